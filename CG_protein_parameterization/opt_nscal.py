@@ -4,7 +4,7 @@
 @author: Yang Jiang @ PSU
 """
 
-import os, time, traceback, io, sys, getopt, multiprocessing, random
+import os, time, traceback, io, sys, getopt, multiprocessing, random, hashlib, shutil
 import parmed as pmd
 import numpy as np
 
@@ -23,6 +23,8 @@ usage = '''
                                proteins.
                 [--casm | -c] <0 or 1> CG model type. Default 0, C-alpha model.
                               1, C-alpha side chain model.
+                [--ffcache | -f] <directory> of compiled xml force fields. Default 
+                                 ~/.cache/cg_simtk_ff. If empty, always run parse_cg_prm.py.
                 [--help | -h]
   
   Example domain.dat:
@@ -52,9 +54,10 @@ ntraj = 10
 restart = 0
 nscal_level_file = ""
 casm = 0 # use C-alpha model
+ff_cache_dir = "~/.cache/cg_simtk_ff"
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:],"hi:d:t:n:p:j:r:s:c:", ["help", "input=", "domain=", "temp=", "ppn=", "tpn=", "ntraj=", "restart=", "nscal=", "casm="])
+    opts, args = getopt.getopt(sys.argv[1:],"hi:d:t:n:p:j:r:s:c:f:", ["help", "input=", "domain=", "temp=", "ppn=", "tpn=", "ntraj=", "restart=", "nscal=", "casm=", "ffcache="])
 except getopt.GetoptError:
     print(usage)
     sys.exit()
@@ -80,6 +83,8 @@ for opt, arg in opts:
         nscal_level_file = arg
     elif opt in ("-c", "--casm"):
         casm = int(arg)
+    elif opt in ("-f", "--ffcache"):
+        ff_cache_dir = arg
 
 has_error = False
 if input_pdb == "":
@@ -326,6 +331,56 @@ def convert_time(t):
     s = int(t - h * 3600 - m * 60)
     return "%d:%d:%d"%(h,m,s)    
 
+def read_new_step(out_file, offset):
+    # Read only the lines appended to out_file after byte offset and return the last 
+    # reported step (None if no new step) and the offset of the unread part
+    if os.path.getsize(out_file) < offset:
+        offset = 0
+    f = open(out_file, 'rb')
+    f.seek(offset)
+    data = f.read()
+    f.close()
+    end = data.rfind(b'\n') + 1
+    step = None
+    for line in reversed(data[:end].decode().split('\n')):
+        line = line.strip()
+        if not line.startswith('Time') and not line == '':
+            step = int(line.split()[1])
+            break
+    return (step, offset+end)
+
+def compile_cg_xml(prm_name, top_name):
+    # Convert prm_name to OpenMM xml with parse_cg_prm.py. The xml is cached in ff_cache_dir 
+    # under the hash of the prm/top files and the parser script, so nscal levels that have 
+    # been compiled before (e.g. on restart) are copied instead of parsed again
+    xml_name = prm_name.split('.prm')[0]+'.xml'
+    cache_file = ''
+    if ff_cache_dir != '':
+        h = hashlib.sha1()
+        input_file_list = [prm_name, top_name]
+        parser = shutil.which('parse_cg_prm.py')
+        if parser != None:
+            input_file_list.append(parser)
+        for fn in input_file_list:
+            f = open(fn, 'rb')
+            h.update(f.read())
+            f.close()
+        cache_dir = os.path.expanduser(ff_cache_dir)
+        cache_file = cache_dir+'/xml_'+h.hexdigest()+'.xml'
+        if os.path.exists(cache_file):
+            shutil.copyfile(cache_file, xml_name)
+            return xml_name
+    os.system('parse_cg_prm.py -p %s -t %s'%(prm_name, top_name))
+    if cache_file != '' and os.path.exists(xml_name):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file+'.%d.tmp'%os.getpid()
+            shutil.copyfile(xml_name, tmp_file)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print('Warning: cannot save compiled force field to %s (%s).'%(cache_file, str(e)))
+    return xml_name
+
 def run_simulation(idx, prefix, prm_name, rand):
     if use_gpu == 1:
         gpu = int(multiprocessing.current_process().name.split('-')[-1])-1-worker_idx
@@ -408,8 +463,7 @@ for iteration in range(start_nscal_level, len(nscal_set['a'])):
         
         os.chdir('setup')
         (prefix, prm_name) = creat_CG_model("../../%s"%clean_pdb, casm, domain)
-        os.system('parse_cg_prm.py -p %s -t %s'%(prm_name, prefix+'.top'))
-        prm_name = prm_name.split('.prm')[0]+'.xml'
+        prm_name = compile_cg_xml(prm_name, prefix+'.top')
         os.chdir('../')
         
         fo = open('../opt_nscal.log', 'a')
@@ -418,11 +472,14 @@ for iteration in range(start_nscal_level, len(nscal_set['a'])):
         
         start_time = [time.time() for i in range(ntraj)]
         start_step = [0 for i in range(ntraj)]
+        last_step = [0 for i in range(ntraj)]
+        out_offset = [0 for i in range(ntraj)]
         for i in range(ntraj):
             if os.path.exists('%d.out'%(i+1)):
-                info = os.popen('tail -n 1 %d.out'%(i+1)).readlines()[0]
-                if not info.strip().startswith('Time') and not info.strip() == '':
-                    start_step[i] = int(info.strip().split()[1])
+                (step, out_offset[i]) = read_new_step('%d.out'%(i+1), 0)
+                if step != None:
+                    start_step[i] = step
+                    last_step[i] = step
         
         pool = multiprocessing.Pool(nproc)
         for i in range(ntraj):
@@ -440,11 +497,10 @@ for iteration in range(start_nscal_level, len(nscal_set['a'])):
                     speed = '--'
                     used_time = np.nan
                 elif os.path.exists('%d.out'%(i+1)):
-                    info = os.popen('tail -n 1 %d.out'%(i+1)).readlines()[0]
-                    if not info.strip().startswith('Time') and not info.strip() == '':
-                        current_step = int(info.strip().split()[1])
-                    else:
-                        current_step = 0
+                    (step, out_offset[i]) = read_new_step('%d.out'%(i+1), out_offset[i])
+                    if step != None:
+                        last_step[i] = step
+                    current_step = last_step[i]
                     used_time = time.time() - start_time[i]
                     speed = (current_step - start_step[i])/used_time
                 else:
@@ -8,9 +8,10 @@ except:
     from simtk.openmm import *
     from simtk.unit import *
 from sys import stdout, exit, stderr
-import getopt, os, time, multiprocessing, random, math
+import getopt, os, time, multiprocessing, queue, random, math, hashlib, shutil, struct
 import parmed as pmd
 import mdtraj
+import numpy as np
 
 usage = '\nUsage: python parallel_temperature_REX.py\n' \
         '       --ctrlfile | -f <REX.ctrl> Control file for temperature replica exchange\n'\
@@ -29,6 +30,12 @@ usage = '\nUsage: python parallel_temperature_REX.py\n' \
         '  log_file = info.log\n'\
         '  ene_file_prefix = ene\n'\
         '  accp_file_prefix = stats\n'\
+        '  ff_cache_dir = ~/.cache/cg_simtk_ff\n'\
+        '  checkpoint_minutes = 10\n'\
+        '  exch_mode = neighbor\n'\
+        '  exch_attempts = 0\n'\
+        '  async_rex = 0\n'\
+        '  async_wait = 0.1\n'\
         '  starting_strucs_t1 = setup/1shf_clean_ca.cor\n'\
         '  starting_strucs_t2 = setup/1shf_clean_ca.cor\n'\
         '  starting_strucs_t3 = setup/1shf_clean_ca.cor\n'\
@@ -42,13 +49,19 @@ usage = '\nUsage: python parallel_temperature_REX.py\n' \
         '  starting_strucs_t11 = setup/1shf_clean_ca.cor\n'\
         '  starting_strucs_t12 = setup/1shf_clean_ca.cor\n'
 
-###### run Langevin Dynamics ######
-def run_REX_LD(psf_file, psf, forcefield, templete_map, cor, temp, strtemp, outname, properties, simulation_steps, trajname, rand, window, return_dict):
-    start_time = time.time()
+###### Replica worker ######
+# Long-lived process of one window holding its context for the whole run
+# Positions and velocities of all windows are exchanged through the shared arrays pos_buf and vel_buf of shape 
+# (2, nwin, natom, 3). In synchronous exchange cycle c reads buffer (c-1)%2 and writes buffer c%2, so a window never 
+# overwrites a structure that another window still has to read.
+# Tasks in task_queue: (read_slot, write_slot, nsteps, src, scale, strtemp, trajname, append) or None to quit. The 
+# window continues from the structure of window src in buffer read_slot with velocities scaled by scale, or from its 
+# own context if src is None. If strtemp is not None, velocities are generated at strtemp instead. append: whether to 
+# append to the existing trajectory trajname.
+def replica_worker(window, psf_file, psf, system_xml, temp, properties, rand, pos_buf, vel_buf, task_queue, 
+    result_queue):
     timestep = 0.015*picoseconds
     fbsolu = 0.05/picosecond
-    nonbond_cutoff = 2.0*nanometer
-    switch_cutoff = 1.8*nanometer
     constraint_tolerance = 0.00001
     psf_pmd = pmd.charmm.psf.CharmmPsfFile(psf_file)
     top = psf.topology
@@ -57,6 +70,191 @@ def run_REX_LD(psf_file, psf, forcefield, templete_map, cor, temp, strtemp, outn
         if res.name != psf_pmd.residues[resid].name:
             res.name = psf_pmd.residues[resid].name
     platform = Platform.getPlatformByName('CPU')
+    system = XmlSerializer.deserialize(system_xml)
+    integrator = LangevinIntegrator(temp, fbsolu, timestep)
+    integrator.setConstraintTolerance(constraint_tolerance)
+    integrator.setRandomNumberSeed(rand)
+    simulation = Simulation(top, system, integrator, platform, properties)
+    dcd_reporter = None
+    while True:
+        task = task_queue.get()
+        if task == None:
+            break
+        (read_slot, write_slot, nsteps, src, scale, strtemp, trajname, append) = task
+        if strtemp != None:
+            simulation.context.setPositions(pos_buf[read_slot, src]*nanometer)
+            simulation.context.setVelocitiesToTemperature(strtemp)
+        elif src != None:
+            simulation.context.setPositions(pos_buf[read_slot, src]*nanometer)
+            simulation.context.setVelocities(vel_buf[read_slot, src]*scale*nanometer/picosecond)
+        simulation.reporters = []
+        if trajname != '':
+            if dcd_reporter == None:
+                dcd_reporter = DCDReporter(trajname, nsteps, append=append)
+            simulation.reporters.append(dcd_reporter)
+        # frames are saved at the end of each cycle
+        simulation.currentStep = 0
+        md_time = time.time()
+        simulation.step(nsteps)
+        md_time = time.time() - md_time
+        state = simulation.context.getState(getPositions=True, getVelocities=True, getEnergy=True)
+        pos_buf[write_slot, window] = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+        vel_buf[write_slot, window] = state.getVelocities(asNumpy=True).value_in_unit(nanometer/picosecond)
+        energy = state.getPotentialEnergy().value_in_unit(kilocalorie/mole)
+        result_queue.put((window, energy, md_time))
+###### END Replica worker ######
+
+###### Run one exchange cycle on the replica workers ######
+# Window w continues from the structure of window exch_map[w] of the last cycle
+# return (energy, process_time) of all windows; process_time is the MD time of each window
+def run_replica_cycle(cycle, nsteps, exch_map, strtemp_list, trajname_list, append):
+    global nwin, temps, task_queue_list, result_queue
+    for window in range(nwin):
+        src = exch_map[window]
+        scale = (temps[window]/temps[src])**0.5
+        # windows restarted from a checkpoint load their structures in the first cycle
+        if src == window and strtemp_list[window] == None and cycle > 0:
+            src = None
+        task_queue_list[window].put(((cycle-1)%2, cycle%2, nsteps, src, scale, strtemp_list[window], 
+            trajname_list[window], append))
+    energy = [0 for window in range(nwin)]
+    process_time = [0 for window in range(nwin)]
+    for i in range(nwin):
+        (window, ene, md_time) = result_queue.get()
+        energy[window] = ene
+        process_time[window] = md_time
+    return (energy, process_time)
+###### END Run one exchange cycle ######
+
+###### Save the structures of the last cycle ######
+# The structure of window w in buffer slot is saved to aa<w+1>/1_<i>_<phase>.cor
+def save_window_cor(slot, i, phase):
+    global nwin, psf_pmd, pos_buf
+    for window in range(nwin):
+        psf_pmd.coordinates = pos_buf[slot, window]*10
+        psf_pmd.save('aa'+str(window+1)+'/1_'+str(i)+'_'+phase+'.cor', format='charmmcrd', overwrite=True)
+###### END Save the structures of the last cycle ######
+
+###### Save REX checkpoint ######
+# Binary checkpoint of the exchange state in buffer slot: positions (nm), velocities (nm/ps) and potential energies 
+# (kcal/mol) of all windows, exchange map and window_track, acceptance counters, per-pair statistics and round trips, 
+# the number of finished exchanges of the current phase, the state of the random number generator of exchanges and 
+# the sizes (bytes) of the trajectory and energy file of each window
+# async_state: None, or dict of the asynchronous production phase: positions and velocities each window starts its 
+# next segment from, nseg (finished segments), dcd_offset and ene_offset of each window, and frame_info of the PROD 
+# lines not written yet (see run_async_prod())
+def save_rex_checkpoint(checkpoint_file, slot, phase, nexch_done, energy, async_state=None):
+    global nwin, ene_file, pos_buf, vel_buf, exch_map, window_track, accp, nexch, pair_stats, half_trips, replica_end
+    dcd_offset = []
+    ene_offset = []
+    for window in range(nwin):
+        for (offset_list, fn) in [(dcd_offset, 'mc1.dcd'), (ene_offset, ene_file)]:
+            fn = 'aa'+str(window+1)+'/'+fn
+            if os.path.exists(fn):
+                offset_list.append(os.path.getsize(fn))
+            else:
+                offset_list.append(0)
+    positions = pos_buf[slot]
+    velocities = vel_buf[slot]
+    exch_map_save = exch_map
+    async_data = {}
+    if async_state != None:
+        positions = async_state['positions']
+        velocities = async_state['velocities']
+        dcd_offset = async_state['dcd_offset']
+        ene_offset = async_state['ene_offset']
+        # the structures already are in the windows they continue in
+        exch_map_save = list(range(nwin))
+        frame_index = sorted(async_state['frame_info'].keys())
+        frame_data = [[async_state['frame_info'][k][key] for key in ['replica', 'start', 'end', 'md', 'wait']] 
+            for k in frame_index]
+        async_data = {'nseg': np.array(async_state['nseg']), 'frame_index': np.array(frame_index, dtype=int), 
+            'frame_data': np.array(frame_data, dtype=float).reshape((len(frame_index), 5, nwin))}
+    rng_state = random.getstate()
+    tmp_file = checkpoint_file.split('.npz')[0]+'.tmp.npz'
+    np.savez(tmp_file, phase=phase, nexch_done=nexch_done, positions=positions, 
+        velocities=velocities, energy=np.array(energy), exch_map=np.array(exch_map_save), 
+        window_track=np.array(window_track), accp=np.array(accp), nexch=np.array(nexch), 
+        pair_stats=np.array(pair_stats), half_trips=np.array(half_trips), replica_end=np.array(replica_end), 
+        rng_version=rng_state[0], rng_state=np.array(rng_state[1], dtype=np.int64), dcd_offset=np.array(dcd_offset), 
+        ene_offset=np.array(ene_offset), **async_data)
+    # never leave a broken checkpoint if the run is killed while writing
+    os.replace(tmp_file, checkpoint_file)
+###### END Save REX checkpoint ######
+
+###### Load REX checkpoint ######
+# return dict of the arrays saved by save_rex_checkpoint()
+def load_rex_checkpoint(checkpoint_file):
+    data = np.load(checkpoint_file)
+    checkpoint = {}
+    for key in data.files:
+        checkpoint[key] = data[key]
+    data.close()
+    return checkpoint
+###### END Load REX checkpoint ######
+
+###### Truncate trajectory ######
+# Truncate the DCD file to offset bytes holding nframe frames and update the number of frames in its header, so that 
+# DCDReporter appends right after the last frame
+def truncate_dcd(dcd_file, offset, nframe):
+    f = open(dcd_file, 'r+b')
+    f.truncate(offset)
+    f.seek(12)
+    (first_step, interval) = struct.unpack('<2i', f.read(8))
+    f.seek(8)
+    f.write(struct.pack('<i', nframe))
+    f.seek(20)
+    f.write(struct.pack('<i', first_step+max(nframe-1, 0)*interval))
+    f.close()
+###### END Truncate trajectory ######
+
+###### Count trajectory frames ######
+# return the number of complete frames in the DCD file written by DCDReporter
+def count_dcd_frames(dcd_file):
+    f = open(dcd_file, 'rb')
+    head = f.read(96)
+    if len(head) < 96:
+        f.close()
+        return 0
+    box_flag = struct.unpack('<i', head[44:48])[0]
+    comments_size = struct.unpack('<i', head[92:96])[0]
+    f.seek(104+comments_size)
+    natom = struct.unpack('<i', f.read(4))[0]
+    f.close()
+    header_size = 104+comments_size+8
+    frame_size = 3*(4*natom+8)
+    if box_flag != 0:
+        frame_size += 56
+    return max(os.path.getsize(dcd_file)-header_size, 0)//frame_size
+###### END Count trajectory frames ######
+
+###### Load compiled CG system ######
+# The serialized System is cached in cache_dir under the hash of the top/prm/psf files, the parser script and the 
+# OpenMM version, so that repeated runs skip the prm -> xml -> ForceField -> System pipeline
+def load_cg_system(psf_file, top_file, prm_file, top, templete_map, cache_dir):
+    nonbond_cutoff = 2.0*nanometer
+    switch_cutoff = 1.8*nanometer
+    cache_file = ''
+    if cache_dir != '':
+        h = hashlib.sha1()
+        input_file_list = [top_file, prm_file, psf_file]
+        parser = shutil.which('parse_cg_prm.py')
+        if parser != None:
+            input_file_list.append(parser)
+        for fn in input_file_list:
+            f = open(fn, 'rb')
+            h.update(f.read())
+            f.close()
+        h.update(Platform.getOpenMMVersion().encode())
+        cache_file = cache_dir+'/rex_'+h.hexdigest()+'.xml'
+        if os.path.exists(cache_file):
+            f = open(cache_file, 'r')
+            system_xml = f.read()
+            f.close()
+            return (system_xml, cache_file)
+
+    os.system('parse_cg_prm.py -t '+top_file+' -p '+prm_file)
+    forcefield = ForceField(prm_file.split('.prm')[0]+'.xml')
     system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
                                      nonbondedCutoff=nonbond_cutoff, constraints=AllBonds, 
                                      removeCMMotion=True, ignoreExternalBonds=True,
@@ -66,40 +264,27 @@ def run_REX_LD(psf_file, psf, forcefield, templete_map, cor, temp, strtemp, outn
         if force.getName() == 'CustomNonbondedForce':
             custom_nb_force = force
             break
-    # custom_nb_force = system.getForce(4)
     custom_nb_force.setUseSwitchingFunction(True)
     custom_nb_force.setSwitchingDistance(switch_cutoff)
     # End set to use switching function explicitly for CG Custom Nonbond Force #
-    integrator = LangevinIntegrator(temp, fbsolu, timestep)
-    integrator.setConstraintTolerance(constraint_tolerance)
-    integrator.setRandomNumberSeed(rand)
-    simulation = Simulation(top, system, integrator, platform, properties)
-    simulation.context.setPositions(cor.positions)
-    simulation.context.setVelocitiesToTemperature(strtemp)
-    simulation.reporters = []
-    #simulation.reporters.append(PDBReporter(outname+'.pdb', simulation_steps))
-    if trajname != '':
-        words = outname.split('/')
-        words = words[1].split('_')
-        if words[1] == '1':
-            simulation.reporters.append(DCDReporter(trajname, simulation_steps, append=False))
-        else:
-            simulation.reporters.append(DCDReporter(trajname, simulation_steps, append=True))
-    simulation.step(simulation_steps)
-    #pdb = pmd.load_file(outname+'.pdb')
-    #pdb.save(outname, format='charmmcrd', overwrite=True)
-    #os.remove(outname+'.pdb')
-    current_cor = simulation.context.getState(getPositions=True).getPositions()
-    psf_pmd.positions = current_cor
-    psf_pmd.save(outname, format='charmmcrd', overwrite=True)
-    energy = simulation.context.getState(getEnergy=True).getPotentialEnergy()
-    energy = energy.value_in_unit(kilocalorie/mole)
-    end_time = time.time()
-    return_dict[window] = [energy, end_time-start_time]
-###### END run Langevin Dynamics ######
+    system_xml = XmlSerializer.serialize(system)
+
+    if cache_file != '':
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file+'.%d.tmp'%os.getpid()
+            f = open(tmp_file, 'w')
+            f.write(system_xml)
+            f.close()
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print('Warning: cannot save compiled system to %s (%s).'%(cache_file, str(e)))
+    return (system_xml, '')
+###### END Load compiled CG system ######
 
 ###### Temperature Swap ######
-def Temperature_Swap(windows, temps, energy):
+# pair_stats: None or [attempt, accept] matrices of window pairs, updated in place
+def Temperature_Swap(windows, temps, energy, pair_stats=None):
     kb = 1.9872/1000 # kcal/mol
     exch_map = []
     for i in range(windows[-1]+1):
@@ -113,15 +298,284 @@ def Temperature_Swap(windows, temps, energy):
         dt = 1 / temp_1 - 1 / temp_2
         exp = math.exp(-dt*de/kb)
         rand = random.random()
+        if pair_stats != None:
+            pair_stats[0][windows[i-1]][windows[i]] += 1
         if (exp < 1 and rand < exp) or (exp >= 1): # Accept
             exch_map[windows[i-1]] = windows[i]
             exch_map[windows[i]] = windows[i-1]
+            if pair_stats != None:
+                pair_stats[1][windows[i-1]][windows[i]] += 1
         else:
             exch_map[windows[i-1]] = windows[i-1]
             exch_map[windows[i]] = windows[i]
     return exch_map
 ###### END Temperature Swap ######
 
+###### Gibbs Temperature Swap ######
+# nattempt swaps between randomly chosen pairs of windows (neighbors or not) are attempted on the permutation of 
+# structures with the heat-bath criterion p/(1+p), p being the Metropolis ratio. Each attempt samples the pair from its 
+# conditional distribution instead of flipping it back and forth, so many attempts approach independence sampling of 
+# the permutation at no extra MD cost. Attempts only need the potential energies of the last cycle.
+# windows: windows taking part in the swaps
+# pair_stats: None or [attempt, accept] matrices of window pairs, updated in place. A pair counts one attempt per call 
+# if it was attempted, and is accepted if one of the two windows continues from the structure of the other.
+def Gibbs_Temperature_Swap(windows, temps, energy, nattempt, pair_stats=None):
+    kb = 1.9872/1000 # kcal/mol
+    beta = [1/(kb*temps[i].value_in_unit(kelvin)) for i in range(len(energy))]
+    exch_map = list(range(len(energy)))
+    attempted = set()
+    for n in range(nattempt):
+        (i, j) = sorted(random.sample(list(windows), 2))
+        attempted.add((i, j))
+        # log of the Metropolis ratio
+        arg = (beta[i]-beta[j])*(energy[exch_map[i]]-energy[exch_map[j]])
+        if arg >= 0:
+            prob = 1/(1+math.exp(-arg))
+        else:
+            prob = math.exp(arg)/(1+math.exp(arg))
+        if random.random() < prob: # Accept
+            (exch_map[i], exch_map[j]) = (exch_map[j], exch_map[i])
+    if pair_stats != None:
+        for (i, j) in attempted:
+            pair_stats[0][i][j] += 1
+            if exch_map[i] == j or exch_map[j] == i:
+                pair_stats[1][i][j] += 1
+    return exch_map
+###### END Gibbs Temperature Swap ######
+
+###### Exchange windows ######
+# return exch_map of the next cycle after exchange i of the current phase
+def exchange_windows(i, energy, pair_stats=None):
+    global nwin, temps, exch_mode, exch_attempts
+    if exch_mode == 'gibbs':
+        return Gibbs_Temperature_Swap(range(nwin), temps, energy, exch_attempts, pair_stats)
+    return Temperature_Swap(range(i%2, nwin), temps, energy, pair_stats)
+###### END Exchange windows ######
+
+###### Count swaps with neighbor windows ######
+# Set nexch and accp of each window from pair_stats (gibbs mode and asynchronous production) counting only the swaps 
+# with its neighbor windows, as in synchronous neighbor mode, so that the acceptance file keeps the per-window 
+# neighbor ratios read by opt_temp.pl. The statistics of all pairs are written to the pair file.
+def count_neighbor_swaps():
+    global nwin, pair_stats, nexch, accp
+    for window in range(nwin):
+        pairs = [(j, j+1) for j in [window-1, window] if j >= 0 and j+1 < nwin]
+        nexch[window] = sum([pair_stats[0][j][k] for (j, k) in pairs])
+        accp[window] = sum([pair_stats[1][j][k] for (j, k) in pairs])
+###### END Count swaps with neighbor windows ######
+
+###### Write per-pair acceptance statistics ######
+def write_pair_stats(pair_file):
+    global nwin, temps, pair_stats, half_trips
+    f = open(pair_file, 'w')
+    # a round trip is a pass of one replica from the lowest to the highest window and back
+    f.write('# Round trips of all replicas: %.1f\n'%(sum(half_trips)/2))
+    f.write('%10s %10s %12s %12s %8s\n'%('T_i', 'T_j', 'Attempts', 'Accepted', 'Ratio'))
+    for i in range(nwin):
+        for j in range(i+1, nwin):
+            if pair_stats[0][i][j] > 0:
+                f.write('%10.1f %10.1f %12d %12d %8.4f\n'%(temps[i].value_in_unit(kelvin), 
+                    temps[j].value_in_unit(kelvin), pair_stats[0][i][j], pair_stats[1][i][j], 
+                    pair_stats[1][i][j]/pair_stats[0][i][j]))
+    f.close()
+###### END Write per-pair acceptance statistics ######
+
+###### Update round trips ######
+# count replicas reaching the lowest or the highest window
+def update_round_trips():
+    global nwin, window_track, half_trips, replica_end
+    for (window, end) in [(0, 0), (nwin-1, 1)]:
+        replica = window_track[window]
+        if replica_end[replica] != end:
+            if replica_end[replica] != -1:
+                half_trips[replica] += 1
+            replica_end[replica] = end
+###### END Update round trips ######
+
+###### Asynchronous production phase ######
+# Windows run segments of nsteps_prod steps without a barrier between exchanges. A window that finishes a segment 
+# waits at most async_wait times the mean MD time of one segment for ready exchange partners: one attempt with a ready 
+# neighbor window in neighbor mode, exch_attempts attempts among all ready windows in gibbs mode. Otherwise it 
+# continues alone. Segments have a fixed number of steps, so whether an attempt is made does not depend on the 
+# configurations, and each attempt is a Metropolis move between the current states of the windows involved, which 
+# preserves detailed balance.
+# The latest structure of window w is kept in pos_buf[slot, w]. Structures are swapped by the main process while the 
+# windows involved are idle, so no window can overwrite a structure that another window still has to read.
+# PROD line k (and T-EXCHNG line k) is written once all windows have finished segment k; it lists the replica of each 
+# window during its segment k. The last column is the mean time (ms) windows waited for exchange partners before 
+# segment k.
+# Every checkpoint_minutes minutes the structure each window starts its current segment from is saved with the 
+# number of finished segments and the trajectory and energy file sizes of each window (see save_rex_checkpoint()).
+# async_nseg and async_frame_info hold the state of a restarted asynchronous production phase.
+# return energy of the last segment of all windows
+def run_async_prod(slot, strtemp_list):
+    global nwin, temps, exch_mode, exch_attempts, nsteps_prod, nexch_prod, nsteps_start, async_wait
+    global task_queue_list, result_queue, pos_buf, vel_buf, window_track, pair_stats, nexch, accp
+    global log_file, ene_file, accp_file, pair_file, overhead_list, md_total, idle_total
+    global checkpoint_minutes, checkpoint_time, async_nseg, async_frame_info
+    nseg = list(async_nseg) # finished segments of each window
+    energy = [0 for window in range(nwin)]
+    ready = {} # idle window: time it finished the last segment
+    seg_start = [0 for window in range(nwin)]
+    # segment index: replica, start and end time, MD time and waiting time of each window
+    frame_info = dict(async_frame_info)
+    # structure each window starts its current segment from and the file sizes after its last finished segment
+    start_pos = pos_buf[slot].copy()
+    start_vel = vel_buf[slot].copy()
+    dcd_offset = []
+    ene_offset = []
+    for window in range(nwin):
+        for (offset_list, fn) in [(dcd_offset, 'mc1.dcd'), (ene_offset, ene_file)]:
+            fn = 'aa'+str(window+1)+'/'+fn
+            if os.path.exists(fn):
+                offset_list.append(os.path.getsize(fn))
+            else:
+                offset_list.append(0)
+    exch_text = '' # exchanges since the last T-EXCHNG line
+    next_line = nsteps_start
+    nrunning = 0
+    nresult = 0
+    md_sum = 0
+    prod_start = time.time()
+
+    # window: (src, scale, strtemp); src: None or window whose structure in slot is loaded
+    def dispatch(window, src, scale, strtemp):
+        now = time.time()
+        k = nseg[window]+1
+        if k not in frame_info:
+            frame_info[k] = {'replica': [0]*nwin, 'start': [0]*nwin, 'end': [0]*nwin, 'md': [0]*nwin, 
+                'wait': [0]*nwin}
+        frame_info[k]['replica'][window] = window_track[window]
+        frame_info[k]['start'][window] = now
+        if window in ready:
+            frame_info[k]['wait'][window] = now - ready[window]
+            idle_total[window] += now - ready[window]
+            del ready[window]
+        seg_start[window] = now
+        start_pos[window] = pos_buf[slot, window]
+        start_vel[window] = vel_buf[slot, window]
+        task_queue_list[window].put((slot, slot, nsteps_prod, src, scale, strtemp, 'aa'+str(window+1)+'/mc1.dcd', 
+            k > 1))
+
+    # swap the structures of the windows according to exch_map; return list of exchanged windows
+    def apply_exchange(windows, exch_map):
+        moved = [window for window in windows if exch_map[window] != window]
+        pos = dict([(window, pos_buf[slot, exch_map[window]].copy()) for window in moved])
+        vel = dict([(window, vel_buf[slot, exch_map[window]].copy()) for window in moved])
+        new_track = dict([(window, window_track[exch_map[window]]) for window in moved])
+        for window in moved:
+            pos_buf[slot, window] = pos[window]
+            vel_buf[slot, window] = vel[window]*(temps[window]/temps[exch_map[window]])**0.5
+            window_track[window] = new_track[window]
+        if len(moved) > 0:
+            update_round_trips()
+        return moved
+
+    for window in range(nwin):
+        # windows of a restarted run may have finished all segments
+        if nseg[window] < nexch_prod:
+            dispatch(window, window, 1, strtemp_list[window])
+            nrunning += 1
+    while nrunning > 0 or len(ready) > 0:
+        timeout = None
+        if len(ready) > 0:
+            timeout = max(0, min(ready.values()) + async_wait*md_sum/nresult - time.time())
+        try:
+            result = result_queue.get(timeout=timeout)
+        except queue.Empty:
+            result = None
+        now = time.time()
+        if result != None:
+            (window, ene, md_time) = result
+            nrunning -= 1
+            nresult += 1
+            md_sum += md_time
+            md_total[window] += md_time
+            nseg[window] += 1
+            energy[window] = ene
+            k = nseg[window]
+            frame_info[k]['end'][window] = now
+            frame_info[k]['md'][window] = md_time
+            f = open('aa'+str(window+1)+'/'+ene_file, 'a')
+            f.write('%.6f\n'%(ene))
+            f.close()
+            # the worker has flushed the frame of this segment before reporting
+            dcd_offset[window] = os.path.getsize('aa'+str(window+1)+'/mc1.dcd')
+            ene_offset[window] = os.path.getsize('aa'+str(window+1)+'/'+ene_file)
+            if nseg[window] < nexch_prod:
+                ready[window] = now
+                # attempt exchanges with ready partners
+                windows = []
+                if exch_mode == 'gibbs':
+                    if len(ready) > 1:
+                        windows = sorted(ready.keys())
+                        exch_map = Gibbs_Temperature_Swap(windows, temps, energy, exch_attempts, pair_stats)
+                else:
+                    partners = [j for j in [window-1, window+1] if j in ready]
+                    if len(partners) > 0:
+                        windows = sorted([window, random.choice(partners)])
+                        exch_map = Temperature_Swap(windows, temps, energy, pair_stats)
+                        exch_map += list(range(len(exch_map), nwin))
+                if len(windows) > 0:
+                    moved = apply_exchange(windows, exch_map)
+                    for j in moved:
+                        exch_text += '%.1f <- %.1f '%(temps[j].value_in_unit(kelvin), 
+                            temps[exch_map[j]].value_in_unit(kelvin))
+                    for j in windows:
+                        if j in moved:
+                            dispatch(j, j, 1, None)
+                        else:
+                            dispatch(j, None, 1, None)
+                        nrunning += 1
+        # windows without partners in time continue alone
+        for window in sorted(ready.keys()):
+            if now - ready[window] >= async_wait*md_sum/nresult:
+                dispatch(window, None, 1, None)
+                nrunning += 1
+
+        # write finished segments
+        while next_line <= nexch_prod and min(nseg) >= next_line:
+            info = frame_info.pop(next_line)
+            overhead = sum(info['wait'])/nwin*1000
+            overhead_list.append(overhead)
+            log_file_object = open(log_file,'a')
+            log_file_object.write('PROD '+str(next_line)+': ')
+            for window in range(nwin):
+                if window == nwin-1:
+                    log_file_object.write(str(info['replica'][window]+1)+'| ')
+                else:
+                    log_file_object.write(str(info['replica'][window]+1)+'||| ')
+            cost_time = (now-prod_start)/(next_line-nsteps_start+1)
+            log_file_object.write('%s %s %.2f %.2f %s %.1f\n'%(time.strftime('%H:%M:%S', 
+                time.localtime(min(info['start']))), time.strftime('%H:%M:%S', time.localtime(max(info['end']))), 
+                min(info['md']), max(info['md']), convert_time((nexch_prod-next_line)*cost_time), overhead))
+            log_file_object.close()
+            count_neighbor_swaps()
+            accp_file_object = open('logs/'+accp_file,'a')
+            accp_file_object.write('T-EXCHNG %d: '%(next_line)+exch_text)
+            exch_text = ''
+            for window in range(nwin):
+                if nexch[window] == 0:
+                    accp_file_object.write('%.2f '%(0.0))
+                else:
+                    accp_file_object.write('%.2f '%(accp[window]/nexch[window]))
+            accp_file_object.write('\n')
+            accp_file_object.close()
+            next_line += 1
+
+        if checkpoint_minutes > 0 and time.time() - checkpoint_time >= checkpoint_minutes*60:
+            # idle windows start from their structure in slot, which is not written by any worker
+            for window in ready.keys():
+                start_pos[window] = pos_buf[slot, window]
+                start_vel[window] = vel_buf[slot, window]
+            save_rex_checkpoint('rex_checkpoint.npz', slot, 'prod', min(nseg), energy, {'positions': start_pos, 
+                'velocities': start_vel, 'nseg': nseg, 'dcd_offset': dcd_offset, 'ene_offset': ene_offset, 
+                'frame_info': frame_info})
+            write_pair_stats('logs/'+pair_file)
+            checkpoint_time = time.time()
+    return energy
+###### END Asynchronous production phase ######
+
 ###### convert time seconds to hours ######
 def convert_time(seconds):
     m, s = divmod(seconds, 60)
@@ -151,6 +605,7 @@ nwin = 0 # window number
 temps = [] # window temperature
 tpn = 0 # total number of processors
 ppn = 0 # number of processors for each window
+ppn_list = [] # number of processors of each window
 nexch_equil = 2 # number of exchanges in equilibrium
 nsteps_equil = 10000 # number of steps in equilibrium simulation for each exchange
 nexch_prod = 100000 # number of exchanges in production
@@ -164,6 +619,16 @@ psf = '' # Charmm psf file for CG model
 top = '' # Charmm top file for CG model
 param = '' # Charmm prm file for CG model
 starting_strucs = [] # starting structures (Charmm cor file)
+ff_cache_dir = '~/.cache/cg_simtk_ff' # directory of compiled systems; '': always compile the force field
+exch_mode = 'neighbor' # neighbor: one attempt for alternating even/odd neighbor pairs per exchange; gibbs: 
+                       # exch_attempts attempts between any pairs of windows per exchange
+exch_attempts = 0 # number of attempts per exchange in gibbs mode; 0: nwindows^3
+async_rex = 0 # 1: windows run production without a barrier and exchange with whichever partners are ready; 
+              # 0: all windows wait for each other before each exchange
+async_wait = 0.1 # in asynchronous mode, a ready window waits at most async_wait times the mean MD time of one 
+                 # exchange for exchange partners
+checkpoint_minutes = 10 # save the exchange state of all windows to rex_checkpoint.npz every checkpoint_minutes 
+                        # minutes and at the end of each phase; 0: only at the end of each phase
 
 if not os.path.exists(ctrlfile):
     print('Error: cannot find control file ' + ctrlfile + '.')
@@ -244,6 +709,33 @@ try:
             words = line.split()
             starting_strucs.append(words[2])
             continue
+        if line.startswith('exch_mode'):
+            words = line.split()
+            exch_mode = words[2]
+            continue
+        if line.startswith('exch_attempts'):
+            words = line.split()
+            exch_attempts = int(words[2])
+            continue
+        if line.startswith('async_rex'):
+            words = line.split()
+            async_rex = int(words[2])
+            continue
+        if line.startswith('async_wait'):
+            words = line.split()
+            async_wait = float(words[2])
+            continue
+        if line.startswith('checkpoint_minutes'):
+            words = line.split()
+            checkpoint_minutes = float(words[2])
+            continue
+        if line.startswith('ff_cache_dir'):
+            words = line.split()
+            if len(words) > 2:
+                ff_cache_dir = words[2]
+            else:
+                ff_cache_dir = ''
+            continue
 finally:
      file_object.close()
 
@@ -260,10 +752,33 @@ if len(temps) == 0:
 if tpn == 0:
     print('Error: no processor number specified.')
     sys.exit()
+if async_rex != 0 and async_rex != 1:
+    print('Error: async_rex can only be 0 or 1.')
+    sys.exit()
+if async_wait < 0:
+    print('Error: async_wait cannot be negative.')
+    sys.exit()
 if tpn % nwin == 0:
     ppn = int(tpn / nwin)
+    ppn_list = [ppn for i in range(nwin)]
+elif async_rex == 1 and tpn > nwin:
+    # without a barrier the windows with one more processor just run more segments in between
+    ppn = int(tpn / nwin)
+    ppn_list = [ppn+1 if i < tpn % nwin else ppn for i in range(nwin)]
 else:
-    print('Error: total processor number are not multiple of window number.')
+    print('Error: total processor number are not multiple of window number. Use async_rex = 1 to run windows with '
+        'uneven processor numbers.')
+    sys.exit()
+if exch_mode != 'neighbor' and exch_mode != 'gibbs':
+    print('Error: exch_mode can only be neighbor or gibbs.')
+    sys.exit()
+if exch_attempts < 0:
+    print('Error: exch_attempts cannot be negative.')
+    sys.exit()
+if exch_mode == 'gibbs' and exch_attempts == 0:
+    exch_attempts = nwin**3
+if checkpoint_minutes < 0:
+    print('Error: checkpoint_minutes cannot be negative.')
     sys.exit()
 if psf == '':
     print('Error: no Charmm psf file specified.')
@@ -280,7 +795,67 @@ if len(starting_strucs) == 0 and restart == 0:
 if len(starting_strucs) != nwin and restart == 0:
     print('Error: window number and structure number mismatch.')
     sys.exit()
-if restart == 1:
+nexch_equil_start = 0 # first exchange of the equil phase
+checkpoint = None
+if restart == 1 and os.path.exists('rex_checkpoint.npz'):
+    # restart from the last checkpoint; trajectory and energy files are truncated to the checkpoint by offset
+    checkpoint = load_rex_checkpoint('rex_checkpoint.npz')
+    if checkpoint['positions'].shape[0] != nwin:
+        print('Error: window number and rex_checkpoint.npz mismatch.')
+        sys.exit()
+    nexch_done = int(checkpoint['nexch_done'])
+    # never discard production frames written after the checkpoint
+    nframe_checkpoint = [0 for i in range(nwin)]
+    if 'nseg' in checkpoint:
+        # windows of the asynchronous production phase have finished different numbers of segments
+        if async_rex == 0:
+            print('Error: rex_checkpoint.npz is written by asynchronous production; please restart with async_rex = 1.')
+            sys.exit()
+        nframe_checkpoint = [int(n) for n in checkpoint['nseg']]
+    elif str(checkpoint['phase']) == 'prod':
+        nframe_checkpoint = [nexch_done for i in range(nwin)]
+    n_frame_traj = []
+    for i in range(nwin):
+        if os.path.exists('aa'+str(i+1)+'/mc1.dcd'):
+            n_frame_traj.append(count_dcd_frames('aa'+str(i+1)+'/mc1.dcd'))
+        else:
+            n_frame_traj.append(0)
+    if max([n_frame_traj[i] - nframe_checkpoint[i] for i in range(nwin)]) > 0:
+        print('Warning: trajectories are newer than rex_checkpoint.npz; rebuild the restart point from the '
+            'trajectories instead.')
+        checkpoint = None
+        if nsteps_start == 1:
+            nsteps_start = min(n_frame_traj)+1
+if checkpoint != None:
+    if str(checkpoint['phase']) == 'equil':
+        nexch_equil_start = min(nexch_done, nexch_equil)
+        nsteps_start = 1
+    else:
+        if nsteps_start != 1 and nsteps_start != nexch_done+1:
+            print('Warning: restart from the checkpoint at exchange '+str(nexch_done)+' instead of nsteps_start = '+
+                str(nsteps_start))
+        nexch_equil = 0
+        nsteps_start = nexch_done+1
+    for i in range(nwin):
+        for (offset, fn) in [(checkpoint['dcd_offset'][i], 'mc1.dcd'), 
+            (checkpoint['ene_offset'][i], ene_file_prefix+'_1.log')]:
+            fn = 'aa'+str(i+1)+'/'+fn
+            if offset == 0:
+                if os.path.exists(fn):
+                    os.remove(fn)
+                continue
+            if not os.path.exists(fn) or os.path.getsize(fn) < offset:
+                print('Error: '+fn+' is shorter than in rex_checkpoint.npz.')
+                sys.exit()
+            if fn.endswith('.dcd'):
+                truncate_dcd(fn, offset, nframe_checkpoint[i])
+            else:
+                os.truncate(fn, offset)
+    starting_strucs = ['rex_checkpoint.npz' for i in range(nwin)]
+    log_file = log_file.split('.')[0] + '_r_' + str(nsteps_start) + '.log'
+    accp_file_prefix = accp_file_prefix + '_r_' + str(nsteps_start)
+elif restart == 1:
+    # no checkpoint: rebuild the restart point from the trajectories
     nexch_equil = 0
     starting_strucs = []
     n_frame_traj = []
@@ -321,6 +896,7 @@ elif restart == 0:
     nsteps_start = 1
     os.system('rm -rf aa*')
     os.system('rm -rf logs')
+    os.system('rm -f rex_checkpoint.npz')
 else:
     print('Error: restart can only be 0 (no restart) or 1 (restart).')
     sys.exit()
@@ -328,12 +904,9 @@ else:
 
 ###### Setup writing log files ######
 
-os.system('parse_cg_prm.py -t '+top+' -p '+param)
-xml_param = param.split('.prm')
-xml_param = xml_param[0]+'.xml'
-
 ene_file = ene_file_prefix+'_1.log'
 accp_file = accp_file_prefix+'-tswap-1-1.log'
+pair_file = accp_file_prefix+'-pairs-1-1.log'
 
 log_file_object = open(log_file,'w')
 log_file_object.write('Parallel Temperature Replica Exchange for CG Model using OpenMM\nAuthor: Yang Jiang; Ed O\'Brien.\n')
@@ -344,7 +917,7 @@ for i in range(len(temps)):
     log_file_object.write(str(temps[i])+' ')
 log_file_object.write('\n')
 log_file_object.write('Total number of processors: '+str(tpn)+'\n')
-log_file_object.write('Number of processors for each window: '+str(ppn)+'\n')
+log_file_object.write('Number of processors for each window: '+' '.join([str(n) for n in ppn_list])+'\n')
 log_file_object.write('Number of exchanges in equilibrium: '+str(nexch_equil)+'\n')
 log_file_object.write('Number of steps in equilibrium for each exchange: '+str(nsteps_equil)+'\n')
 log_file_object.write('Number of exchanges in production: '+str(nexch_prod)+'\n')
@@ -359,6 +932,26 @@ if restart == 0:
     log_file_object.write('No restart requested\n')
 else:
     log_file_object.write('Restart requested from '+str(nsteps_start)+'\n')
+    if checkpoint != None:
+        log_file_object.write('Restart from rex_checkpoint.npz after '+str(int(checkpoint['nexch_done']))+' '+
+            str(checkpoint['phase'])+' exchanges\n')
+log_file_object.write('Windows run on persistent workers and exchange structures through shared memory; velocities are '
+    'rescaled to the new temperature\n')
+if exch_mode == 'gibbs':
+    log_file_object.write('Exchange mode: gibbs with '+str(exch_attempts)+' attempts between any pairs of windows per exchange\n')
+else:
+    log_file_object.write('Exchange mode: neighbor\n')
+log_file_object.write('Pair acceptance file name: '+pair_file+'\n')
+if async_rex == 1:
+    log_file_object.write('Asynchronous production: windows exchange with partners ready within '+str(async_wait)+
+        ' times the mean MD time of one exchange\n')
+if checkpoint_minutes > 0:
+    log_file_object.write('Exchange state will be saved to rex_checkpoint.npz every '+str(checkpoint_minutes)+' minutes\n')
+if async_rex == 1:
+    log_file_object.write('Last column of EQUIL/PROD lines: exchange overhead (ms); mean waiting time for exchange '
+        'partners (ms) of asynchronous PROD lines\n')
+else:
+    log_file_object.write('Last column of EQUIL/PROD lines: exchange overhead (ms)\n')
 for i in range(len(starting_strucs)):
     log_file_object.write('Starting structure for T'+str(i+1)+': '+starting_strucs[i]+'\n')
 log_file_object.close()
@@ -389,10 +982,13 @@ for i in range(nwin):
     window_track.append(i)
     accp.append(0)
     nexch.append(0)
+pair_stats = [[[0 for j in range(nwin)] for i in range(nwin)] for k in range(2)] # [attempt, accept] of window pairs
+half_trips = [0 for i in range(nwin)] # passes of each replica between the lowest and the highest window
+replica_end = [-1 for i in range(nwin)] # last end window visited by each replica; 0: lowest, 1: highest, -1: none
 psf_file = psf
+top_file = top
 psf = CharmmPsfFile(psf)
 psf_pmd = pmd.charmm.psf.CharmmPsfFile(psf_file)
-forcefield = ForceField(xml_param)
 top = psf.topology
 # re-name residues that are changed by openmm
 for resid, res in enumerate(top.residues()):
@@ -402,136 +998,218 @@ templete_map = {}
 for chain in top.chains():
     for res in chain.residues():
         templete_map[res] = res.name
-properties = {'Threads': str(ppn)}
+if ff_cache_dir != '':
+    ff_cache_dir = os.path.expanduser(ff_cache_dir)
+(system_xml, ff_cache_file) = load_cg_system(psf_file, top_file, param, top, templete_map, ff_cache_dir)
+if ff_cache_file != '':
+    log_file_object = open(log_file,'a')
+    log_file_object.write('Compiled system loaded from cache: '+ff_cache_file+'\n')
+    log_file_object.close()
+
+# start one long-lived worker per window
+natom = len(psf_pmd.atoms)
+pos_buf = np.frombuffer(multiprocessing.RawArray('d', 2*nwin*natom*3), dtype=np.float64).reshape((2, nwin, natom, 3))
+vel_buf = np.frombuffer(multiprocessing.RawArray('d', 2*nwin*natom*3), dtype=np.float64).reshape((2, nwin, natom, 3))
+if checkpoint == None:
+    for window in range(nwin):
+        cor = CharmmCrdFile(cor_list[window])
+        pos_buf[1, window] = cor.positions.value_in_unit(nanometer)
+else:
+    pos_buf[1] = checkpoint['positions']
+    vel_buf[1] = checkpoint['velocities']
+    energy = list(checkpoint['energy'])
+    exch_map = [int(w) for w in checkpoint['exch_map']]
+    window_track = [int(w) for w in checkpoint['window_track']]
+    accp = [int(n) for n in checkpoint['accp']]
+    nexch = [int(n) for n in checkpoint['nexch']]
+    pair_stats = checkpoint['pair_stats'].tolist()
+    half_trips = checkpoint['half_trips'].tolist()
+    replica_end = checkpoint['replica_end'].tolist()
+task_queue_list = []
+result_queue = multiprocessing.Queue()
+worker_list = []
+for window in range(nwin):
+    task_queue_list.append(multiprocessing.Queue())
+    rand = random.randint(10,1000000000)
+    properties = {'Threads': str(ppn_list[window])}
+    p = multiprocessing.Process(target=replica_worker, args=(window, psf_file, psf, system_xml, temps[window], 
+        properties, rand, pos_buf, vel_buf, task_queue_list[window], result_queue))
+    p.daemon = True
+    p.start()
+    worker_list.append(p)
+# velocities of the first cycle are generated at the temperature of the starting structure
+strtemp_list = [temps[exch_map[window]] for window in range(nwin)]
+if checkpoint != None:
+    # velocities of the checkpoint are rescaled to the new temperature
+    strtemp_list = [None for window in range(nwin)]
+    # the exchanges continue with the random numbers of the interrupted run
+    random.setstate((int(checkpoint['rng_version']), tuple([int(n) for n in checkpoint['rng_state']]), None))
+cycle = 0
+overhead_list = []
+md_total = [0 for window in range(nwin)] # MD time (s) of each window in production
+idle_total = [0 for window in range(nwin)] # time (s) each window waited for the others in production
+checkpoint_time = time.time()
 
 ###### equil phase ######
-for i in range(nexch_equil):
-    energy = []
-    process_time = []
-    process_pool = []
+for i in range(nexch_equil_start, nexch_equil):
     start_time = time.time()
-    return_dict = multiprocessing.Manager().dict()
     log_file_object = open(log_file,'a')
     log_file_object.write('EQUIL '+str(i+1)+': ')
-    for window in range(nwin):
+#    for window in range(nwin):
 #        if window == nwin-1:
 #            log_file_object.write(str(window_track[window]+1)+'| ')
 #        else:
 #            log_file_object.write(str(window_track[window]+1)+'||| ')
-        
-        strtemp = temps[exch_map[window]]
-        cor = CharmmCrdFile(cor_list[window])
-        outname = 'aa'+str(window+1)+'/1_'+str(i+1)+'_equil.cor'
-        rand = random.randint(10,1000000000)
-        p = multiprocessing.Process(target=run_REX_LD, args=(psf_file, psf, forcefield, templete_map, cor, temps[window], 
-            strtemp, outname, properties, nsteps_equil, '', rand, window, return_dict))
-        p.daemon = True
-        process_pool.append(p)
-    for window in range(nwin):
-        process_pool[window].start()
-    for window in range(nwin):
-        process_pool[window].join()
-    for window in range(nwin):
-        results = return_dict[window]
-        energy.append(results[0])
-        process_time.append(results[1])
+    (energy, process_time) = run_replica_cycle(cycle, nsteps_equil, exch_map, strtemp_list, 
+        ['' for window in range(nwin)], False)
+    strtemp_list = [None for window in range(nwin)]
+    cycle += 1
     end_time = time.time()
     cost_time = end_time-start_time
-    exch_map = Temperature_Swap(range(i%2, nwin), temps, energy)
-    log_file_object.write('%s %s %.2f %.2f %s\n'%(time.strftime('%H:%M:%S', time.localtime(start_time)), 
+    exch_map = exchange_windows(i, energy)
+    # wall time of the cycle not spent in MD of the slowest window
+    overhead = (time.time()-start_time-max(process_time))*1000
+    log_file_object.write('%s %s %.2f %.2f %s %.1f\n'%(time.strftime('%H:%M:%S', time.localtime(start_time)), 
         time.strftime('%H:%M:%S', time.localtime(end_time)), min(process_time), max(process_time), 
-        convert_time((nexch_equil-i-1)*cost_time)))
+        convert_time((nexch_equil-i-1)*cost_time), overhead))
     log_file_object.close()
 
-    # update cor_list and window_track
+    # update window_track
     new_window_track = [0 for window in range(nwin)]
     for window in range(nwin):
-        cor_list[window] = 'aa'+str(exch_map[window]+1)+'/1_'+str(i+1)+'_equil.cor'
         new_window_track[window] = window_track[exch_map[window]]
     window_track = new_window_track
 
+    if checkpoint_minutes > 0 and time.time() - checkpoint_time >= checkpoint_minutes*60:
+        save_rex_checkpoint('rex_checkpoint.npz', (cycle-1)%2, 'equil', i+1, energy)
+        checkpoint_time = time.time()
+if nexch_equil > nexch_equil_start:
+    save_window_cor((cycle-1)%2, nexch_equil, 'equil')
+    save_rex_checkpoint('rex_checkpoint.npz', (cycle-1)%2, 'equil', nexch_equil, energy)
+
 ###### prod phase ######
-for i in range(nwin):
-    window_track[i] = i
-for i in range(nsteps_start-1, nexch_prod):
-    energy = []
-    process_time = []
-    process_pool = []
-    start_time = time.time()
-    return_dict = multiprocessing.Manager().dict()
-    log_file_object = open(log_file,'a')
-    log_file_object.write('PROD '+str(i+1)+': ')
-    for window in range(nwin):
-        if window == nwin-1:
-            log_file_object.write(str(window_track[window]+1)+'| ')
-        else:
-            log_file_object.write(str(window_track[window]+1)+'||| ')
-        
-        strtemp = temps[exch_map[window]]
-        cor = CharmmCrdFile(cor_list[window])
-        outname = 'aa'+str(window+1)+'/1_'+str(i+1)+'_prod.cor'
-        rand = random.randint(10,1000000000)
-        p = multiprocessing.Process(target=run_REX_LD, args=(psf_file, psf, forcefield, templete_map, cor, temps[window], 
-            strtemp, outname, properties, nsteps_prod, 'aa'+str(window+1)+'/mc1.dcd', rand, window, return_dict))
-        p.daemon = True
-        process_pool.append(p)
-    for window in range(nwin):
-        process_pool[window].start()
-    for window in range(nwin):
-        process_pool[window].join()
+async_nseg = [nsteps_start-1 for window in range(nwin)] # finished segments of each window in asynchronous production
+async_frame_info = {} # PROD lines of asynchronous production not written yet
+if checkpoint != None and str(checkpoint['phase']) == 'prod':
+    if 'nseg' in checkpoint:
+        async_nseg = [int(n) for n in checkpoint['nseg']]
+        for (k, data) in zip(checkpoint['frame_index'], checkpoint['frame_data']):
+            async_frame_info[int(k)] = {'replica': [int(n) for n in data[0]], 'start': list(data[1]), 
+                'end': list(data[2]), 'md': list(data[3]), 'wait': list(data[4])}
+else:
+    for i in range(nwin):
+        window_track[i] = i
+if async_rex == 1 and nexch_prod > nsteps_start-1:
+    # structures of the last exchange before production
+    slot = cycle%2
     for window in range(nwin):
-        results = return_dict[window]
-        energy.append(results[0])
-        f = open('aa'+str(window+1)+'/'+ene_file, 'a')
-        f.write('%.6f\n'%(results[0]))
-        f.close()
-        process_time.append(results[1])
-    end_time = time.time()
-    cost_time = end_time-start_time
-    exch_map = Temperature_Swap(range(i%2, nwin), temps, energy)
-    log_file_object.write('%s %s %.2f %.2f %s\n'%(time.strftime('%H:%M:%S', time.localtime(start_time)), 
-        time.strftime('%H:%M:%S', time.localtime(end_time)), min(process_time), max(process_time), 
-        convert_time((nexch_prod-i-1)*cost_time)))
-    log_file_object.close()
+        src = exch_map[window]
+        pos_buf[slot, window] = pos_buf[(cycle-1)%2, src]
+        vel_buf[slot, window] = vel_buf[(cycle-1)%2, src]*(temps[window]/temps[src])**0.5
+    energy = run_async_prod(slot, strtemp_list)
+    # the latest structures are read from slot (cycle-1)%2 below
+    cycle += 1
+    exch_map = list(range(nwin))
+else:
+    for i in range(nsteps_start-1, nexch_prod):
+        start_time = time.time()
+        log_file_object = open(log_file,'a')
+        log_file_object.write('PROD '+str(i+1)+': ')
+        for window in range(nwin):
+            if window == nwin-1:
+                log_file_object.write(str(window_track[window]+1)+'| ')
+            else:
+                log_file_object.write(str(window_track[window]+1)+'||| ')
+        trajname_list = ['aa'+str(window+1)+'/mc1.dcd' for window in range(nwin)]
+        (energy, process_time) = run_replica_cycle(cycle, nsteps_prod, exch_map, strtemp_list, trajname_list, i > 0)
+        strtemp_list = [None for window in range(nwin)]
+        cycle += 1
+        for window in range(nwin):
+            md_total[window] += process_time[window]
+            idle_total[window] += max(process_time) - process_time[window]
+        for window in range(nwin):
+            f = open('aa'+str(window+1)+'/'+ene_file, 'a')
+            f.write('%.6f\n'%(energy[window]))
+            f.close()
+        end_time = time.time()
+        cost_time = end_time-start_time
+        exch_map = exchange_windows(i, energy, pair_stats)
+        # wall time of the cycle not spent in MD of the slowest window
+        overhead = (time.time()-start_time-max(process_time))*1000
+        overhead_list.append(overhead)
+        log_file_object.write('%s %s %.2f %.2f %s %.1f\n'%(time.strftime('%H:%M:%S', time.localtime(start_time)), 
+            time.strftime('%H:%M:%S', time.localtime(end_time)), min(process_time), max(process_time), 
+            convert_time((nexch_prod-i-1)*cost_time), overhead))
+        log_file_object.close()
 
-    # update cor_list and window_track
-    new_window_track = [0 for window in range(nwin)]
-    for window in range(nwin):
-        cor_list[window] = 'aa'+str(exch_map[window]+1)+'/1_'+str(i+1)+'_prod.cor'
-        new_window_track[window] = window_track[exch_map[window]]
-        if i > 0:
-            os.remove('aa'+str(window+1)+'/1_'+str(i)+'_prod.cor')
-    window_track = new_window_track
+        # update window_track
+        new_window_track = [0 for window in range(nwin)]
+        for window in range(nwin):
+            new_window_track[window] = window_track[exch_map[window]]
+        window_track = new_window_track
+        update_round_trips()
 
-    # print acceptence ratio
-    accp_file_object = open('logs/'+accp_file,'a')
-    accp_file_object.write('T-EXCHNG %d: '%(i+1))
-    if i%2 == 0:
-        if nwin%2 == 0:
+        # print acceptence ratio
+        accp_file_object = open('logs/'+accp_file,'a')
+        accp_file_object.write('T-EXCHNG %d: '%(i+1))
+        if exch_mode == 'gibbs':
+            count_neighbor_swaps()
             for window in range(nwin):
-                nexch[window] += 1
-        else:
-            for window in range(nwin-1):
-                nexch[window] += 1
-    else:
-        if (nwin-1)%2 == 0:
-            for window in range(1, nwin):
-                nexch[window] += 1
+                if window != exch_map[window]:
+                    accp_file_object.write('%.1f <- %.1f '%(temps[window].value_in_unit(kelvin), 
+                        temps[exch_map[window]].value_in_unit(kelvin)))
+        elif i%2 == 0:
+            if nwin%2 == 0:
+                for window in range(nwin):
+                    nexch[window] += 1
+            else:
+                for window in range(nwin-1):
+                    nexch[window] += 1
         else:
-            for window in range(1, nwin-1):
-                nexch[window] += 1
-    tag = -1
-    for window in range(nwin):     
-        if window != exch_map[window]:
-            accp[window] += 1
-            if window != tag:
-                accp_file_object.write('%.1f <=> %.1f '%(temps[window].value_in_unit(kelvin), 
-                    temps[exch_map[window]].value_in_unit(kelvin)))
-            tag = exch_map[window]
+            if (nwin-1)%2 == 0:
+                for window in range(1, nwin):
+                    nexch[window] += 1
+            else:
+                for window in range(1, nwin-1):
+                    nexch[window] += 1
+        tag = -1
+        for window in range(nwin):     
+            if exch_mode == 'neighbor' and window != exch_map[window]:
+                accp[window] += 1
+                if window != tag:
+                    accp_file_object.write('%.1f <=> %.1f '%(temps[window].value_in_unit(kelvin), 
+                        temps[exch_map[window]].value_in_unit(kelvin)))
+                tag = exch_map[window]
+        for window in range(nwin):
+        	if nexch[window] == 0:
+        		accp_file_object.write('%.2f '%(0.0))
+        	else:
+        		accp_file_object.write('%.2f '%(accp[window]/nexch[window]))
+        accp_file_object.write('\n')
+        accp_file_object.close()
+
+        if checkpoint_minutes > 0 and time.time() - checkpoint_time >= checkpoint_minutes*60:
+            save_rex_checkpoint('rex_checkpoint.npz', (cycle-1)%2, 'prod', i+1, energy)
+            write_pair_stats('logs/'+pair_file)
+            checkpoint_time = time.time()
+if nexch_prod > nsteps_start-1:
+    save_window_cor((cycle-1)%2, nexch_prod, 'prod')
+    save_rex_checkpoint('rex_checkpoint.npz', (cycle-1)%2, 'prod', nexch_prod, energy)
+    write_pair_stats('logs/'+pair_file)
+
+for window in range(nwin):
+    task_queue_list[window].put(None)
+for p in worker_list:
+    p.join()
+if len(overhead_list) > 0:
+    log_file_object = open(log_file,'a')
+    log_file_object.write('Mean exchange overhead: %.1f ms\n'%(sum(overhead_list)/len(overhead_list)))
+    # time windows spent waiting for the slowest window (synchronous) or for exchange partners (asynchronous)
+    log_file_object.write('Load imbalance of production:\n')
     for window in range(nwin):
-    	if nexch[window] == 0:
-    		accp_file_object.write('%.2f '%(0.0))
-    	else:
-    		accp_file_object.write('%.2f '%(accp[window]/nexch[window]))
-    accp_file_object.write('\n')
-    accp_file_object.close()
+        log_file_object.write('  T%d %.1f K: %d processors, MD time %.1f s, idle time %.1f s\n'%(window+1, 
+            temps[window].value_in_unit(kelvin), ppn_list[window], md_total[window], idle_total[window]))
+    if sum(md_total) + sum(idle_total) > 0:
+        log_file_object.write('Idle fraction of window time: %.2f %%\n'%(sum(idle_total)/(sum(md_total)+
+            sum(idle_total))*100))
+    log_file_object.close()
@@ -8,7 +8,7 @@ except:
     from simtk.openmm import *
     from simtk.unit import *
 from sys import stdout, exit, stderr
-import getopt, os, time, multiprocessing, random, math, traceback
+import getopt, os, time, multiprocessing, random, math, traceback, queue, hashlib, shutil
 import parmed as pmd
 import mdtraj as mdt
 
@@ -29,13 +29,14 @@ usage = '\nUsage: python temperature_quenching.py\n' \
         '  Q_threshold = 0.75\n'\
         '  secondary_structure_def = setup/secondary_struc_defs.txt\n'\
         '  log_file = info.log\n'\
-        '  restart = 0\n'
+        '  restart = 0\n'\
+        '  ff_cache_dir = ~/.cache/cg_simtk_ff\n'
 
 ###### run Langevin Dynamics ######
 def run_TQ_LD(index, rand):
     global nsteps_equil, nsteps_prod, temp_equil, temp_prod, tag_restart_equil, tag_restart_prod
-    global psf, forcefield, template_map, start_cor, use_gpu, current_step, ppn
-    global nsteps_save, timestep, Q_threshold, fold_nframe, folding_array
+    global psf, system_xml, start_cor, use_gpu, current_step, ppn
+    global nsteps_save, timestep, Q_threshold, fold_nframe, folding_array, Q_array
     
     if use_gpu == 0:
         properties = {'Threads': str(ppn)}
@@ -47,25 +48,10 @@ def run_TQ_LD(index, rand):
         platform = Platform.getPlatformByName('CUDA')
     
     fbsolu = 0.05/picosecond
-    nonbond_cutoff = 2.0*nanometer
-    switch_cutoff = 1.8*nanometer
     constraint_tolerance = 0.00001
     top = psf.topology
-    try:
-        system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
-            nonbondedCutoff=nonbond_cutoff, constraints=AllBonds, removeCMMotion=False, 
-            ignoreExternalBonds=True, residueTemplates=template_map)
-    except Exception as e:
-        traceback.print_exc()
-    # must set to use switching function explicitly for CG Custom Nonbond Force #
-    for force in system.getForces():
-        if force.getName() == 'CustomNonbondedForce':
-            custom_nb_force = force
-            break
-    # custom_nb_force = system.getForce(4)
-    custom_nb_force.setUseSwitchingFunction(True)
-    custom_nb_force.setSwitchingDistance(switch_cutoff)
-    # End set to use switching function explicitly for CG Custom Nonbond Force #
+    progress_queue.put((index, 'start', current_step[index-1], None, 0, 0, time.time()))
+    system = XmlSerializer.deserialize(system_xml)
     
     if tag_restart_prod[index-1] == 1:
         integrator = LangevinIntegrator(temp_prod, fbsolu, timestep)
@@ -156,6 +142,7 @@ def run_TQ_LD(index, rand):
             potentialEnergy=True, temperature=True, progress=True, remainingTime=True,
             speed=True, totalSteps=nsteps_equil-current_step[index-1], separator='\t'))
         simulation.reporters.append(pmd.openmm.reporters.RestartReporter('traj/'+str(index)+'.ncrst', nsteps_save, netcdf=True))
+        simulation.reporters.append(ProgressReporter(index, nsteps_save, current_step[index-1]))
         if tag_restart_equil[index-1] == 1:
             simulation.reporters.append(DCDReporter('traj/'+str(index)+'_equil.dcd', nsteps_save, append=True))
         else:
@@ -184,11 +171,24 @@ def run_TQ_LD(index, rand):
         simulation.reporters.append(DCDReporter('traj/'+str(index)+'_prod.dcd', nsteps_save, append=False))
     
     folding_tag = folding_array[index-1]
+    # Q of the last fold_nframe frames
+    if tag_restart_prod[index-1] == 1:
+        q_array = list(Q_array[index-1])
+    else:
+        q_array = []
+    prod_start_time = time.time()
     nframe = 0
     if tag_restart_prod[index-1] == 0:
         step_id = nsteps_save * nframe
     else:
         step_id = current_step[index-1] + nsteps_save * nframe
+    if folding_tag != 0 or step_id >= nsteps_prod:
+        # restarted trajectory that has already finished; report its restored state
+        if len(q_array) > 0:
+            Q = q_array[-1]
+        else:
+            Q = 0
+        progress_queue.put((index, 'prod', step_id, Q, folding_tag, 0, time.time()))
     while folding_tag == 0 and step_id < nsteps_prod:
         simulation.step(nsteps_save)
         nframe += 1
@@ -203,11 +203,33 @@ def run_TQ_LD(index, rand):
         f = open('output/'+str(index)+'_prod.out', 'a')
         f.write('%10.3f %20d %10.3f\n'%(time_id, step_id, Q))
         f.close()
-        results = updat_Q(index)
-        folding_tag = results[0]
+        q_array = (q_array + [Q])[-fold_nframe:]
+        if len(q_array) == fold_nframe and min(q_array) >= Q_threshold:
+            folding_tag = 1
+        report_time = time.time()
+        speed = nsteps_save * nframe / (report_time - prod_start_time)
+        progress_queue.put((index, 'prod', step_id, Q, folding_tag, speed, report_time))
 
 ###### END run Langevin Dynamics ######
 
+###### reporter publishing equilibrium progress to the main process ######
+class ProgressReporter(object):
+    def __init__(self, index, reportInterval, start_step):
+        self._index = index
+        self._reportInterval = reportInterval
+        self._start_step = start_step
+        self._start_time = time.time()
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep%self._reportInterval
+        return (steps, False, False, False, False, False)
+
+    def report(self, simulation, state):
+        report_time = time.time()
+        speed = simulation.currentStep / (report_time - self._start_time) * timestep.value_in_unit(nanosecond) * 3600 * 24
+        progress_queue.put((self._index, 'equil', self._start_step+simulation.currentStep, None, 0, speed, report_time))
+###### END reporter publishing equilibrium progress ######
+
 ###### convert time seconds to hours ######
 def convert_time(seconds):
     m, s = divmod(seconds, 60)
@@ -248,7 +270,9 @@ def calc_Q(current_cor):
 def updat_Q(index):
     global Q_threshold, fold_nframe
     q_array = []
-    last_line_list = os.popen('tail -n '+str(fold_nframe)+' output/'+str(index)+'_prod.out').readlines()
+    f = open('output/'+str(index)+'_prod.out')
+    last_line_list = f.readlines()[-fold_nframe:]
+    f.close()
     if len(last_line_list) == fold_nframe:
         tag = 1
     else:
@@ -262,6 +286,59 @@ def updat_Q(index):
     return [tag, q_array]
 ###### END update Q_array and folding_array ######
 
+###### Load compiled CG system ######
+# The serialized System is cached in cache_dir under the hash of the top/prm/psf files, the parser script and the 
+# OpenMM version, so that repeated runs skip the prm -> xml -> ForceField -> System pipeline
+def load_cg_system(psf_file, top_file, prm_file, top, template_map, cache_dir):
+    nonbond_cutoff = 2.0*nanometer
+    switch_cutoff = 1.8*nanometer
+    cache_file = ''
+    if cache_dir != '':
+        h = hashlib.sha1()
+        input_file_list = [top_file, prm_file, psf_file]
+        parser = shutil.which('parse_cg_prm.py')
+        if parser != None:
+            input_file_list.append(parser)
+        for fn in input_file_list:
+            f = open(fn, 'rb')
+            h.update(f.read())
+            f.close()
+        h.update(Platform.getOpenMMVersion().encode())
+        cache_file = cache_dir+'/tq_'+h.hexdigest()+'.xml'
+        if os.path.exists(cache_file):
+            f = open(cache_file, 'r')
+            system_xml = f.read()
+            f.close()
+            return (system_xml, cache_file)
+
+    os.system('parse_cg_prm.py -t '+top_file+' -p '+prm_file)
+    forcefield = ForceField(prm_file.split('.prm')[0]+'.xml')
+    system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
+        nonbondedCutoff=nonbond_cutoff, constraints=AllBonds, removeCMMotion=False, 
+        ignoreExternalBonds=True, residueTemplates=template_map)
+    # must set to use switching function explicitly for CG Custom Nonbond Force #
+    for force in system.getForces():
+        if force.getName() == 'CustomNonbondedForce':
+            custom_nb_force = force
+            break
+    custom_nb_force.setUseSwitchingFunction(True)
+    custom_nb_force.setSwitchingDistance(switch_cutoff)
+    # End set to use switching function explicitly for CG Custom Nonbond Force #
+    system_xml = XmlSerializer.serialize(system)
+
+    if cache_file != '':
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_file+'.%d.tmp'%os.getpid()
+            f = open(tmp_file, 'w')
+            f.write(system_xml)
+            f.close()
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print('Warning: cannot save compiled system to %s (%s).'%(cache_file, str(e)))
+    return (system_xml, '')
+###### END Load compiled CG system ######
+
 ctrlfile = ''
 
 if len(sys.argv) == 1:
@@ -302,6 +379,8 @@ fold_time = 750*picoseconds # time to determine folding status
 dist_cutoff = 8 # distance cutoff for finding native contact
 sdist = 1.2 # multiple factor of native distance to determine native contact in trajectory
 sleep_time = 5 # how ofen (seconds) the main process check and write the log file
+progress_queue = None # queue of progress events sent from workers to the main process
+ff_cache_dir = '~/.cache/cg_simtk_ff' # directory of compiled systems; '': always compile the force field
 
 if not os.path.exists(ctrlfile):
     print('Error: cannot find control file ' + ctrlfile + '.')
@@ -385,6 +464,10 @@ try:
             words = line.split('=')
             secondary_structure_def = words[1].strip()
             continue
+        if line.startswith('ff_cache_dir'):
+            words = line.split('=')
+            ff_cache_dir = words[1].strip()
+            continue
 finally:
      file_object.close()
 
@@ -433,7 +516,9 @@ folding_array = [0 for i in range(num_traj)]
 if restart == 1:
     for i in range(1, num_traj + 1):
         if os.path.exists('output/'+str(i)+'_prod.out'):
-            last_line = os.popen('tail -n 1 output/'+str(i)+'_prod.out').read().strip()
+            f = open('output/'+str(i)+'_prod.out')
+            last_line = f.readlines()[-1].strip()
+            f.close()
             words = last_line.split()
             current_step[i-1] = int(words[1])
             tag_restart_prod[i-1] = 1
@@ -441,7 +526,9 @@ if restart == 1:
             folding_array[i-1] = results[0]
             Q_array[i-1] = results[1]
         elif os.path.exists('output/'+str(i)+'_equil.out'):
-            last_line = os.popen('tail -n 1 output/'+str(i)+'_equil.out').read().strip()
+            f = open('output/'+str(i)+'_equil.out')
+            last_line = f.readlines()[-1].strip()
+            f.close()
             words = last_line.split()
             current_step[i-1] = int(words[1])
             tag_restart_equil[i-1] = 1
@@ -450,10 +537,6 @@ if restart == 1:
 ###### END Check Control Parameters ######
 
 ###### Setup writing log files ######
-os.system('parse_cg_prm.py -t '+top+' -p '+param)
-xml_param = param.split('.prm')
-xml_param = xml_param[0]+'.xml'
-
 log_file_object = open(log_file,'w')
 log_head = ''
 log_head += 'Temperature Quenching for CG Model using OpenMM\nAuthor: Yang Jiang; Ed O\'Brien.\n'
@@ -501,7 +584,7 @@ elif restart == 0:
 ###### Temperature Quenching ######
 nprocess = int(tpn/ppn)
 psf = CharmmPsfFile(psffile)
-forcefield = ForceField(xml_param)
+top_file = top
 top = psf.topology
 start_cor = CharmmCrdFile(starting_strucs)
 psf_pmd = pmd.charmm.CharmmPsfFile(psffile)
@@ -513,6 +596,11 @@ template_map = {}
 for chain in top.chains():
     for res in chain.residues():
         template_map[res] = res.name
+if ff_cache_dir != '':
+    ff_cache_dir = os.path.expanduser(ff_cache_dir)
+(system_xml, ff_cache_file) = load_cg_system(psffile, top_file, param, top, template_map, ff_cache_dir)
+if ff_cache_file != '':
+    log_head += 'Compiled system loaded from cache: '+ff_cache_file+'\n'
 
 # assign GPU device index
 dev_index_list = []
@@ -588,55 +676,48 @@ for i in range(1, num_traj + 1):
 log_file_object.write(log_output)
 log_file_object.close()
 
+# workers publish their progress events (index, stage, step, Q, if_folded, speed, time) through this queue
+progress_queue = multiprocessing.Queue()
 pool = multiprocessing.Pool(nprocess)
 for i in range(1, num_traj + 1):
     rand = random.randint(10,1000000000)
     pool.apply_async(run_TQ_LD, (i, rand))
 
-start_time = [time.time() for i in range(num_traj)]
-end_time = [time.time() for i in range(num_traj)]
+start_time = [None for i in range(num_traj)]
+end_time = [None for i in range(num_traj)]
+last_event = [None for i in range(num_traj)]
 while True:
     time.sleep(sleep_time)
+    while True:
+        try:
+            event = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        i = event[0]
+        if start_time[i-1] == None:
+            start_time[i-1] = event[6]
+        end_time[i-1] = event[6]
+        last_event[i-1] = event
     log_file_object = open(log_file,'w')
     log_output = log_head
     for i in range(1, num_traj + 1):
-        if os.path.exists('output/'+str(i)+'_equil.out'):
-            if not os.path.exists('output/'+str(i)+'_prod.out') and tag_restart_prod[i-1] == 0:
-                last_line = os.popen('tail -n 1 output/'+str(i)+'_equil.out').read().strip()
-                words = last_line.split()
-                if len(words) != 6:
-                    log_output += '%10s %20s %20s %10s %10s %10s %10s\n'%(str(i), start_str[i-1], 'wait', '--', '--', '--', '--')
-                    start_time[i-1] = time.time()
-                else:
-                    speed = str(float(words[4]))
-                    end_time[i-1] = time.time()
-                    log_output += '%10s %20s %20s %10s %10s %10s %10s\n'%(str(i), start_str[i-1], 'equil@'+str(current_step[i-1]+int(words[1])), 
-                        '--', '--', convert_time(end_time[i-1] - start_time[i-1]), speed)
-            elif os.path.exists('output/'+str(i)+'_prod.out'):
-                last_line = os.popen('tail -n 1 output/'+str(i)+'_prod.out').read().strip()
-                words = last_line.split()
-                if words[1] == current_step[i-1]:
-                    log_output += '%10s %20s %20s %10s %10s %10s %10s\n'%(str(i), start_str[i-1], 'wait', '--', '--', '--', '--')
-                    start_time[i-1] = time.time()
-                else:
-                    results = updat_Q(i)
-                    folding_array[i-1] = results[0]
-                    Q_array[i-1] = results[1]
-                    if results[0] == 1:
-                        speed = (float(words[1]) - current_step[i-1]) / (end_time[i-1] - start_time[i-1])
-                        log_output += '%10s %20s %20s %10.3f %10s %10s %10.1f\n'%(str(i), start_str[i-1], 'Done@'+words[1], 
-                            Q_array[i-1][-1], str(folding_array[i-1]), convert_time(end_time[i-1] - start_time[i-1]), speed)
-                    else:
-                        end_time[i-1] = time.time()
-                        speed = (float(words[1]) - current_step[i-1]) / (end_time[i-1] - start_time[i-1])
-                        log_output += '%10s %20s %20s %10.3f %10s %10s %10.1f\n'%(str(i), start_str[i-1], 'prod@'+words[1], 
-                            Q_array[i-1][-1], str(folding_array[i-1]), convert_time(end_time[i-1] - start_time[i-1]), speed)
-            else:
-                log_output += '%10s %20s %20s %10s %10s %10s %10s\n'%(str(i), start_str[i-1], 'wait', '--', '--', '--', '--')
-                start_time[i-1] = time.time()
-        else:
+        if last_event[i-1] == None or last_event[i-1][1] == 'start':
             log_output += '%10s %20s %20s %10s %10s %10s %10s\n'%(str(i), start_str[i-1], 'wait', '--', '--', '--', '--')
-            start_time[i-1] = time.time()
+            continue
+        (stage, step, Q, folding_tag, speed) = last_event[i-1][1:6]
+        if stage == 'equil':
+            log_output += '%10s %20s %20s %10s %10s %10s %10.1f\n'%(str(i), start_str[i-1], 'equil@'+str(step), 
+                '--', '--', convert_time(time.time() - start_time[i-1]), speed)
+        else:
+            folding_array[i-1] = folding_tag
+            if folding_tag == 1:
+                status = 'Done@'+str(step)
+                used_time = end_time[i-1] - start_time[i-1]
+            else:
+                status = 'prod@'+str(step)
+                used_time = time.time() - start_time[i-1]
+            log_output += '%10s %20s %20s %10.3f %10s %10s %10.1f\n'%(str(i), start_str[i-1], status, 
+                Q, str(folding_array[i-1]), convert_time(used_time), speed)
     log_file_object.write(log_output)
     log_file_object.close()
     
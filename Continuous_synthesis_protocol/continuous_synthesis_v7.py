@@ -9,11 +9,17 @@ except:
     from simtk.openmm import *
     from simtk.unit import *
 
+import sys
 from sys import stdout, exit, stderr
-import getopt, os, time, multiprocessing, random, math, traceback, io
+import getopt, os, time, multiprocessing, random, math, traceback, io, queue, struct, hashlib, shutil, pickle, json, zlib
+import sqlite3, socket, threading
 import parmed as pmd
 import numpy as np
 
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from rnc_traj_container import scan_traj_container
+from ribosome_traffic_tasep import simulate_ribosome_traffic
+
 usage = '\nUsage: python continuous_synthesis.py\n' \
         '       --ctrlfile | -f <CSP.ctrl> Control file for continuous synthesis\n'\
         '       [--help | -h] Print this information\n\n'\
@@ -41,23 +47,64 @@ usage = '\nUsage: python continuous_synthesis.py\n' \
         '  time_stage_2 = 0.00838\n'\
         '  ribosome_traffic = 1\n'\
         '  initiation_rate = 0.09\n'\
+        '  traffic_num_ribosomes = 4000\n'\
+        '  traffic_num_replicas = 16\n'\
+        '  traffic_footprint = 10\n'\
+        '  traffic_termination_rate = 35.0\n'\
+        '  traffic_seed = 100\n'\
         '  scale_factor = 4331293\n'\
         '  x_eject = 60\n'\
         '  log_file = info.log\n'\
-        '  restart = 0\n'
-
-def run_elongation(index, start_nascent_chain_length, total_nascent_chain_length, previous_rnc_cor_file):
-    global prot_psf_pmd, ribo_psf_pmd, ribo_resid_list, codon_list, use_gpu, dev_index_list
-    global ppn, temp_prod, timestep, fbsolu, forcefield, constraint_tolerance, nsteps_save, scale_factor
-    global nonbond_cutoff, switch_cutoff
-    global time_stage_1, time_stage_2, real_mean_fpt_list, intrinsic_mean_fpt_list, ribosome_traffic
+        '  restart = 0\n'\
+        '  persistent_context = 0\n'\
+        '  save_stage_structures = 1\n'\
+        '  checkpoint_codons = 0\n'\
+        '  checkpoint_minutes = 0\n'\
+        '  stage_checkpoint_minutes = 0\n'\
+        '  ribosome_grid = setup/ribo_grid.npz\n'\
+        '  codon_scheduler = 0\n'\
+        '  max_live_traj = 0\n'\
+        '  ff_cache_dir = ~/.cache/cg_simtk_ff\n'\
+        '  fork_length = 0\n'\
+        '  fork_seeds = 1\n'\
+        '  traj_atoms = all\n'\
+        '  traj_container = 0\n'\
+        '  traj_container_atoms = nc\n'\
+        '  traj_container_chunk = 100\n'\
+        '  mts_steps = 1\n'\
+        '  active_shell = 0\n'\
+        '  active_shell_margin = 10\n'\
+        '  work_queue = \n'\
+        '  work_queue_lease = 10\n'\
+        '\n'\
+        ' Distributed mode: set work_queue to a file on a filesystem shared by all nodes and start this script with\n'\
+        ' the same control file in the same directory on every node. The first instance sets up the trajectories;\n'\
+        ' all instances pull codons from the queue until every trajectory is finished. Remove the queue file to\n'\
+        ' start a new campaign. Each instance renews its leases every sixth of work_queue_lease and stops its\n'\
+        ' codons if they have not been renewed for two thirds of it, so work_queue_lease must be much longer than\n'\
+        ' one MD block (nsteps_save steps). test_work_queue.py runs several instances against a toy queue.\n'
 
+# end_nascent_chain_length: last codon to elongate in this call
+def run_elongation(index, start_nascent_chain_length, total_nascent_chain_length, previous_rnc_cor, 
+    end_nascent_chain_length):
     traj_dir = 'traj/'+str(index)
-    out_file = '../../output/'+str(index)+'.out'
     if not os.path.exists(traj_dir):
         os.mkdir(traj_dir)
     os.chdir(traj_dir)
-    
+    (platform, properties) = setup_platform()
+
+    rnc_sys = None
+    checkpoint = [start_nascent_chain_length - 1, time.time()]
+    for nascent_chain_length in range(start_nascent_chain_length, end_nascent_chain_length+1):
+        (previous_rnc_cor, rnc_sys, checkpoint) = elongate_codon(index, nascent_chain_length, total_nascent_chain_length, 
+            previous_rnc_cor, rnc_sys, checkpoint, platform, properties)
+        if previous_rnc_cor is False:
+            break
+    os.chdir('../../')
+
+# OpenMM platform of the current worker process
+def setup_platform():
+    global use_gpu, ppn
     if use_gpu == 0:
         properties = {'Threads': str(ppn)}
         platform = Platform.getPlatformByName('CPU')
@@ -67,8 +114,31 @@ def run_elongation(index, start_nascent_chain_length, total_nascent_chain_length
         properties = {'CudaPrecision': 'mixed'}
         properties["DeviceIndex"] = "%d"%(dev_index);
         platform = Platform.getPlatformByName('CUDA')
+    return (platform, properties)
+
+# Elongate the nascent chain of one trajectory by one codon in the current trajectory directory
+# rnc_sys: persistent RNC system of this trajectory (None if not created yet)
+# checkpoint: [nascent chain length, time] of the last RNC checkpoint
+# return (previous_rnc_cor, rnc_sys, checkpoint); previous_rnc_cor is False if the elongation failed
+def elongate_codon(index, nascent_chain_length, total_nascent_chain_length, previous_rnc_cor, rnc_sys, checkpoint, 
+    platform, properties):
+    global prot_psf_pmd, ribo_psf_pmd, ribo_resid_list, codon_list
+    global ppn, temp_prod, timestep, fbsolu, forcefield, constraint_tolerance, nsteps_save, scale_factor
+    global nonbond_cutoff, switch_cutoff
+    global time_stage_1, time_stage_2, real_mean_fpt_list, intrinsic_mean_fpt_list, ribosome_traffic
+    global persistent_context, checkpoint_codons, checkpoint_minutes, progress_traj_index, stage_checkpoint_info
+    global traj_container, fork_length, queue_lease_lost
 
-    for nascent_chain_length in range(start_nascent_chain_length, total_nascent_chain_length+1):
+    out_file = '../../output/'+str(index)+'.out'
+    progress_traj_index = index
+    # an unfinished codon restarted from the stage checkpoint keeps its sampled steps and random seed
+    resume = None
+    if type(previous_rnc_cor) == str and previous_rnc_cor == 'rnc_stage_checkpoint.npz':
+        resume = load_stage_checkpoint(previous_rnc_cor)
+    if resume == None:
+        if traj_container == 1:
+            # frames left by an earlier run of this codon
+            trim_traj_container('rnc_traj.rtc', nascent_chain_length)
         rand = random.randint(10,1000000000)
         # Read the codon insertion time of the next codon
         sampled_time_stage_1 = sample_fpt_dist(time_stage_1)
@@ -90,6 +160,7 @@ def run_elongation(index, start_nascent_chain_length, total_nascent_chain_length
         fo = open(out_file, 'a')
         fo.write('#'*92 + '\n')
         fo.write('--> Elongation at length %d with random seed %d\n'%(nascent_chain_length, rand))
+        report_progress(nascent_chain_length, 'minimizing')
         #if uniform_ta == 1:
         #    fo.write('    Mean in vivo AA insertion time: %f s\n'%(intrinsic_mean_fpt_list[nascent_chain_length]))
         #else:
@@ -124,77 +195,756 @@ def run_elongation(index, start_nascent_chain_length, total_nascent_chain_length
         #fo.write('    Total sampled in silico AA insertion time: %f ns\n'%(simulation_time_stage_1+simulation_time_stage_2
         #    +simulation_time_stage_3))
         fo.close()
+    else:
+        rand = resume['rand']
+        [step_stage_1, step_stage_2, step_stage_3] = resume['simulation_steps']
+        fo = open(out_file, 'a')
+        fo.write('--> Resume elongation at length %d from stage %d step %d\n'%(nascent_chain_length, resume['stage'], 
+            resume['step']))
+        fo.close()
+        report_progress(nascent_chain_length, 'minimizing')
+    stage_checkpoint_info = {'simulation_steps': [step_stage_1, step_stage_2, step_stage_3], 'rand': rand}
+
+    try:
+        if persistent_context == 1:
+            if rnc_sys == None:
+                rnc_sys = create_persistent_rnc(prot_psf_pmd, ribo_psf_pmd, total_nascent_chain_length, out_file, 
+                    platform, properties, rand)
+            if rnc_sys == False:
+                previous_rnc_cor = False
+            else:
+                previous_rnc_cor = elongation_persistent(rnc_sys, nascent_chain_length, prot_psf_pmd, ribo_psf_pmd, 
+                    previous_rnc_cor, [step_stage_1, step_stage_2, step_stage_3], out_file, properties, resume)
+        else:
+            previous_rnc_cor = elongation(nascent_chain_length, prot_psf_pmd, ribo_psf_pmd, previous_rnc_cor, 
+                [step_stage_1, step_stage_2, step_stage_3], rand, out_file, properties, platform, resume)
+    except Exception as e:
+        if queue_lease_lost:
+            # stopped at the lease deadline; the codon is run again from the queue
+            return (None, None, checkpoint)
+        traceback.print_exc()
+        previous_rnc_cor = False
+        
+    if previous_rnc_cor is False:
+        report_progress(nascent_chain_length, 'failed')
+        return (previous_rnc_cor, rnc_sys, checkpoint)
+    if nascent_chain_length < len(prot_psf_pmd.residues):
+        fo = open(out_file, 'a')
+        fo.write('--> Elongation finished at length %d\n'%nascent_chain_length)
+        fo.close()
+        if nascent_chain_length < total_nascent_chain_length:
+            report_progress(nascent_chain_length+1, 'wait')
+        else:
+            report_progress(nascent_chain_length, 'Done')
+        # save sparse checkpoint of the RNC structure
+        if ((checkpoint_codons > 0 and nascent_chain_length - checkpoint[0] >= checkpoint_codons) or 
+            (checkpoint_minutes > 0 and time.time() - checkpoint[1] >= checkpoint_minutes*60)):
+            save_rnc_checkpoint('rnc_checkpoint.npz', nascent_chain_length, previous_rnc_cor)
+            checkpoint = [nascent_chain_length, time.time()]
+        # the other trajectories branch from this structure
+        if nascent_chain_length == fork_length:
+            save_rnc_checkpoint('rnc_fork.npz', nascent_chain_length, previous_rnc_cor)
+    else:
+        fo = open(out_file, 'a')
+        fo.write('#'*92 + '\n')
+        fo.write('--> All Done\n')
+        fo.close()
+        report_progress(nascent_chain_length, 'Done')
+    return (previous_rnc_cor, rnc_sys, checkpoint)
+# END Elongate the nascent chain of one trajectory by one codon
+
+# Publish the progress of the trajectory running in this worker to the main process
+# status: 'minimizing', 'step(progress)', 'wait', 'Done' or 'failed'; speed in ns/day
+def report_progress(nascent_chain_length, status, speed='--'):
+    global progress_queue, progress_traj_index
+    if progress_queue != None:
+        progress_queue.put((progress_traj_index, nascent_chain_length, status, speed, time.time()))
+# END Publish the progress of the trajectory
+
+# Collect all progress events published since the last call
+# progress_list[i]: {'length', 'status', 'speed', 'start_time', 'end_time'} of trajectory start_traj_id+i
+def update_progress(progress_list):
+    global progress_queue, start_traj_id
+    while True:
+        try:
+            (index, nascent_chain_length, status, speed, event_time) = progress_queue.get_nowait()
+        except queue.Empty:
+            break
+        progress = progress_list[index-start_traj_id]
+        if progress['start_time'] == None:
+            progress['start_time'] = event_time
+        progress['length'] = str(nascent_chain_length)
+        progress['status'] = status
+        progress['speed'] = speed
+        progress['end_time'] = event_time
+# END Collect all progress events
+
+# Write the status of all trajectories to the log file
+def write_progress_log(progress_list):
+    global log_file, log_head, num_traj, start_traj_id, start_str
+    update_progress(progress_list)
+    log_output = log_head
+    for i in range(1, num_traj + 1):
+        progress = progress_list[i-1]
+        if progress['start_time'] == None:
+            time_used = '--'
+        elif progress['status'] in ['wait', 'Done', 'failed']:
+            time_used = convert_time(progress['end_time'] - progress['start_time'])
+        else:
+            time_used = convert_time(time.time() - progress['start_time'])
+        log_output += '%10s %10s %20s %15s %10s %15s\n'%(str(start_traj_id+i-1), start_str[i-1], progress['status'], 
+                                                         progress['length'], time_used, progress['speed'])
+    # instances sharing the work queue write the same log file
+    tmp_file = log_file+'.%d.tmp'%os.getpid()
+    log_file_object = open(tmp_file,'w')
+    log_file_object.write(log_output)
+    log_file_object.close()
+    os.replace(tmp_file, log_file)
+# END Write the status of all trajectories to the log file
 
+# Worker process of the codon scheduler
+# Tasks in task_queue: ('codon', index, nascent_chain_length, total_nascent_chain_length, previous_rnc_cor, checkpoint),
+# ('drop', index) to release the persistent system of a trajectory moved to another worker, or None to quit.
+# lease_deadline: deadline of the leases of this instance in distributed mode (None otherwise). A codon that cannot 
+# finish before the deadline is stopped and returned with previous_rnc_cor = None.
+def codon_worker(worker_id, task_queue, result_queue, lease_deadline=None):
+    global queue_lease_deadline, queue_lease_lost
+    queue_lease_deadline = lease_deadline
+    (platform, properties) = setup_platform()
+    rnc_sys_dict = {}
+    while True:
+        task = task_queue.get()
+        if task == None:
+            break
+        if task[0] == 'drop':
+            rnc_sys_dict.pop(task[1], None)
+            continue
+        (index, nascent_chain_length, total_nascent_chain_length, previous_rnc_cor, checkpoint) = task[1:]
+        queue_lease_lost = False
+        if not check_queue_lease():
+            # do not touch the files of a codon that may already be taken over by another instance
+            rnc_sys_dict.pop(index, None)
+            result_queue.put((worker_id, index, nascent_chain_length, None, checkpoint))
+            continue
+        traj_dir = 'traj/'+str(index)
+        if not os.path.exists(traj_dir):
+            os.mkdir(traj_dir)
+        os.chdir(traj_dir)
         try:
-            previous_rnc_cor_file = elongation(nascent_chain_length, prot_psf_pmd, ribo_psf_pmd, previous_rnc_cor_file, 
-                [step_stage_1, step_stage_2, step_stage_3], rand, out_file, properties, platform)
+            (previous_rnc_cor, rnc_sys, checkpoint) = elongate_codon(index, nascent_chain_length, 
+                total_nascent_chain_length, previous_rnc_cor, rnc_sys_dict.get(index, None), checkpoint, 
+                platform, properties)
         except Exception as e:
             traceback.print_exc()
-            previous_rnc_cor_file = False
-            
-        if previous_rnc_cor_file == False:
+            (previous_rnc_cor, rnc_sys) = (False, None)
+        os.chdir('../../')
+        if queue_lease_lost:
+            (previous_rnc_cor, rnc_sys) = (None, None)
+        if previous_rnc_cor is None or previous_rnc_cor is False or nascent_chain_length == total_nascent_chain_length:
+            rnc_sys_dict.pop(index, None)
+        elif rnc_sys != None:
+            rnc_sys_dict[index] = rnc_sys
+        result_queue.put((worker_id, index, nascent_chain_length, previous_rnc_cor, checkpoint))
+# END Worker process of the codon scheduler
+
+# Check that the codon running in the current worker is still safely assigned to this instance of the work queue
+# return False (and flag the codon as stopped) after the lease deadline
+def check_queue_lease():
+    global queue_lease_deadline, queue_lease_lost
+    if queue_lease_deadline != None and time.time() >= queue_lease_deadline.value:
+        queue_lease_lost = True
+    return not queue_lease_lost
+# END Check the lease of the running codon
+
+# Run all trajectories codon by codon on nprocess workers
+# Idle workers take the next codon of the ready trajectory with the most predicted remaining steps. At most 
+# max_live_traj trajectories are started and not finished at the same time. With persistent_context = 1, a worker 
+# prefers trajectories whose persistent system it already holds.
+# end_nascent_chain_length: last codon to elongate in this call
+def run_codon_scheduler(nprocess, start_res, previous_rnc_cor_list, progress_list, end_nascent_chain_length):
+    global num_traj, start_traj_id, total_nascent_chain_length, max_live_traj, persistent_context, sleep_time
+    global remaining_steps_list
+
+    task_queue_list = [multiprocessing.Queue() for i in range(nprocess)]
+    result_queue = multiprocessing.Queue()
+    worker_list = []
+    for i in range(nprocess):
+        # process name ends with 1-based worker index, which is used to select the GPU device
+        worker = multiprocessing.Process(target=codon_worker, args=(i, task_queue_list[i], result_queue), 
+            name='CodonWorker-%d'%(i+1))
+        worker.start()
+        worker_list.append(worker)
+
+    waiting_list = []
+    for i in range(num_traj):
+        if start_res[i] <= end_nascent_chain_length:
+            waiting_list.append({'index': start_traj_id+i, 'length': start_res[i], 
+                'previous_rnc_cor': previous_rnc_cor_list[i], 'checkpoint': [start_res[i]-1, time.time()], 
+                'worker': None})
+    waiting_list.sort(key=lambda traj: remaining_steps_list[traj['length']], reverse=True)
+    ready_list = []
+    running_dict = {}
+    idle_list = list(range(nprocess))
+    log_time = 0
+    while len(waiting_list) > 0 or len(ready_list) > 0 or len(running_dict) > 0:
+        # start new trajectories
+        while len(waiting_list) > 0 and len(ready_list) + len(running_dict) < max_live_traj:
+            ready_list.append(waiting_list.pop(0))
+        # assign codons to idle workers
+        while len(idle_list) > 0 and len(ready_list) > 0:
+            worker_id = idle_list.pop(0)
+            candidate_list = ready_list
+            if persistent_context == 1:
+                own_list = [traj for traj in ready_list if traj['worker'] == worker_id]
+                if len(own_list) > 0:
+                    candidate_list = own_list
+            traj = max(candidate_list, key=lambda traj: remaining_steps_list[traj['length']])
+            ready_list.remove(traj)
+            if traj['worker'] != None and traj['worker'] != worker_id:
+                task_queue_list[traj['worker']].put(('drop', traj['index']))
+            traj['worker'] = worker_id
+            task_queue_list[worker_id].put(('codon', traj['index'], traj['length'], total_nascent_chain_length, 
+                traj['previous_rnc_cor'], traj['checkpoint']))
+            running_dict[worker_id] = traj
+        # collect finished codons
+        try:
+            result = result_queue.get(timeout=sleep_time)
+        except queue.Empty:
+            result = None
+        while result != None:
+            (worker_id, index, nascent_chain_length, previous_rnc_cor, checkpoint) = result
+            traj = running_dict.pop(worker_id)
+            idle_list.append(worker_id)
+            if previous_rnc_cor is not False and nascent_chain_length < end_nascent_chain_length:
+                traj['length'] = nascent_chain_length + 1
+                traj['previous_rnc_cor'] = previous_rnc_cor
+                traj['checkpoint'] = checkpoint
+                ready_list.append(traj)
+            try:
+                result = result_queue.get_nowait()
+            except queue.Empty:
+                result = None
+        if time.time() - log_time >= sleep_time:
+            write_progress_log(progress_list)
+            log_time = time.time()
+
+    for task_queue in task_queue_list:
+        task_queue.put(None)
+    # keep reading progress events so that workers can flush their queues and exit
+    for worker in worker_list:
+        while worker.is_alive():
+            update_progress(progress_list)
+            worker.join(sleep_time)
+    write_progress_log(progress_list)
+# END Run all trajectories codon by codon
+
+# Elongate all trajectories from start_res up to end_nascent_chain_length on nprocess workers
+def run_synthesis(nprocess, start_res, previous_rnc_cor_list, progress_list, end_nascent_chain_length):
+    global num_traj, start_traj_id, total_nascent_chain_length, codon_scheduler, max_live_traj, sleep_time
+    if codon_scheduler == 1:
+        print('Setup codon scheduler with %d workers and up to %d live trajectories'%(nprocess, max_live_traj))
+        run_codon_scheduler(nprocess, start_res, previous_rnc_cor_list, progress_list, end_nascent_chain_length)
+    else:
+        print('Setup process pool containing %d processors'%nprocess)
+        pool = multiprocessing.Pool(nprocess)
+        for i in range(1, num_traj + 1):
+            if start_res[i-1] <= end_nascent_chain_length:
+                pool.apply_async(run_elongation, (start_traj_id+i-1, start_res[i-1], total_nascent_chain_length, 
+                    previous_rnc_cor_list[i-1], end_nascent_chain_length, ))
+
+        while True:
+            time.sleep(sleep_time)
+            write_progress_log(progress_list)
+
+            if len(pool._cache) == 0:
+                break
+
+        pool.close()
+        pool.join()
+        write_progress_log(progress_list)
+# END Elongate all trajectories
+
+# Branch trajectory traj_id from seed trajectory seed_id at the end of codon fork_length
+# The output of the seed up to the fork is copied and the files of the shared codons are linked to the seed directory, 
+# so analysis scripts see a complete trajectory. The branch continues from the structure rnc_fork.npz of the seed 
+# with its own random seeds and sampled dwell times. Dwell times are exponential and the stages of the next codon 
+# restart from thermal velocities, so the branch is a statistically valid continuation of the seed; branches of one 
+# seed are only correlated through their shared prefix.
+# return True if the seed has finished codon fork_length
+def fork_trajectory(traj_id, seed_id, fork_length):
+    seed_dir = 'traj/%d/'%seed_id
+    traj_dir = 'traj/%d/'%traj_id
+    if not os.path.exists(seed_dir+'rnc_fork.npz') or load_rnc_checkpoint(seed_dir+'rnc_fork.npz')[0] != fork_length:
+        return False
+    # output of the seed up to the end of the fork codon
+    out_lines = []
+    tag_found = 0
+    f = open('output/%d.out'%seed_id, 'r')
+    for line in f:
+        out_lines.append(line)
+        if line.strip() == '--> Elongation finished at length %d'%fork_length:
+            tag_found = 1
             break
-        elif nascent_chain_length < len(prot_psf_pmd.residues):
-            fo = open(out_file, 'a')
-            fo.write('--> Elongation finished at length %d\n'%nascent_chain_length)
-            fo.close()
-        else:
-            fo = open(out_file, 'a')
-            fo.write('#'*92 + '\n')
-            fo.write('--> All Done\n')
-            fo.close()
-    os.chdir('../../')
+    f.close()
+    if tag_found == 0:
+        return False
 
+    os.system('rm -rf '+traj_dir)
+    os.mkdir(traj_dir)
+    for file in ['rnc_fork.npz', 'rnc_static.npz']:
+        if os.path.exists(seed_dir+file):
+            shutil.copy(seed_dir+file, traj_dir+file)
+    # files of the shared codons
+    for file in os.listdir(seed_dir):
+        if not file.startswith('rnc_l'):
+            continue
+        words = file[5:].replace('.', '_').split('_')
+        if words[0].isdigit() and int(words[0]) <= fork_length:
+            os.symlink('../%d/%s'%(seed_id, file), traj_dir+file)
+    # records of the shared codons in the trajectory container
+    if os.path.exists(seed_dir+'rnc_traj.rtc'):
+        (record_list, end) = scan_traj_container(seed_dir+'rnc_traj.rtc')
+        for (offset, header) in record_list:
+            if header['length'] > fork_length:
+                end = offset
+                break
+        f = open(seed_dir+'rnc_traj.rtc', 'rb')
+        fo = open(traj_dir+'rnc_traj.rtc', 'wb')
+        fo.write(f.read(end))
+        fo.close()
+        f.close()
 
-def elongation(nascent_chain_length, prot_psf, ribo_psf, previous_rnc_cor_file, simulation_steps, rand, out_file, properties, platform):
-    global ppn, temp_prod, timestep, fbsolu, forcefield, constraint_tolerance, nsteps_save, ribo_resid_list
-    global use_gpu, ribo_free_mask, spherical_restraint_mask, spherical_restraint_center, spherical_restraint_radius
+    fo = open('output/%d.out'%traj_id, 'w')
+    fo.write('--> Forked from trajectory %d at length %d\n'%(seed_id, fork_length))
+    for line in out_lines:
+        fo.write(line)
+    fo.close()
+    new_file = not os.path.exists('output/fork_points.dat')
+    fo = open('output/fork_points.dat', 'a')
+    if new_file:
+        fo.write('%10s %10s %12s\n'%('SIM_ID', 'SEED_ID', 'FORK_LENGTH'))
+    fo.write('%10d %10d %12d\n'%(traj_id, seed_id, fork_length))
+    fo.close()
+    return True
+# END Branch trajectory from a seed trajectory
 
-    rnc_psf_pmd = prot_psf[':1-'+str(nascent_chain_length)] + ribo_psf # combine ribosome psf with nascent chain psf
-    
-    rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'.psf', overwrite=True)
-    rnc_psf = CharmmPsfFile('rnc_l'+str(nascent_chain_length)+'.psf')
-    
-    top = rnc_psf.topology
-    # re-name residues that are changed by openmm
-    for resid, res in enumerate(top.residues()):
-        if res.name != rnc_psf_pmd.residues[resid].name:
-            res.name = rnc_psf_pmd.residues[resid].name
-    # re-name segid that are changed by openmm
-    for resid, res in enumerate(top.residues()):
-        if res.chain.id != rnc_psf_pmd.residues[resid].segid:
-            res.chain.id = rnc_psf_pmd.residues[resid].segid
-    
-    # renumber ribosome resid
-    idx = 0
-    for res in rnc_psf_pmd.residues:
-        if res.segid != 'A':
-            res.number = ribo_resid_list[idx]
-            idx += 1
-    rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'.psf', overwrite=True)
-    formate_psf_vmd('rnc_l'+str(nascent_chain_length)+'.psf')
+# Open the work queue database on the shared filesystem
+# Transactions lock the whole database file, so the filesystem must support file locks (e.g. NFSv4, Lustre, GPFS).
+# The busy timeout is a twelfth of the lease: an operation that waits longer for the lock fails with 
+# sqlite3.OperationalError and is retried later, so a busy database cannot hold the scheduler until leases expire.
+def connect_work_queue(queue_file):
+    global work_queue_lease
+    conn = sqlite3.connect(queue_file, timeout=work_queue_lease*60/12, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+# END Open the work queue database
 
-    if ribo_free_mask == '':
-        ribo_free_idx = []
+# Join the work queue; the first instance creates it
+# return 'init' if this instance has to set up the trajectories, 'join' if they are set up by another instance
+def open_work_queue(queue_file):
+    global sleep_time
+    conn = connect_work_queue(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    # state: ready, running, fork (waiting for the seed trajectory), done or failed
+    # length: next codon to elongate; previous_rnc_cor: structure to start it from (relative to the trajectory directory)
+    # dirty: 1 if an earlier attempt of the codon was lost; out_size: size of the output file before the codon
+    conn.execute('CREATE TABLE IF NOT EXISTS traj (id INTEGER PRIMARY KEY, seed_id INTEGER, length INTEGER, '
+        'previous_rnc_cor TEXT, state TEXT, owner TEXT, lease REAL, attempts INTEGER, dirty INTEGER, '
+        'out_size INTEGER, checkpoint_length INTEGER, checkpoint_time REAL, start_str TEXT, status TEXT, '
+        'progress_length TEXT, speed TEXT, start_time REAL, end_time REAL)')
+    row = conn.execute("SELECT value FROM meta WHERE key = 'owner'").fetchone()
+    if row == None:
+        conn.execute("INSERT INTO meta VALUES ('owner', ?)", ('%s:%d'%(socket.gethostname(), os.getpid()),))
+        conn.execute("INSERT INTO meta VALUES ('state', 'init')")
+        role = 'init'
     else:
-        try:
-            ribo_free_idx = parse_mask(rnc_psf_pmd, ribo_free_mask)
-        except Exception as e:
-            traceback.print_exc()
-            return False
-    if ribo_free_idx == False:
+        role = 'join'
+    conn.execute('COMMIT')
+    if role == 'join':
+        print('Join work queue %s set up by %s'%(queue_file, row['value']))
+        while conn.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()['value'] != 'ready':
+            time.sleep(sleep_time)
+    conn.close()
+    return role
+# END Join the work queue
+
+# Add all trajectories to the work queue and open it for all instances
+def init_work_queue(queue_file, start_res, previous_rnc_cor_list, progress_list):
+    global num_traj, start_traj_id, total_nascent_chain_length, fork_length, fork_seeds, start_str
+    conn = connect_work_queue(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    for i in range(num_traj):
+        traj_id = start_traj_id + i
+        seed_id = 0
+        state = 'ready'
+        if start_res[i] > total_nascent_chain_length:
+            state = 'done'
+        elif fork_length > 0 and i >= fork_seeds and start_res[i] <= fork_length and previous_rnc_cor_list[i] != \
+            'rnc_stage_checkpoint.npz':
+            seed_id = start_traj_id + (i-fork_seeds)%fork_seeds
+            state = 'fork'
+        out_size = 0
+        if os.path.exists('output/%d.out'%traj_id):
+            out_size = os.path.getsize('output/%d.out'%traj_id)
+        progress = progress_list[i]
+        conn.execute('INSERT INTO traj VALUES (?, ?, ?, ?, ?, NULL, 0, 0, 0, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)', 
+            (traj_id, seed_id, start_res[i], previous_rnc_cor_list[i], state, out_size, start_res[i]-1, time.time(), 
+            start_str[i], progress['status'], progress['length'], progress['speed']))
+    # branches of seeds that have passed the fork point are released by the schedulers
+    conn.execute("UPDATE meta SET value = 'ready' WHERE key = 'state'")
+    conn.execute('COMMIT')
+    conn.close()
+# END Add all trajectories to the work queue
+
+# Branch the trajectories whose seed has passed the fork point, or start them from their own starting structure if 
+# the seed did not reach it. The branches are first marked 'forking' with a lease of this instance; the files are 
+# copied outside of any transaction and only the new state is committed at the end. Branches left 'forking' by a 
+# lost instance are taken over after their lease expired.
+# lease_deadline: deadline of the leases of this instance
+def release_fork_branches(conn, node_id, lease_deadline):
+    global fork_length, starting_strucs, work_queue_lease
+    now = time.time()
+    # seeds past the fork point: elongating a longer codon, finished or failed
+    select = ("SELECT branch.id AS id, branch.seed_id AS seed_id FROM traj AS branch JOIN traj AS seed ON "
+        "branch.seed_id = seed.id WHERE (branch.state = 'fork' AND (seed.length > ? OR seed.state IN ('done', "
+        "'failed'))) OR (branch.state = 'forking' AND (branch.lease < ? OR branch.owner = ?))")
+    # avoid taking the write lock while there is nothing to release
+    if len(conn.execute(select, (fork_length, now, node_id)).fetchall()) == 0:
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    branch_list = conn.execute(select, (fork_length, now, node_id)).fetchall()
+    for branch in branch_list:
+        conn.execute("UPDATE traj SET state = 'forking', owner = ?, lease = ? WHERE id = ?", (node_id, 
+            now+work_queue_lease*60, branch['id']))
+    conn.execute('COMMIT')
+    for branch in branch_list:
+        if time.time() >= lease_deadline.value:
+            break
+        if fork_trajectory(branch['id'], branch['seed_id'], fork_length):
+            conn.execute("UPDATE traj SET state = 'ready', owner = NULL, length = ?, previous_rnc_cor = "
+                "'rnc_fork.npz', start_str = ?, out_size = ?, checkpoint_length = ? WHERE id = ? AND state = "
+                "'forking' AND owner = ?", (fork_length+1, '%d@%d'%(fork_length+1, branch['seed_id']), 
+                os.path.getsize('output/%d.out'%branch['id']), fork_length, branch['id'], node_id))
+        else:
+            print('Warning: seed trajectory %d did not reach length %d. Trajectory %d starts from %s.'%(
+                branch['seed_id'], fork_length, branch['id'], starting_strucs))
+            conn.execute("UPDATE traj SET state = 'ready', owner = NULL WHERE id = ? AND state = 'forking' AND "
+                "owner = ?", (branch['id'], node_id))
+# END Branch trajectories from their seeds
+
+# Put a codon whose attempt was lost back to the queue; the trajectory fails after 3 lost attempts of one codon. 
+# Must be called within a transaction.
+def requeue_task(conn, row):
+    if row['attempts'] + 1 >= 3:
+        print('Warning: trajectory %d failed after %d lost attempts at length %d.'%(row['id'], row['attempts']+1, 
+            row['length']))
+        conn.execute("UPDATE traj SET state = 'failed', status = 'failed', owner = NULL WHERE id = ?", (row['id'],))
+    else:
+        conn.execute("UPDATE traj SET state = 'ready', owner = NULL, attempts = ?, dirty = 1 WHERE id = ?", 
+            (row['attempts']+1, row['id']))
+# END Put a codon back to the queue
+
+# Claim the ready codon with the most predicted remaining steps, preferring trajectories in prefer_list
+# Codons whose lease has expired are put back to the queue first.
+# return row of the trajectory or None if no codon is ready
+def claim_queue_task(conn, node_id, prefer_list):
+    global work_queue_lease, remaining_steps_list
+    now = time.time()
+    # avoid taking the write lock while there is nothing to claim
+    row = conn.execute("SELECT COUNT(*) AS n FROM traj WHERE state = 'ready' OR (state = 'running' AND lease < ?)", 
+        (now,)).fetchone()
+    if row['n'] == 0:
+        return None
+    conn.execute('BEGIN IMMEDIATE')
+    for row in conn.execute("SELECT * FROM traj WHERE state = 'running' AND lease < ?", (now,)).fetchall():
+        print('Warning: lease of trajectory %d at length %d held by %s expired.'%(row['id'], row['length'], 
+            row['owner']))
+        requeue_task(conn, row)
+    row_list = conn.execute("SELECT * FROM traj WHERE state = 'ready'").fetchall()
+    own_list = [row for row in row_list if row['id'] in prefer_list]
+    if len(own_list) > 0:
+        row_list = own_list
+    if len(row_list) == 0:
+        conn.execute('COMMIT')
+        return None
+    row = max(row_list, key=lambda row: remaining_steps_list[row['length']])
+    conn.execute("UPDATE traj SET state = 'running', owner = ?, lease = ? WHERE id = ?", (node_id, 
+        now+work_queue_lease*60, row['id']))
+    conn.execute('COMMIT')
+    return row
+# END Claim the next codon
+
+# Clean up the output of a lost attempt of the codon in row
+# return structure to start the codon from; the stage checkpoint is used if it was saved by the lost attempt
+def recover_queue_task(row):
+    out_file = 'output/%d.out'%row['id']
+    stage_checkpoint_file = 'traj/%d/rnc_stage_checkpoint.npz'%row['id']
+    out_size = 0
+    if os.path.exists(out_file):
+        out_size = os.path.getsize(out_file)
+    if os.path.exists(stage_checkpoint_file):
+        stage_checkpoint = load_stage_checkpoint(stage_checkpoint_file)
+        if (stage_checkpoint['nascent_chain_length'] == row['length'] and stage_checkpoint['out_size'] > row['out_size'] 
+            and stage_checkpoint['out_size'] <= out_size):
+            os.truncate(out_file, stage_checkpoint['out_size'])
+            return 'rnc_stage_checkpoint.npz'
+        os.remove(stage_checkpoint_file)
+    if out_size > row['out_size']:
+        os.truncate(out_file, row['out_size'])
+    return row['previous_rnc_cor']
+# END Clean up the output of a lost attempt
+
+# Store the result of a codon run by this instance
+# The structure is saved to rnc_queue_<0 or 1>.npz alternately, so the structure the codon started from is kept until 
+# the queue points to the new one.
+# return False if the codon is no longer assigned to this instance
+def finish_queue_task(conn, node_id, index, nascent_chain_length, previous_rnc_cor, checkpoint):
+    global total_nascent_chain_length, fork_length
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute('SELECT * FROM traj WHERE id = ?', (index,)).fetchone()
+    if row['state'] != 'running' or row['owner'] != node_id:
+        conn.execute('COMMIT')
+        print('Warning: result of trajectory %d at length %d is dropped since its lease expired.'%(index, 
+            nascent_chain_length))
         return False
-        
-    if spherical_restraint_mask == '':
-        sp_rst_idx = []
+    out_size = 0
+    if os.path.exists('output/%d.out'%index):
+        out_size = os.path.getsize('output/%d.out'%index)
+    if previous_rnc_cor is False:
+        conn.execute("UPDATE traj SET state = 'failed', owner = NULL, dirty = 0, out_size = ? WHERE id = ?", (out_size, 
+            index))
+    elif nascent_chain_length >= total_nascent_chain_length:
+        conn.execute("UPDATE traj SET state = 'done', owner = NULL, dirty = 0, out_size = ? WHERE id = ?", (out_size, 
+            index))
     else:
+        rnc_cor_file = 'rnc_queue_%d.npz'%(nascent_chain_length%2)
+        save_rnc_checkpoint('traj/%d/%s'%(index, rnc_cor_file), nascent_chain_length, previous_rnc_cor)
+        conn.execute("UPDATE traj SET state = 'ready', owner = NULL, length = ?, previous_rnc_cor = ?, attempts = 0, "
+            'dirty = 0, out_size = ?, checkpoint_length = ?, checkpoint_time = ? WHERE id = ?', (nascent_chain_length+1, 
+            rnc_cor_file, out_size, checkpoint[0], checkpoint[1], index))
+    conn.execute('COMMIT')
+    return True
+# END Store the result of a codon
+
+# Put a codon of this instance back to the queue (its worker died or stopped at the lease deadline)
+def release_queue_task(conn, node_id, index):
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute("SELECT * FROM traj WHERE id = ? AND owner = ? AND state = 'running'", (index, 
+        node_id)).fetchone()
+    if row != None:
+        requeue_task(conn, row)
+    conn.execute('COMMIT')
+# END Put a codon of this instance back to the queue
+
+# Roll back after a work queue operation failed (e.g. the database stayed locked longer than the busy timeout); the 
+# scheduler retries the operation in its next round
+def rollback_work_queue(conn, e):
+    print('Warning: work queue operation failed (%s). Retry later.'%str(e))
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+# END Roll back a failed work queue operation
+
+# Renew the leases of the codons and fork branches of this instance every sixth of the lease until stop_event is set
+# Runs in a thread of the main process with its own connection, so renewals never wait for the scheduler loop. After 
+# every successful renewal the deadline shared with the workers is set to two thirds of the lease ahead. Workers stop 
+# their codons at the deadline, so an instance that cannot reach the database leaves its codons alone before their 
+# leases expire and other instances take them over. The margin of a third of the lease must be much longer than one 
+# MD block (nsteps_save steps).
+def renew_queue_leases(queue_file, node_id, stop_event, lease_deadline):
+    global work_queue_lease
+    conn = connect_work_queue(queue_file)
+    while not stop_event.wait(work_queue_lease*60/6):
+        renew_time = time.time()
         try:
-            sp_rst_idx = parse_mask(rnc_psf_pmd, spherical_restraint_mask)
-        except Exception as e:
-            traceback.print_exc()
-            return False
-    if sp_rst_idx == False:
-        return False
+            conn.execute("UPDATE traj SET lease = ? WHERE owner = ? AND state IN ('running', 'forking')", 
+                (renew_time+work_queue_lease*60, node_id))
+        except sqlite3.OperationalError as e:
+            print('Warning: cannot renew leases of %s (%s).'%(node_id, str(e)))
+            continue
+        lease_deadline.value = renew_time + work_queue_lease*60*2/3
+    conn.close()
+# END Renew the leases of this instance
+
+# Push the progress of trajectories running on this instance to the work queue and pull the progress of all the 
+# others, then write the log file
+# Only rows with new progress events of this instance are updated; all the others are read in a deferred 
+# transaction, which does not take the write lock.
+# push_time_list[i]: end_time of the progress of trajectory start_traj_id+i last pushed or pulled
+def write_queue_progress_log(conn, progress_list, push_time_list):
+    global start_traj_id, start_str
+    update_progress(progress_list)
+    push_list = [i for i in range(len(progress_list)) if progress_list[i]['end_time'] != None and 
+        (push_time_list[i] == None or progress_list[i]['end_time'] > push_time_list[i])]
+    if len(push_list) > 0:
+        conn.execute('BEGIN IMMEDIATE')
+        for i in push_list:
+            progress = progress_list[i]
+            # the start time is kept if the trajectory was started by another instance
+            conn.execute('UPDATE traj SET status = ?, progress_length = ?, speed = ?, start_time = COALESCE(start_time, '
+                '?), end_time = ? WHERE id = ? AND (end_time IS NULL OR end_time < ?)', (progress['status'], 
+                progress['length'], progress['speed'], progress['start_time'], progress['end_time'], start_traj_id+i, 
+                progress['end_time']))
+        conn.execute('COMMIT')
+        for i in push_list:
+            push_time_list[i] = progress_list[i]['end_time']
+    conn.execute('BEGIN')
+    row_list = conn.execute('SELECT id, start_str, status, progress_length, speed, start_time, end_time FROM traj'
+        ).fetchall()
+    conn.execute('COMMIT')
+    for row in row_list:
+        i = row['id'] - start_traj_id
+        if row['end_time'] != None and (progress_list[i]['end_time'] == None or 
+            row['end_time'] >= progress_list[i]['end_time']):
+            progress_list[i] = {'length': row['progress_length'], 'status': row['status'], 'speed': row['speed'], 
+                'start_time': row['start_time'], 'end_time': row['end_time']}
+            push_time_list[i] = row['end_time']
+        start_str[i] = row['start_str']
+    write_progress_log(progress_list)
+# END Push and pull the progress
+
+# Run codons pulled from the work queue on nprocess workers until all trajectories in the queue are finished
+# Leases of the running codons are renewed by a thread of this process. A codon whose worker died or stopped at the 
+# lease deadline is put back to the queue. Work queue operations that fail on a busy database are retried in the 
+# next round; finished codons are kept until their results are stored.
+def run_queue_scheduler(nprocess, queue_file, progress_list):
+    global persistent_context, total_nascent_chain_length, sleep_time, work_queue_lease, fork_length, num_traj
+    conn = connect_work_queue(queue_file)
+    node_id = '%s:%d'%(socket.gethostname(), os.getpid())
+
+    # shared with the workers without a lock, so that workers started while the renewal thread runs cannot inherit 
+    # a held lock
+    lease_deadline = multiprocessing.RawValue('d', time.time() + work_queue_lease*60*2/3)
+    stop_event = threading.Event()
+    renew_thread = threading.Thread(target=renew_queue_leases, args=(queue_file, node_id, stop_event, lease_deadline))
+    renew_thread.daemon = True
+    renew_thread.start()
+
+    task_queue_list = [multiprocessing.Queue() for i in range(nprocess)]
+    result_queue = multiprocessing.Queue()
+    worker_list = [None for i in range(nprocess)]
+    running_dict = {}
+    own_dict = {} # trajectory index -> worker holding its persistent system
+    idle_list = list(range(nprocess))
+    finish_list = [] # results of finished codons not stored in the queue yet
+    release_list = [] # codons to put back to the queue
+    push_time_list = [None for i in range(num_traj)]
+    log_time = 0
+    while True:
+        # (re)start workers
+        for i in range(nprocess):
+            if worker_list[i] == None or not worker_list[i].is_alive():
+                if worker_list[i] != None:
+                    print('Warning: worker %d on %s exited unexpectedly.'%(i+1, node_id))
+                    if i in running_dict:
+                        release_list.append(running_dict.pop(i)['id'])
+                        idle_list.append(i)
+                    for index in [index for index in own_dict.keys() if own_dict[index] == i]:
+                        own_dict.pop(index)
+                    task_queue_list[i] = multiprocessing.Queue()
+                worker_list[i] = multiprocessing.Process(target=codon_worker, args=(i, task_queue_list[i], 
+                    result_queue, lease_deadline), name='CodonWorker-%d'%(i+1))
+                worker_list[i].start()
+        try:
+            # store results of finished codons
+            while len(release_list) > 0:
+                release_queue_task(conn, node_id, release_list[0])
+                release_list.pop(0)
+            while len(finish_list) > 0:
+                (index, nascent_chain_length, previous_rnc_cor, checkpoint) = finish_list[0]
+                if (not finish_queue_task(conn, node_id, index, nascent_chain_length, previous_rnc_cor, checkpoint) 
+                    or previous_rnc_cor is False or nascent_chain_length == total_nascent_chain_length):
+                    own_dict.pop(index, None)
+                finish_list.pop(0)
+            if fork_length > 0:
+                release_fork_branches(conn, node_id, lease_deadline)
+            # assign codons to idle workers
+            while len(idle_list) > 0 and time.time() < lease_deadline.value:
+                worker_id = idle_list[0]
+                prefer_list = []
+                if persistent_context == 1:
+                    prefer_list = [index for index in own_dict.keys() if own_dict[index] == worker_id]
+                row = claim_queue_task(conn, node_id, prefer_list)
+                if row == None:
+                    break
+                idle_list.pop(0)
+                index = row['id']
+                previous_rnc_cor = row['previous_rnc_cor']
+                if row['dirty'] == 1:
+                    previous_rnc_cor = recover_queue_task(row)
+                if index in own_dict and own_dict[index] != worker_id:
+                    task_queue_list[own_dict[index]].put(('drop', index))
+                own_dict[index] = worker_id
+                task_queue_list[worker_id].put(('codon', index, row['length'], total_nascent_chain_length, 
+                    previous_rnc_cor, [row['checkpoint_length'], row['checkpoint_time']]))
+                running_dict[worker_id] = row
+        except sqlite3.OperationalError as e:
+            rollback_work_queue(conn, e)
+        # collect finished codons
+        try:
+            result = result_queue.get(timeout=sleep_time)
+        except queue.Empty:
+            result = None
+        while result != None:
+            (worker_id, index, nascent_chain_length, previous_rnc_cor, checkpoint) = result
+            running_dict.pop(worker_id)
+            idle_list.append(worker_id)
+            if previous_rnc_cor is None:
+                # stopped at the lease deadline
+                own_dict.pop(index, None)
+                release_list.append(index)
+            else:
+                finish_list.append((index, nascent_chain_length, previous_rnc_cor, checkpoint))
+            try:
+                result = result_queue.get_nowait()
+            except queue.Empty:
+                result = None
+        if time.time() - log_time >= sleep_time:
+            try:
+                write_queue_progress_log(conn, progress_list, push_time_list)
+            except sqlite3.OperationalError as e:
+                rollback_work_queue(conn, e)
+            log_time = time.time()
+        if len(running_dict) == 0 and len(finish_list) == 0 and len(release_list) == 0:
+            try:
+                row = conn.execute("SELECT COUNT(*) AS n FROM traj WHERE state IN ('ready', 'running', 'fork', "
+                    "'forking')").fetchone()
+                if row['n'] == 0:
+                    break
+            except sqlite3.OperationalError as e:
+                rollback_work_queue(conn, e)
+
+    for task_queue in task_queue_list:
+        task_queue.put(None)
+    # keep reading progress events so that workers can flush their queues and exit
+    for worker in worker_list:
+        while worker.is_alive():
+            update_progress(progress_list)
+            worker.join(sleep_time)
+    stop_event.set()
+    renew_thread.join()
+    try:
+        write_queue_progress_log(conn, progress_list, push_time_list)
+    except sqlite3.OperationalError as e:
+        rollback_work_queue(conn, e)
+    conn.close()
+# END Run codons pulled from the work queue
+
+# resume: stage checkpoint of this codon to continue from (run all stages if None)
+def elongation(nascent_chain_length, prot_psf, ribo_psf, previous_rnc_cor, simulation_steps, rand, out_file, properties, platform, 
+    resume=None):
+    global ppn, temp_prod, timestep, fbsolu, forcefield, constraint_tolerance, nsteps_save, rnc_index
+    global use_gpu, spherical_restraint_center, spherical_restraint_radius, active_shell
+
+    # RNC of the current length is sliced from the precomputed full-length RNC
+    rnc_psf_pmd = slice_rnc_psf(rnc_index, nascent_chain_length)
+    rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'.psf', overwrite=True)
+    formate_psf_vmd('rnc_l'+str(nascent_chain_length)+'.psf')
+    # openmm topology is built from parmed structure directly instead of re-reading the psf file
+    top = rnc_psf_pmd.topology
+
+    ribo_free_idx = rnc_mask_index(rnc_index, 'ribo_free_idx', nascent_chain_length)
+    sp_rst_idx = rnc_mask_index(rnc_index, 'sp_rst_idx', nascent_chain_length)
     
     fo = open(out_file, 'a')
     if ribo_free_idx == []:
@@ -213,10 +963,20 @@ def elongation(nascent_chain_length, prot_psf, ribo_psf, previous_rnc_cor_file,
         fo.write('    Spherical restraint: None\n')
     else:
         fo.write('    Spherical restraint: Center %s; Radius %.4f\n'%(str(spherical_restraint_center), spherical_restraint_radius))
+    if active_shell == 1:
+        ribo_fix_atom_index = rnc_atom_groups(rnc_columns(rnc_index, nascent_chain_length)['segid'], ribo_free_idx)[0]
+        (ribo_shell_index, radius) = calc_active_shell(ribo_fix_atom_index, nascent_chain_length)
+        fo.write('    Active shell: %d of %d fixed ribosome atoms within %.1f A of tRNA 3\' ends\n'%(
+            len(ribo_shell_index), len(ribo_fix_atom_index), radius))
     fo.close()
 
-    previous_rnc_cor = CharmmCrdFile(previous_rnc_cor_file)
-    current_rnc_cor = previous_rnc_cor.positions
+    # previous RNC structure is either kept in memory or read from a cor/checkpoint file
+    if resume != None:
+        current_rnc_cor = resume['positions']*nanometer
+    elif type(previous_rnc_cor) == str:
+        current_rnc_cor = load_rnc_cor(previous_rnc_cor)
+    else:
+        current_rnc_cor = previous_rnc_cor
     # add new amino acid bead to RNC
 
     # build residue template map
@@ -226,31 +986,36 @@ def elongation(nascent_chain_length, prot_psf, ribo_psf, previous_rnc_cor_file,
             template_map[res] = res.name
 
     seeded_random = random.Random(rand)
-
-    rand = seeded_random.randint(10,1000000000)
-    current_rnc_cor = A_site_tRNA_binding(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
-        out_file, template_map, platform, properties, rand, simulation_steps[0], ribo_free_idx, sp_rst_idx)
-    if current_rnc_cor == False:
-        return False
-
-    rand = seeded_random.randint(10,1000000000)
-    current_rnc_cor = peptide_bond_formation(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
-        out_file, template_map, platform, properties, rand, simulation_steps[1], ribo_free_idx, sp_rst_idx)
-    if current_rnc_cor == False:
-        return False
-
-    rand = seeded_random.randint(10,1000000000)
-    current_rnc_cor = translocation_AtR(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
-        out_file, template_map, platform, properties, rand, simulation_steps[2], ribo_free_idx, sp_rst_idx)
-    if current_rnc_cor == False:
-        return False
-    else:
-        return 'rnc_l'+str(nascent_chain_length)+'_stage_3_final.cor'
+    stage_function = {1: A_site_tRNA_binding, 2: peptide_bond_formation, 3: translocation_AtR}
+    for stage in [1, 2, 3]:
+        rand = seeded_random.randint(10,1000000000)
+        if resume == None or stage > resume['stage']:
+            current_rnc_cor = stage_function[stage](top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
+                out_file, template_map, platform, properties, rand, simulation_steps[stage-1], ribo_free_idx, sp_rst_idx)
+        elif stage == resume['stage']:
+            # continue the MD of the checkpointed stage without minimization
+            system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, stage, nascent_chain_length, 
+                ribo_free_idx, sp_rst_idx)
+            (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, 
+                rnc_psf_pmd, out_file, system, stage, platform, properties, rand, simulation_steps[stage-1], [], 
+                ribo_free_idx, resume)
+            if stage == 3 and nascent_chain_length == len(prot_psf.residues) and current_rnc_cor != False:
+                current_rnc_cor = termination(top, current_rnc_cor, current_rnc_velocities, nascent_chain_length, 
+                    rnc_psf_pmd, out_file, template_map, platform, properties, rand, simulation_steps[2], ribo_free_idx, 
+                    sp_rst_idx)
+        elif stage == 3:
+            # the checkpoint is in nascent chain ejection or dissociation
+            current_rnc_cor = termination(top, current_rnc_cor, resume['velocities']*nanometer/picosecond, 
+                nascent_chain_length, rnc_psf_pmd, out_file, template_map, platform, properties, rand, simulation_steps[2], 
+                ribo_free_idx, sp_rst_idx, resume)
+        if current_rnc_cor is False:
+            return False
+    return current_rnc_cor
 
 # A-site tRNA binding
 def A_site_tRNA_binding(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
     out_file, template_map, platform, properties, rand, simulation_steps, ribo_free_idx, sp_rst_idx):
-    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield
+    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield, save_stage_structures
 
     # A-site resid 76 (last residue) ribose R 
     AtR_id76_R_index = 0
@@ -325,8 +1090,9 @@ def A_site_tRNA_binding(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd,
     getEnergyDecomposition(fo, simulation.context, forcegroups)
     fo.close()
     current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
-    rnc_psf_pmd.positions = current_rnc_cor
-    rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_1.pdb', charmm=True)
+    if save_stage_structures == 1:
+        rnc_psf_pmd.positions = current_rnc_cor
+        rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_1.pdb', charmm=True)
 
     system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 1, nascent_chain_length, ribo_free_idx, sp_rst_idx)
     (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
@@ -336,7 +1102,7 @@ def A_site_tRNA_binding(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd,
 # peptide bond formation
 def peptide_bond_formation(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
     out_file, template_map, platform, properties, rand, simulation_steps, ribo_free_idx, sp_rst_idx):
-    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield
+    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield, save_stage_structures
     global nonbond_cutoff, switch_cutoff
     
     fo = open(out_file, 'a')
@@ -391,8 +1157,9 @@ def peptide_bond_formation(top, current_rnc_cor, nascent_chain_length, rnc_psf_p
     getEnergyDecomposition(fo, simulation.context, forcegroups)
     fo.close()
     current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
-    rnc_psf_pmd.positions = current_rnc_cor
-    rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_2.pdb', charmm=True)
+    if save_stage_structures == 1:
+        rnc_psf_pmd.positions = current_rnc_cor
+        rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_2.pdb', charmm=True)
 
     system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 2, nascent_chain_length, ribo_free_idx, sp_rst_idx)
     (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
@@ -402,7 +1169,7 @@ def peptide_bond_formation(top, current_rnc_cor, nascent_chain_length, rnc_psf_p
 # translocation of A-site tRNA to P-site
 def translocation_AtR(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
     out_file, template_map, platform, properties, rand, simulation_steps, ribo_free_idx, sp_rst_idx):
-    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield
+    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield, save_stage_structures
     global nonbond_cutoff, switch_cutoff, prot_psf_pmd
     
     fo = open(out_file, 'a')
@@ -457,40 +1224,58 @@ def translocation_AtR(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd,
     getEnergyDecomposition(fo, simulation.context, forcegroups)
     fo.close()
     current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
-    rnc_psf_pmd.positions = current_rnc_cor
-    rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_3.pdb', charmm=True)
+    if save_stage_structures == 1:
+        rnc_psf_pmd.positions = current_rnc_cor
+        rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_3.pdb', charmm=True)
 
     system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 3, nascent_chain_length, ribo_free_idx, sp_rst_idx)
     (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
         out_file, system, 3, platform, properties, rand, simulation_steps, [], ribo_free_idx)
 
     if nascent_chain_length == len(prot_psf_pmd.residues) and current_rnc_cor != False:
+        current_rnc_cor = termination(top, current_rnc_cor, current_rnc_velocities, nascent_chain_length, rnc_psf_pmd, 
+            out_file, template_map, platform, properties, rand, simulation_steps, ribo_free_idx, sp_rst_idx)
+
+    return current_rnc_cor
+
+# nascent chain ejection and dissociation after the last codon
+# rand: random seed of the translocation stage
+# resume: stage checkpoint in ejection or dissociation to continue from (run both stages if None)
+def termination(top, current_rnc_cor, current_rnc_velocities, nascent_chain_length, rnc_psf_pmd, 
+    out_file, template_map, platform, properties, rand, simulation_steps, ribo_free_idx, sp_rst_idx, resume=None):
+    global forcefield
+
+    seeded_random = random.Random(rand)
+    rand = seeded_random.randint(10,1000000000)
+    if resume == None:
         fo = open(out_file, 'a')
         fo.write('--> Elongation finished at length %d\n'%nascent_chain_length)
         fo.write('#'*92 + '\n')
         fo.write('--> Elongation termination at length %d\n'%nascent_chain_length)
-        seeded_random = random.Random(rand)
-        rand = seeded_random.randint(10,1000000000)
         fo.write('--> Nascent chain ejection with random seed %d\n'%(rand))
         fo.close()
+    if resume == None or resume['stage'] == 4:
         system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 4, nascent_chain_length, ribo_free_idx, sp_rst_idx)
         (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
-            out_file, system, 4, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx)
-        rand = seeded_random.randint(10,1000000000)
+            out_file, system, 4, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx, resume)
+        if current_rnc_cor is False:
+            return False
+        resume = None
+    rand = seeded_random.randint(10,1000000000)
+    if resume == None:
         fo = open(out_file, 'a')
         fo.write('--> Nascent chain dissociation with random seed %d\n'%(rand))
         fo.close()
-        system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 5, nascent_chain_length, ribo_free_idx, sp_rst_idx)
-        (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
-            out_file, system, 5, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx)
-
+    system = create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, 5, nascent_chain_length, ribo_free_idx, sp_rst_idx)
+    (current_rnc_cor, current_rnc_velocities) = equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, 
+        out_file, system, 5, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx, resume)
     return current_rnc_cor
 
 # equilibration
 def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_file, system, 
-    stage, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx):
+    stage, platform, properties, rand, simulation_steps, current_rnc_velocities, ribo_free_idx, resume=None):
     global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield, nsteps_save
-    global restraint_coor, prot_psf_pmd, x_eject, use_gpu
+    global restraint_coor, prot_psf_pmd, x_eject, use_gpu, rnc_index
 
     if_flex_PTC = 0
 
@@ -516,17 +1301,17 @@ def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_f
             # select all interaction sites not in the partial sphere around the PTC
                 system.setParticleMass(atom.index, 0*dalton)
     else:
-        for atom in top.atoms():
-            if atom.residue.chain.id != 'A' and (not atom.index in ribo_free_idx): 
-            # select all interaction sites not in the partial sphere around the PTC
-                system.setParticleMass(atom.index, 0*dalton)
+        # select all interaction sites not in the partial sphere around the PTC
+        segid = rnc_columns(rnc_index, nascent_chain_length)['segid']
+        is_free = np.zeros(len(segid), dtype=bool)
+        is_free[ribo_free_idx] = True
+        for i in np.nonzero((segid != 'A') & np.logical_not(is_free))[0]:
+            system.setParticleMass(int(i), 0*dalton)
 
     rm_cons_0_mass(system)
 
-    integrator = LangevinIntegrator(temp_prod, fbsolu, timestep)
-    integrator.setConstraintTolerance(constraint_tolerance)
-    integrator.setRandomNumberSeed(rand)
     forcegroups = forcegroupify(system)
+    (integrator, forcegroups) = create_md_integrator(system, forcegroups, rand)
     while True:
         try:
             simulation = Simulation(top, system, integrator, platform, properties)
@@ -548,14 +1333,6 @@ def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_f
     else:
         fo.write('    Running MD on GPUs with random seed %d\n'%(rand))
     fo.close()
-    simulation.reporters = []
-    if stage == 4:
-        simulation.reporters.append(DCDReporter('rnc_l'+str(nascent_chain_length)+'_ejection.dcd', nsteps_save))
-    elif stage == 5:
-        simulation.reporters.append(DCDReporter('rnc_l'+str(nascent_chain_length)+'_dissociation.dcd', nsteps_save))
-    else:
-        simulation.reporters.append(DCDReporter('rnc_l'+str(nascent_chain_length)+'_stage_'+str(stage)+'.dcd', nsteps_save))
-
     # Compute the number of degrees of freedom.
     dof = 0
     for i in range(system.getNumParticles()):
@@ -565,72 +1342,236 @@ def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_f
     if any(type(system.getForce(i)) == CMMotionRemover for i in range(system.getNumForces())):
         dof -= 3
 
+    return run_stage_md(simulation, system, top, nascent_chain_length, rnc_psf_pmd, out_file, stage, 
+        simulation_steps, forcegroups, dof, resume=resume)
+
+# run MD for one stage and save outputs
+# save_idx: atoms written to dcd and cor files (all atoms if None)
+# mobile_idx: atoms used to compute kinetic energy (the whole system if None)
+# resume: stage checkpoint to continue from (start from step 0 if None)
+def run_stage_md(simulation, system, top, nascent_chain_length, rnc_psf_pmd, out_file, stage, 
+    simulation_steps, forcegroups, dof, save_idx=None, mobile_idx=None, resume=None):
+    global timestep, nsteps_save, x_eject, save_stage_structures, stage_checkpoint_minutes
+    global ribosome_grid, ribo_grid, rnc_index, traj_container, traj_container_atoms, traj_container_chunk, traj_atoms
+    global spherical_restraint_mask
+
+    if traj_container == 1:
+        dcd_file = 'rnc_traj.rtc'
+    elif stage == 4:
+        dcd_file = 'rnc_l'+str(nascent_chain_length)+'_ejection.dcd'
+    elif stage == 5:
+        dcd_file = 'rnc_l'+str(nascent_chain_length)+'_dissociation.dcd'
+    else:
+        dcd_file = 'rnc_l'+str(nascent_chain_length)+'_stage_'+str(stage)+'.dcd'
+    start_step = 0
+    tag_seperate = 0
+    if resume != None:
+        restore_stage_checkpoint(simulation, resume, out_file)
+        start_step = resume['step']
+        tag_seperate = resume['tag_seperate']
+        # drop frames written after the checkpoint
+        if traj_container == 1:
+            truncate_traj_container(dcd_file, resume['dcd_size'])
+        else:
+            truncate_dcd(dcd_file, resume['dcd_size'], start_step//nsteps_save)
+        fo = open(out_file, 'a')
+        fo.write('    Resume MD at step %d\n'%start_step)
+        fo.close()
+    simulation.reporters = []
+    if (traj_container == 0 and traj_atoms == 'mobile') or (traj_container == 1 and traj_container_atoms == 'mobile'):
+        # nascent chain and free ribosome atoms; all the others are frozen and saved once in rnc_static.npz
+        mobile_sel = np.zeros(len(rnc_psf_pmd.atoms), dtype=bool)
+        mobile_sel[:rnc_index['nc_natom'][nascent_chain_length]] = True
+        mobile_sel[rnc_mask_index(rnc_index, 'ribo_free_idx', nascent_chain_length)] = True
+        mobile_idx_rnc = np.nonzero(mobile_sel)[0]
+        if not os.path.exists('rnc_static.npz'):
+            positions = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+            if save_idx is not None:
+                positions = positions[save_idx]
+            save_static_snapshot('rnc_static.npz', positions.value_in_unit(angstroms), nascent_chain_length)
+    if traj_container == 1:
+        if traj_container_atoms == 'nc':
+            container_idx = np.arange(rnc_index['nc_natom'][nascent_chain_length])
+        elif traj_container_atoms == 'mobile':
+            container_idx = mobile_idx_rnc
+        else:
+            container_idx = np.arange(len(rnc_psf_pmd.atoms))
+        if save_idx is not None:
+            container_idx = np.array(save_idx)[container_idx]
+        container = TrajContainerReporter(dcd_file, nsteps_save, container_idx, nascent_chain_length, stage, 
+            traj_container_atoms, traj_container_chunk)
+        simulation.reporters.append(container)
+    elif traj_atoms == 'mobile':
+        mobile_psf_pmd = rnc_psf_pmd[mobile_sel]
+        mobile_psf_file = 'rnc_l'+str(nascent_chain_length)+'_mobile.psf'
+        if not os.path.exists(mobile_psf_file):
+            mobile_psf_pmd.save(mobile_psf_file, overwrite=True)
+            formate_psf_vmd(mobile_psf_file)
+        if save_idx is None:
+            dcd_idx = mobile_idx_rnc
+        else:
+            dcd_idx = np.array(save_idx)[mobile_idx_rnc]
+        simulation.reporters.append(SubsetDCDReporter(dcd_file, nsteps_save, dcd_idx, mobile_psf_pmd.topology, 
+            append=(resume != None)))
+    elif save_idx is None:
+        simulation.reporters.append(DCDReporter(dcd_file, nsteps_save, append=(resume != None)))
+    else:
+        simulation.reporters.append(SubsetDCDReporter(dcd_file, nsteps_save, save_idx, rnc_psf_pmd.topology, 
+            append=(resume != None)))
+    if mobile_idx is not None:
+        mobile_mass = np.array([system.getParticleMass(i).value_in_unit(dalton) for i in mobile_idx])
+    if stage == 4 or stage == 5:
+        # distance monitor: frozen ribosome atoms in a cell list, free ribosome atoms checked directly
+        nc_atom_index = []
+        free_atom_index = []
+        static_atom_index = []
+        for atom in top.atoms():
+            if atom.residue.chain.id == 'A':
+                nc_atom_index.append(atom.index)
+            elif atom.residue.chain.id != 'LIG':
+                # not nascent chain and not ligands
+                if system.getParticleMass(atom.index) > 0*dalton:
+                    free_atom_index.append(atom.index)
+                else:
+                    static_atom_index.append(atom.index)
+        current_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(angstroms)
+        static_coor = current_cor[static_atom_index]
+        if ribosome_grid != '':
+            static_coor = np.vstack([static_coor, ribo_grid['grid_coor']])
+        ribo_cell_list = build_ribo_cell_list(static_coor)
+    if stage == 5 and spherical_restraint_mask != '':
+        # synthesized residues of the nascent chain, whose center of mass is the center of the spherical restraint
+        com_idx = [atom.index for atom in top.atoms() if atom.residue.chain.id == 'A' and 
+            atom.residue.index < nascent_chain_length]
+        com_mass = np.array([system.getParticleMass(i).value_in_unit(dalton) for i in com_idx])
+
     start_time = time.time()
-    step = 0
+    checkpoint_time = start_time
+    step = start_step
     tag_eject = 0
-    tag_seperate = 0
 
     while True:
-        step += 1
+        # in distributed mode, stop before the next block writes to the trajectory files if the codon may have been 
+        # taken over by another instance of the work queue
+        if not check_queue_lease():
+            raise RuntimeError('lease deadline of the codon passed at step %d of stage %d'%(step, stage))
+        # Reset spherical restraint center for dissociation; it is kept fixed within the block
+        if stage == 5 and spherical_restraint_mask != '':
+            current_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+            current_cor = current_cor.value_in_unit(angstroms)[com_idx]
+            NC_COM = np.sum(current_cor*com_mass[:, np.newaxis], axis=0) / np.sum(com_mass)
+            simulation.context.setParameter('x0', NC_COM[0]*angstrom)
+            simulation.context.setParameter('y0', NC_COM[1]*angstrom)
+            simulation.context.setParameter('z0', NC_COM[2]*angstrom)
+        # advance to the next output step in one block
+        nstep = nsteps_save - step%nsteps_save
+        if stage != 4 and stage != 5:
+            nstep = max(min(nstep, simulation_steps - step), 1)
+        block_start = step
+        block_current_step = simulation.currentStep
+        block_state = simulation.context.getState(getPositions=True, getVelocities=True, getParameters=True)
         try:
-            simulation.step(1)
-            # Reset spherical restaint center for dissociation
-            if stage == 5 and spherical_restraint_mask != '':
-                NC_COM = calc_NC_COM(top, simulation.context.getState(getPositions=True).getPositions(), system)
-                simulation.context.setParameter('x0', NC_COM[0]*angstrom)
-                simulation.context.setParameter('y0', NC_COM[1]*angstrom)
-                simulation.context.setParameter('z0', NC_COM[2]*angstrom)
-            # Prepare outputs
-            if step%nsteps_save == 0:
-                progress = step/simulation_steps*100
-                Ep = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilocalorie/mole)
-                Ek = simulation.context.getState(getEnergy=True).getKineticEnergy().value_in_unit(kilocalorie/mole)
-                Temp = (2*simulation.context.getState(getEnergy=True).getKineticEnergy()/
-                    (dof*MOLAR_GAS_CONSTANT_R)).value_in_unit(kelvin)
-                end_time = time.time()
-                speed = step / (end_time - start_time) * timestep.value_in_unit(nanoseconds) * 3600 * 24
-                left_time = convert_time((simulation_steps - step) / step * (end_time - start_time))
+            simulation.step(nstep)
+            check_finite_energy(simulation.context)
+            step += nstep
+        except Exception as e:
+            block_error = e
+            # roll back to the start of the block and replay single steps to find the crashed step
+            simulation.context.setState(block_state)
+            simulation.currentStep = block_current_step
+            step = block_start
+            error = None
+            while step < block_start + nstep:
+                step += 1
+                try:
+                    simulation.step(1)
+                    check_finite_energy(simulation.context)
+                except Exception as e:
+                    error = e
+                    break
+            if error == None:
                 fo = open(out_file, 'a')
-                if stage == 4 or stage == 5:
-                    current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
-                    (min_d_rn, min_d_n) = calc_min_distance(top, current_rnc_cor)
-                    if step/nsteps_save == 1:
-                        fo.write('    %11s %15s %15s %7s %10s %11s\n'%('Step', 'Ep(kcal/mol)', 'Ek(kcal/mol)',
-                            'Temp(K)', 'd_min(A)', 'Speed(ns/d)'))
-                    if stage == 4:
-                        fo.write('    %11d %15.4f %15.4f %7.1f %10.3f %11.1f\n'%(step, Ep, Ek, Temp, min_d_n, speed))
-                        if min_d_n >= x_eject:
-                            tag_eject = 1
-                    else:
-                        fo.write('    %11d %15.4f %15.4f %7.1f %10.3f %11.1f\n'%(step, Ep, Ek, Temp, min_d_rn, speed))
-                        if min_d_rn >= 20:
-                            tag_seperate += 1
-                        else:
-                            tag_seperate = 0
-                else:
-                    if step/nsteps_save == 1:
-                        fo.write('    %6s %11s %15s %15s %7s %11s %11s\n'%('Progress', 'Step', 'Ep(kcal/mol)', 'Ek(kcal/mol)',
-                            'Temp(K)', 'Speed(ns/d)', 'Time_remain'))
-                    fo.write('    %7.1f%% %11d %15.4f %15.4f %7.1f %11.1f %11s\n'%(progress, step, Ep, Ek, Temp,
-                        speed, left_time))
+                fo.write("Warning: error in steps %d to %d was not reproduced by single steps:\n"%(block_start+1, 
+                    block_start+nstep))
+                fo.write(str(block_error)+'\n')
                 fo.close()
-        except Exception as e:
+            else:
+                fo = open(out_file, 'a')
+                simulation.saveState('rnc_l'+str(nascent_chain_length)+'_crashed_step_'+str(step)+
+                    '_stage_'+str(stage)+'.xml')
+                fo.write("Error: crashed at step %d:\n"%(step))
+                fo.write(str(error)+'\n')
+                getEnergyDecomposition(fo, simulation.context, forcegroups)
+                getMaxForce(fo, simulation.context, forcegroups)
+                ke = simulation.context.getState(getEnergy=True).getKineticEnergy()
+                fo.write("    Kinetic energy is %.4f kcal/mol\n"%(ke.value_in_unit(kilocalories_per_mole)))
+                fo.close()
+                current_rnc_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+                if save_idx is None:
+                    rnc_psf_pmd.positions = current_rnc_cor
+                else:
+                    rnc_psf_pmd.positions = current_rnc_cor[save_idx]
+                rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'_crashed_step_'+str(step)+
+                    '_stage_'+str(stage)+'.cor', format='charmmcrd', overwrite=True)
+                if traj_container == 1:
+                    container.flush()
+                return (False, False)
+
+        # Prepare outputs
+        if step%nsteps_save == 0:
+            progress = step/simulation_steps*100
+            Ep = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilocalorie/mole)
+            if mobile_idx is None:
+                Ek = simulation.context.getState(getEnergy=True).getKineticEnergy()
+            else:
+                vel = simulation.context.getState(getVelocities=True).getVelocities(asNumpy=True)
+                vel = vel.value_in_unit(nanometer/picosecond)[mobile_idx]
+                Ek = 0.5*np.sum(mobile_mass*np.sum(vel**2, axis=1))*kilojoule/mole
+            Temp = (2*Ek/(dof*MOLAR_GAS_CONSTANT_R)).value_in_unit(kelvin)
+            Ek = Ek.value_in_unit(kilocalorie/mole)
+            end_time = time.time()
+            speed = (step - start_step) / (end_time - start_time) * timestep.value_in_unit(nanoseconds) * 3600 * 24
+            left_time = convert_time((simulation_steps - step) / (step - start_step) * (end_time - start_time))
             fo = open(out_file, 'a')
-            simulation.saveState('rnc_l'+str(nascent_chain_length)+'_crashed_step_'+str(step)+
-                '_stage_'+str(stage)+'.xml')
-            fo.write("Error: crashed at step %d:\n"%(step))
-            fo.write(str(e)+'\n')
-            getEnergyDecomposition(fo, simulation.context, forcegroups)
-            getMaxForce(fo, simulation.context, system)
-            ke = simulation.context.getState(getEnergy=True).getKineticEnergy()
-            fo.write("    Kinetic energy is %.4f kcal/mol\n"%(ke.value_in_unit(kilocalories_per_mole)))
+            if stage == 4 or stage == 5:
+                current_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+                current_cor = current_cor.value_in_unit(angstroms)
+                (min_d_rn, min_d_n) = calc_min_distance(ribo_cell_list, current_cor[nc_atom_index],
+                    current_cor[free_atom_index])
+                if step/nsteps_save == 1:
+                    fo.write('    %11s %15s %15s %7s %10s %11s\n'%('Step', 'Ep(kcal/mol)', 'Ek(kcal/mol)',
+                        'Temp(K)', 'd_min(A)', 'Speed(ns/d)'))
+                if stage == 4:
+                    fo.write('    %11d %15.4f %15.4f %7.1f %10.3f %11.1f\n'%(step, Ep, Ek, Temp, min_d_n, speed))
+                    if min_d_n >= x_eject:
+                        tag_eject = 1
+                else:
+                    fo.write('    %11d %15.4f %15.4f %7.1f %10.3f %11.1f\n'%(step, Ep, Ek, Temp, min_d_rn, speed))
+                    if min_d_rn >= 20:
+                        tag_seperate += 1
+                    else:
+                        tag_seperate = 0
+            else:
+                if step/nsteps_save == 1:
+                    fo.write('    %6s %11s %15s %15s %7s %11s %11s\n'%('Progress', 'Step', 'Ep(kcal/mol)', 'Ek(kcal/mol)',
+                        'Temp(K)', 'Speed(ns/d)', 'Time_remain'))
+                fo.write('    %7.1f%% %11d %15.4f %15.4f %7.1f %11.1f %11s\n'%(progress, step, Ep, Ek, Temp,
+                    speed, left_time))
             fo.close()
-            current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
-            rnc_psf_pmd.positions = current_rnc_cor
-            rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'_crashed_step_'+str(step)+
-                '_stage_'+str(stage)+'.cor', format='charmmcrd', overwrite=True)
-            return (False, False)
-        
+            if stage == 4 or stage == 5:
+                report_progress(nascent_chain_length, '%d(stage %d)'%(step, stage), '%.1f'%speed)
+            else:
+                report_progress(nascent_chain_length, '%d(%.1f%%)'%(step, progress), '%.1f'%speed)
+
+            # save the state of a stage that is not finished yet
+            if (stage_checkpoint_minutes > 0 and time.time() - checkpoint_time >= stage_checkpoint_minutes*60 and 
+                tag_eject == 0 and tag_seperate < 10 and (stage >= 4 or step < simulation_steps)):
+                if traj_container == 1:
+                    container.flush()
+                save_stage_checkpoint('rnc_stage_checkpoint.npz', simulation, nascent_chain_length, stage, step, 
+                    tag_seperate, out_file, dcd_file)
+                checkpoint_time = time.time()
+
         if stage == 4:
             if tag_eject == 1:
                 break
@@ -642,8 +1583,16 @@ def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_f
 
     current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
     current_rnc_velocities = simulation.context.getState(getVelocities=True).getVelocities()
-    rnc_psf_pmd.positions = current_rnc_cor
-    rnc_psf_pmd.velocities = current_rnc_velocities
+    if save_idx is None:
+        rnc_psf_pmd.positions = current_rnc_cor
+        rnc_psf_pmd.velocities = current_rnc_velocities
+    else:
+        state = simulation.context.getState(getPositions=True, getVelocities=True)
+        rnc_psf_pmd.positions = state.getPositions(asNumpy=True)[save_idx]
+        rnc_psf_pmd.velocities = state.getVelocities(asNumpy=True)[save_idx]
+    if traj_container == 1:
+        container.write_final(simulation.context.getState(getPositions=True), step)
+        simulation.reporters = []
     if stage == 4:
         rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'_ejection_final.cor', 
             format='charmmcrd', overwrite=True)
@@ -667,17 +1616,115 @@ def equilibration(top, current_rnc_cor, nascent_chain_length, rnc_psf_pmd, out_f
                 # fv.write('%12.6f '%v)
             # fv.write('\n')
         # fv.close()
-    else:
+    elif save_stage_structures == 1:
         rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'_stage_'+str(stage)+'_final.cor', 
             format='charmmcrd', overwrite=True)
     fo = open(out_file, 'a')
     fo.write('    Done at step %d\n'%step)
     fo.close()
+    report_progress(nascent_chain_length, 'minimizing')
     return (current_rnc_cor, current_rnc_velocities)
 
+# Frozen-environment interaction groups of the CG nonbonded force
+# ribo_nb_force: None or copy of the nonbonded force holding the nascent chain - ribosome pairs that are evaluated 
+# less often by the multiple time step integrator. Pairs between nascent chain and P-site tRNA stay in 
+# custom_nb_force, as the tRNA is bonded to the nascent chain.
+# ribo_shell_index: None or fixed ribosome atoms that can interact with the nascent chain (active shell)
+def add_frozen_env_groups(custom_nb_force, nc_atom_index, ribo_free_idx, ribo_fix_atom_index, sp_rst_idx, 
+    ribo_nb_force=None, PtR_atom_index=[], ribo_shell_index=None):
+    # A fixed number of groups independent of the nascent chain length.
+    # Pairs appearing in both sets of a group are computed only once and
+    # fixed-fixed ribosome pairs are never enumerated.
+    mobile_atom_index = ribo_free_idx + nc_atom_index
+    if ribo_nb_force is None and ribo_shell_index is None:
+        ribo_nb_force = custom_nb_force
+        # nascent chain / free ribosome atoms - fixed ribosome atoms
+        custom_nb_force.addInteractionGroup(ribo_fix_atom_index, mobile_atom_index)
+    else:
+        if ribo_nb_force is None:
+            ribo_nb_force = custom_nb_force
+        if ribo_shell_index is None:
+            ribo_shell_index = ribo_fix_atom_index
+        PtR_set = set(PtR_atom_index)
+        ribo_fix_PtR_index = [i for i in ribo_fix_atom_index if i in PtR_set]
+        ribo_fix_exclude_PtR_index = [i for i in ribo_shell_index if not i in PtR_set]
+        # free ribosome atoms - fixed ribosome atoms
+        if len(ribo_free_idx) > 0:
+            custom_nb_force.addInteractionGroup(ribo_fix_atom_index, ribo_free_idx)
+        # nascent chain - fixed P-site tRNA atoms
+        if len(ribo_fix_PtR_index) > 0:
+            custom_nb_force.addInteractionGroup(ribo_fix_PtR_index, nc_atom_index)
+        # nascent chain - other fixed ribosome atoms
+        ribo_nb_force.addInteractionGroup(ribo_fix_exclude_PtR_index, nc_atom_index)
+    # nascent chain - nascent chain
+    custom_nb_force.addInteractionGroup(nc_atom_index, nc_atom_index)
+    # free ribosome atoms - free ribosome atoms
+    if len(ribo_free_idx) > 1:
+        custom_nb_force.addInteractionGroup(ribo_free_idx, ribo_free_idx)
+    # nascent chain - free ribosome atoms (12-6 interactions for spherical restrained atoms are in a separate force)
+    sp_rst_set = set(sp_rst_idx)
+    ribo_free_exclude_sp_rst_index = [i for i in ribo_free_idx if not i in sp_rst_set]
+    if len(ribo_free_exclude_sp_rst_index) > 0:
+        ribo_nb_force.addInteractionGroup(nc_atom_index, ribo_free_exclude_sp_rst_index)
+# END Frozen-environment interaction groups of the CG nonbonded force
+
+# Load precomputed grid potential of the frozen ribosome created by gen_ribosome_grid.py
+def load_ribosome_grid(grid_file):
+    data = np.load(grid_file)
+    ribo_grid = {}
+    for key in data.files:
+        ribo_grid[key] = data[key]
+    # tabulated values are converted once and reused for every system
+    ribo_grid['phi_list'] = ribo_grid['phi'].ravel().tolist()
+    ribo_grid['basis_list'] = [g.ravel().tolist() for g in ribo_grid['basis']]
+    return ribo_grid
+# END Load precomputed grid potential of the frozen ribosome
+
+# Add grid potential of the frozen ribosome acting on mobile atoms
+def add_ribosome_grid_force(system, custom_nb_force, mobile_idx, ribo_grid):
+    global mts_steps
+    n_basis = ribo_grid['weights'].shape[1]
+    (nx, ny, nz) = [int(n) for n in ribo_grid['shape']]
+    grid_min = ribo_grid['origin']
+    grid_max = ribo_grid['origin'] + (ribo_grid['shape'] - 1) * ribo_grid['spacing']
+    energy = 'qg*phi(x1,y1,z1)'
+    for k in range(n_basis):
+        energy += '+w%d*g%d(x1,y1,z1)'%(k, k)
+    grid_force = CustomCompoundBondForce(1, energy)
+    grid_force.addPerBondParameter('qg')
+    for k in range(n_basis):
+        grid_force.addPerBondParameter('w%d'%k)
+    grid_force.addTabulatedFunction('phi', Continuous3DFunction(nx, ny, nz, ribo_grid['phi_list'],
+        grid_min[0], grid_max[0], grid_min[1], grid_max[1], grid_min[2], grid_max[2]))
+    for k in range(n_basis):
+        grid_force.addTabulatedFunction('g%d'%k, Continuous3DFunction(nx, ny, nz, ribo_grid['basis_list'][k],
+            grid_min[0], grid_max[0], grid_min[1], grid_max[1], grid_min[2], grid_max[2]))
+
+    param_name = [custom_nb_force.getPerParticleParameterName(i) for i in range(custom_nb_force.getNumPerParticleParameters())]
+    grid_param = []
+    for i in mobile_idx:
+        param = custom_nb_force.getParticleParameters(i)
+        ke = param[param_name.index('ke')]
+        kv = param[param_name.index('kv')]
+        ep = param[param_name.index('ep')]
+        ld = param[param_name.index('ld')]
+        charge = param[param_name.index('charge')]
+        index = int(param[param_name.index('index')])
+        if abs(ld - ribo_grid['ld']) > 1e-8 or not ribo_grid['weight_mask'][index]:
+            print('Error: parameters of atom %d are not covered by the ribosome grid. Please re-generate the grid.'%i)
+            sys.exit()
+        grid_param.append([ke*charge/ep] + list(kv*ribo_grid['weights'][index]))
+        grid_force.addBond([i], grid_param[-1])
+    if mts_steps > 1:
+        grid_force.setName('NCRiboForce')
+    system.addForce(grid_force)
+    return (grid_force, grid_param)
+# END Add grid potential of the frozen ribosome acting on mobile atoms
+
 # create system for elongation
 def create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, stage, nascent_chain_length, ribo_free_idx, sp_rst_idx):
     global nonbond_cutoff, switch_cutoff, x_eject, spherical_restraint_center, spherical_restraint_radius
+    global ribosome_grid, ribo_grid, rnc_index, mts_steps, active_shell
     try:
         system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
             nonbondedCutoff=nonbond_cutoff, constraints=AllBonds, removeCMMotion=False, 
@@ -693,16 +1740,8 @@ def create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, stage,
     custom_nb_force.setSwitchingDistance(switch_cutoff)
     # End set to use switching function explicitly for CG Custom Nonbond Force #
 
-    ribo_fix_atom_index = []
-    nc_atom_index = []
-    AtR_atom_index = []
-    for atom in top.atoms():
-        if (not atom.index in ribo_free_idx) and atom.residue.chain.id != 'A' and atom.residue.chain.id != 'AtR':
-            ribo_fix_atom_index.append(atom.index)
-        elif atom.residue.chain.id == 'A':
-            nc_atom_index.append(atom.index)
-        elif atom.residue.chain.id == 'AtR':
-            AtR_atom_index.append(atom.index)
+    segid = rnc_columns(rnc_index, nascent_chain_length)['segid']
+    (ribo_fix_atom_index, nc_atom_index, AtR_atom_index) = rnc_atom_groups(segid, ribo_free_idx)
     
     # hard copy of the custom nb force for 12-6 inter-molecular force
     custom_nb_force_copy = custom_nb_force.__copy__()
@@ -714,21 +1753,34 @@ def create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, stage,
     custom_nb_force_copy.setUseSwitchingFunction(False) # No switch
     custom_nb_force_copy.addInteractionGroup(nc_atom_index, sp_rst_idx)
     system.addForce(custom_nb_force_copy)
+
+    # nascent chain - ribosome interactions evaluated less often by the multiple time step integrator
+    if mts_steps > 1:
+        custom_nb_force_copy.setName('NCRiboForce')
+        ribo_nb_force = custom_nb_force.__copy__()
+        ribo_nb_force.setName('NCRiboForce')
+        system.addForce(ribo_nb_force)
+    else:
+        ribo_nb_force = None
     
+    # fixed ribosome atoms out of reach of the tethered nascent chain
+    if active_shell == 1 and stage <= 3:
+        (ribo_shell_index, radius) = calc_active_shell(ribo_fix_atom_index, nascent_chain_length)
+    else:
+        ribo_shell_index = None
+
     # turn off interactions among fixed ribosome atoms and 
     # 12-10-6 interactions between spherical restrained atoms and nascent chain atoms
-    custom_nb_force.addInteractionGroup(ribo_fix_atom_index, ribo_free_idx+nc_atom_index)
-    for i in range(len(ribo_free_idx)-1):
-        custom_nb_force.addInteractionGroup([ribo_free_idx[i]], ribo_free_idx[i+1:])
-    for i in range(len(nc_atom_index)-1):
-        custom_nb_force.addInteractionGroup([nc_atom_index[i]], nc_atom_index[i+1:])
-    ribo_free_exclude_sp_rst_index = [i for i in ribo_free_idx if not i in sp_rst_idx]
-    if len(ribo_free_exclude_sp_rst_index) > 0:
-        custom_nb_force.addInteractionGroup(nc_atom_index, ribo_free_exclude_sp_rst_index)
+    add_frozen_env_groups(custom_nb_force, nc_atom_index, ribo_free_idx, ribo_fix_atom_index, sp_rst_idx, 
+        ribo_nb_force, np.nonzero(segid == 'PtR')[0].tolist(), ribo_shell_index)
 
     if stage == 1 or stage == 2:
         custom_nb_force.addInteractionGroup(nc_atom_index, AtR_atom_index)
 
+    # frozen ribosome atoms represented by precomputed grid potential
+    if ribosome_grid != '':
+        add_ribosome_grid_force(system, custom_nb_force, nc_atom_index+ribo_free_idx, ribo_grid)
+
     # A-site resid 76 (last residue) ribose R 
     AtR_id76_R_index = 0
     for res in top.residues():
@@ -857,110 +1909,914 @@ def create_elongation_system(forcefield, rnc_psf_pmd, top, template_map, stage,
         # add bonds between new AA and P-site resid 76 ribose R
         hbf.addBond(nascent_chain_length-1, PtR_id76_R_index, d_R_N_P, bond_harmonic_force)
 
-        haf = HarmonicAngleForce()
-        # add Ep angle for new AA -- PtR:76@R -- PtR:76@P
-        haf.addAngle(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index-1, a_P_R_N_P, angle_harmonic_force)
-        # add Ep angle for new AA -- PtR:76@R -- PtR:76@PU2
-        haf.addAngle(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index+2, a_PU2_R_N_P, angle_harmonic_force)
-        system.addForce(haf)
+        haf = HarmonicAngleForce()
+        # add Ep angle for new AA -- PtR:76@R -- PtR:76@P
+        haf.addAngle(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index-1, a_P_R_N_P, angle_harmonic_force)
+        # add Ep angle for new AA -- PtR:76@R -- PtR:76@PU2
+        haf.addAngle(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index+2, a_PU2_R_N_P, angle_harmonic_force)
+        system.addForce(haf)
+
+        # add improper dihedral potential for new AA -- PtR:76@R -- PtR:76@P -- PtR:76@PU2
+        ctf.addTorsion(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index-1, PtR_id76_R_index+2, 
+            [improper_dihedral_force, di_N_R_P_PU2_P])
+
+        # add Ep angle for previous AA -- new AA -- PtR:76@R
+        if nascent_chain_length > 1:
+            caf.addAngle(nascent_chain_length-2, nascent_chain_length-1, PtR_id76_R_index, 
+                [106.4*kilocalories/mole/radian**2, 91.7*degree, 26.3*kilocalories/mole/radian**2, 
+                130*degree, 0.1*mole/kilocalories, 4.3*kilocalories/mole])
+        # add exclusion for NB between new AA and P-site resid 76 ribose R
+        custom_nb_force.addExclusion(nascent_chain_length-1, PtR_id76_R_index)
+        # add exclusion for NB between previous AA and P-site resid 76 ribose R
+        if nascent_chain_length > 1:
+            custom_nb_force.addExclusion(nascent_chain_length-2, PtR_id76_R_index)
+    elif stage == 5:
+        xref = (x_eject-2)*angstrom
+        k = 20*kilocalories/mole/angstroms**2
+        force_2 = CustomExternalForce("k*r^2; r=min(x-x0, 0)")
+        force_2.addPerParticleParameter("k")
+        force_2.addPerParticleParameter("x0")
+        for atom in top.atoms():
+            if atom.residue.chain.id == 'A':
+                force_2.addParticle(atom.index, [k, xref])
+        system.addForce(force_2)
+    
+    # add spherical restraint
+    k = 0.1*kilocalories/mole/angstroms**2
+    R0 = spherical_restraint_radius * angstrom
+    center_xyz = spherical_restraint_center * angstrom
+    # during dissociation the center is moved to the center of mass of the nascent chain by run_stage_md()
+    force = CustomExternalForce("k*dR^2; dR=max(R-R0, 0); R=sqrt((x-x0)^2+(y-y0)^2+(z-z0)^2);")
+    force.addGlobalParameter('k', k)
+    force.addGlobalParameter('R0', R0)
+    force.addGlobalParameter('x0', center_xyz[0])
+    force.addGlobalParameter('y0', center_xyz[1])
+    force.addGlobalParameter('z0', center_xyz[2])
+    for i in sp_rst_idx:
+        force.addParticle(i, [])
+    system.addForce(force)
+    
+    # add position restraints
+    force_7 = CustomExternalForce("k*((x-x0)^2+(y-y0)^2+(z-z0)^2)")
+    force_7.addPerParticleParameter("k")
+    force_7.addPerParticleParameter("x0")
+    force_7.addPerParticleParameter("y0")
+    force_7.addPerParticleParameter("z0")
+    system.addForce(force_7)
+    # END add position restraints
+    
+    # Remove ligand bond constraints
+    try:
+        rm_cons_LIG(system, rnc_psf_pmd, forcefield, top, template_map)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit()
+
+    return system
+# END create system for elongation
+
+# create persistent system of the full-length RNC
+# All stage-specific bonds, angles, torsions and non-bonded exclusions of every
+# nascent chain length are built into one system. They are switched on or off 
+# by set_persistent_stage() on a live context so that the system is created only 
+# once per trajectory. Residues that are not synthesized yet are "ghosts": they 
+# have no interactions and are parked far away from the ribosome. Nascent chain 
+# bonds are constrained as in create_elongation_system(); the constraint of a new 
+# bond is added in stage 3 of its codon, which reinitializes the context.
+def create_persistent_system(forcefield, rnc_psf_pmd, top, template_map, ribo_free_idx, sp_rst_idx):
+    global nonbond_cutoff, switch_cutoff, x_eject, spherical_restraint_center, spherical_restraint_radius
+    global ribosome_grid, ribo_grid, rnc_index, mts_steps
+    try:
+        system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
+            nonbondedCutoff=nonbond_cutoff, constraints=AllBonds, removeCMMotion=False, 
+            ignoreExternalBonds=True, residueTemplates=template_map)
+    except Exception as e:
+        traceback.print_exc()
+        return False
+    # must set to use switching function explicitly for CG Custom Nonbond Force #
+    for force in system.getForces():
+        if force.getName() == 'CustomNonbondedForce':
+            custom_nb_force = force
+            break
+    custom_nb_force.setUseSwitchingFunction(True)
+    custom_nb_force.setSwitchingDistance(switch_cutoff)
+    # End set to use switching function explicitly for CG Custom Nonbond Force #
+
+    # the persistent system always holds the full-length RNC
+    segid = rnc_index['columns']['segid']
+    (ribo_fix_atom_index, nc_atom_index, AtR_atom_index) = rnc_atom_groups(segid, ribo_free_idx)
+    nc_length = len(nc_atom_index)
+
+    # A-site resid 76 (last residue) ribose R 
+    AtR_id76_R_index = 0
+    for res in top.residues():
+        if res.chain.id == 'AtR':
+            AtR_id76_res = res
+    for atom in AtR_id76_res.atoms():
+        if atom.name == 'R':
+            AtR_id76_R_index = atom.index
+
+    # P-site resid 76 (last residue) ribose R 
+    PtR_id76_R_index = 0
+    for res in top.residues():
+        if res.chain.id == 'PtR':
+            PtR_id76_res = res
+    for atom in PtR_id76_res.atoms():
+        if atom.name == 'R':
+            PtR_id76_R_index = atom.index
+
+    # FF parameters for bond interaction between tRNA and nascent chain
+    bond_harmonic_force = 200*kilocalories/mole/angstroms**2
+    angle_harmonic_force = 25*kilocalories/mole/radian**2
+    improper_dihedral_force = 25*kilocalories/mole/radian**2
+    d_R_N_A = 4.27*angstroms
+    d_R_N_P = 4.76*angstroms
+    a_PU2_R_N_A = 127*degree
+    a_PU2_R_N_P = 130*degree
+    a_P_R_N_A = 106*degree
+    a_P_R_N_P = 117*degree
+    di_N_R_P_PU2_A = 128*degree
+    di_N_R_P_PU2_P = -161*degree
+    caf_R_param = [106.4*kilocalories/mole/radian**2, 91.7*degree, 26.3*kilocalories/mole/radian**2, 
+                   130*degree, 0.1*mole/kilocalories, 4.3*kilocalories/mole]
+    caf_off_param = [0.0, 0.0, 0.0, 0.0, 1e10, 0.0]
+    # END FF parameters for bond interaction between tRNA and nascent chain
+
+    for force in system.getForces():
+        if force.getName() == 'HarmonicBondForce':
+            hbf = force
+        elif force.getName() == 'CustomAngleForce':
+            caf = force
+        elif force.getName() == 'PeriodicTorsionForce':
+            ptf = force
+        elif force.getName() == 'CustomTorsionForce':
+            ctf = force
+
+    # Each switchable term is stored as [force, setter, parameters when on, parameters when off, state].
+    # terms[family][i] is the list of terms in the family whose last nascent chain residue is i (0-based).
+    families = ['nc_angle', 'nc_torsion', 'pep_bond', 'AtR_bond', 'PtR_bond', 'AtR_angle', 'PtR_angle', 
+                'AtR_torsion', 'PtR_torsion', 'AtR_caf', 'PtR_caf', 'nc_pair_12', 'nc_pair_13', 'AtR_pair', 'PtR_pair']
+    terms = {}
+    for fm in families:
+        terms[fm] = [[] for i in range(nc_length)]
+
+    # Nascent chain bonds are constraints as in create_elongation_system(). They are taken out here and added back 
+    # by set_persistent_constraints() as residues join the chain, since the bond of the new residue must not be 
+    # constrained in stages 1 and 2. nc_constraints[i] holds the constraints whose last residue is i.
+    nc_constraints = [[] for i in range(nc_length)]
+    for i in reversed(range(system.getNumConstraints())):
+        (p1, p2, d) = system.getConstraintParameters(i)
+        if p1 < nc_length and p2 < nc_length:
+            system.removeConstraint(i)
+            nc_constraints[max(p1, p2)].insert(0, (p1, p2, d))
+    for i in range(caf.getNumAngles()):
+        (p1, p2, p3, param) = caf.getAngleParameters(i)
+        if max(p1, p2, p3) < nc_length:
+            terms['nc_angle'][max(p1, p2, p3)].append([caf, 'setAngleParameters', (i, p1, p2, p3, list(param)), 
+                (i, p1, p2, p3, caf_off_param), 1])
+    for i in range(ptf.getNumTorsions()):
+        (p1, p2, p3, p4, periodicity, phase, k) = ptf.getTorsionParameters(i)
+        if max(p1, p2, p3, p4) < nc_length:
+            terms['nc_torsion'][max(p1, p2, p3, p4)].append([ptf, 'setTorsionParameters', 
+                (i, p1, p2, p3, p4, periodicity, phase, k), (i, p1, p2, p3, p4, periodicity, phase, 0), 1])
+
+    # bonds, angles and improper dihedrals between nascent chain residues and tRNA
+    haf = HarmonicAngleForce()
+    system.addForce(haf)
+    for i in range(nc_length):
+        if i > 0:
+            idx = hbf.addBond(i-1, i, 3.81*angstroms, 0)
+            terms['pep_bond'][i].append([hbf, 'setBondParameters', (idx, i-1, i, 3.81*angstroms, bond_harmonic_force), 
+                (idx, i-1, i, 3.81*angstroms, 0), 0])
+        for (tRNA, R, d, a_P, a_PU2, di) in [('AtR', AtR_id76_R_index, d_R_N_A, a_P_R_N_A, a_PU2_R_N_A, di_N_R_P_PU2_A), 
+                                             ('PtR', PtR_id76_R_index, d_R_N_P, a_P_R_N_P, a_PU2_R_N_P, di_N_R_P_PU2_P)]:
+            idx = hbf.addBond(i, R, d, 0)
+            terms[tRNA+'_bond'][i].append([hbf, 'setBondParameters', (idx, i, R, d, bond_harmonic_force), 
+                (idx, i, R, d, 0), 0])
+            idx = haf.addAngle(i, R, R-1, a_P, 0)
+            terms[tRNA+'_angle'][i].append([haf, 'setAngleParameters', (idx, i, R, R-1, a_P, angle_harmonic_force), 
+                (idx, i, R, R-1, a_P, 0), 0])
+            idx = haf.addAngle(i, R, R+2, a_PU2, 0)
+            terms[tRNA+'_angle'][i].append([haf, 'setAngleParameters', (idx, i, R, R+2, a_PU2, angle_harmonic_force), 
+                (idx, i, R, R+2, a_PU2, 0), 0])
+            idx = ctf.addTorsion(i, R, R-1, R+2, [0, di])
+            terms[tRNA+'_torsion'][i].append([ctf, 'setTorsionParameters', (idx, i, R, R-1, R+2, [improper_dihedral_force, di]), 
+                (idx, i, R, R-1, R+2, [0, di]), 0])
+            if i > 0:
+                idx = caf.addAngle(i-1, i, R, caf_off_param)
+                terms[tRNA+'_caf'][i].append([caf, 'setAngleParameters', (idx, i-1, i, R, caf_R_param), 
+                    (idx, i-1, i, R, caf_off_param), 0])
+
+    # Non-bonded pairs between nascent chain and tRNA 76@R are always excluded. Together with the 
+    # 1-2 and 1-3 exclusions within the nascent chain, they are turned back on by a compensating 
+    # bond force when the stage requires the non-bonded interaction.
+    for i in range(nc_length):
+        custom_nb_force.addExclusion(i, AtR_id76_R_index)
+        custom_nb_force.addExclusion(i, PtR_id76_R_index)
+    nb_energy = custom_nb_force.getEnergyFunction().split(';')
+    nb_param_name = [custom_nb_force.getPerParticleParameterName(i) for i in range(custom_nb_force.getNumPerParticleParameters())]
+    rc = nonbond_cutoff.value_in_unit(nanometer)
+    rs = switch_cutoff.value_in_unit(nanometer)
+    pair_force = CustomCompoundBondForce(2, 'on*sw*('+nb_energy[0]+'); sw=step(rc-r)*(1-step(r-rs)*(10*x^3-15*x^4+6*x^5)); '+
+                                         'x=(r-rs)/(rc-rs); r=distance(p1, p2); rc=%.6f; rs=%.6f;'%(rc, rs)+';'.join(nb_energy[1:]))
+    pair_force.addPerBondParameter('on')
+    for name in nb_param_name:
+        pair_force.addPerBondParameter(name+'1')
+        pair_force.addPerBondParameter(name+'2')
+    for i in range(custom_nb_force.getNumTabulatedFunctions()):
+        (xsize, ysize, values) = custom_nb_force.getTabulatedFunction(i).getFunctionParameters()
+        pair_force.addTabulatedFunction(custom_nb_force.getTabulatedFunctionName(i), Discrete2DFunction(xsize, ysize, values))
+    for i in range(nc_length):
+        pair_list = [('AtR_pair', AtR_id76_R_index), ('PtR_pair', PtR_id76_R_index)]
+        if i > 0:
+            pair_list.append(('nc_pair_12', i-1))
+        if i > 1:
+            pair_list.append(('nc_pair_13', i-2))
+        for (fm, j) in pair_list:
+            param_i = custom_nb_force.getParticleParameters(i)
+            param_j = custom_nb_force.getParticleParameters(j)
+            param = [0]
+            for k in range(len(nb_param_name)):
+                param += [param_i[k], param_j[k]]
+            idx = pair_force.addBond([i, j], param)
+            terms[fm][i].append([pair_force, 'setBondParameters', (idx, [i, j], [1]+param[1:]), (idx, [i, j], param), 0])
+    system.addForce(pair_force)
+
+    # hard copy of the custom nb force for 12-6 inter-molecular force
+    custom_nb_force_copy = custom_nb_force.__copy__()
+    # Add LJ 12-6 interactions between spherical restrained atoms and nascent chain atoms
+    custom_nb_force_copy.setEnergyFunction('ke*charge1*charge2/ep/r*exp(-r/ld)+kv*(a/13/r^12 - c/2/r^6); '+
+                                           'ke=ke1*ke2; ep=ep1*ep2; ld=ld1*ld2; kv=kv1*kv2; '+
+                                           'a=acoef(index1, index2); c=ccoef(index1, index2)')
+    custom_nb_force_copy.setNonbondedMethod(0) # No cutoff
+    custom_nb_force_copy.setUseSwitchingFunction(False) # No switch
+    custom_nb_force_copy.addInteractionGroup(nc_atom_index, sp_rst_idx)
+    system.addForce(custom_nb_force_copy)
+
+    # interactions between nascent chain and A-site tRNA, scaled by lambda_AtR 
+    custom_nb_force_AtR = custom_nb_force.__copy__()
+    custom_nb_force_AtR.setEnergyFunction('lambda_AtR*('+nb_energy[0]+');'+';'.join(nb_energy[1:]))
+    custom_nb_force_AtR.addGlobalParameter('lambda_AtR', 1)
+    custom_nb_force_AtR.addInteractionGroup(nc_atom_index, AtR_atom_index)
+    system.addForce(custom_nb_force_AtR)
+
+    # nascent chain - ribosome interactions evaluated less often by the multiple time step integrator
+    nb_forces = [custom_nb_force, custom_nb_force_copy, custom_nb_force_AtR]
+    if mts_steps > 1:
+        custom_nb_force_copy.setName('NCRiboForce')
+        ribo_nb_force = custom_nb_force.__copy__()
+        ribo_nb_force.setName('NCRiboForce')
+        system.addForce(ribo_nb_force)
+        nb_forces.append(ribo_nb_force)
+    else:
+        ribo_nb_force = None
+
+    # turn off interactions among fixed ribosome atoms and 
+    # 12-10-6 interactions between spherical restrained atoms and nascent chain atoms
+    add_frozen_env_groups(custom_nb_force, nc_atom_index, ribo_free_idx, ribo_fix_atom_index, sp_rst_idx, 
+        ribo_nb_force, np.nonzero(segid == 'PtR')[0].tolist())
+
+    # frozen ribosome atoms represented by precomputed grid potential
+    if ribosome_grid != '':
+        (grid_force, grid_param) = add_ribosome_grid_force(system, custom_nb_force, nc_atom_index+ribo_free_idx, ribo_grid)
+    else:
+        (grid_force, grid_param) = (None, [])
+
+    # push nascent chain away from the exit tunnel during dissociation (k_push > 0 in stage 5 only)
+    force_2 = CustomExternalForce("k_push*r^2; r=min(x-x_push, 0)")
+    force_2.addGlobalParameter("k_push", 0)
+    force_2.addGlobalParameter("x_push", (x_eject-2)*angstrom)
+    for i in nc_atom_index:
+        force_2.addParticle(i, [])
+    system.addForce(force_2)
+
+    # add spherical restraint
+    # the sphere is centered at spherical_restraint_center before dissociation; during dissociation the center is 
+    # moved to the center of mass of the nascent chain by run_stage_md()
+    k = 0.1*kilocalories/mole/angstroms**2
+    R0 = spherical_restraint_radius * angstrom
+    center_xyz = spherical_restraint_center * angstrom
+    force = CustomExternalForce("k*dR^2; dR=max(R-R0, 0); R=sqrt((x-x0)^2+(y-y0)^2+(z-z0)^2);")
+    force.addGlobalParameter('k', k)
+    force.addGlobalParameter('R0', R0)
+    force.addGlobalParameter('x0', center_xyz[0])
+    force.addGlobalParameter('y0', center_xyz[1])
+    force.addGlobalParameter('z0', center_xyz[2])
+    for i in sp_rst_idx:
+        force.addParticle(i, [])
+    system.addForce(force)
+
+    # position restraints to park ghost residues and to hold atoms during minimization
+    hold_force = CustomExternalForce("k_hold*((x-x_hold)^2+(y-y_hold)^2+(z-z_hold)^2)")
+    hold_force.addPerParticleParameter("k_hold")
+    hold_force.addPerParticleParameter("x_hold")
+    hold_force.addPerParticleParameter("y_hold")
+    hold_force.addPerParticleParameter("z_hold")
+    park_coor = np.zeros((nc_length, 3))
+    n_side = math.ceil(nc_length**(1/3))
+    for i in range(nc_length):
+        # cubic lattice with 25 A spacing (> nonbond cutoff) far behind the ribosome
+        park_coor[i] = np.array([-500-25*(i//n_side**2), 25*((i//n_side)%n_side), 25*(i%n_side)])
+        hold_force.addParticle(i, [0, park_coor[i][0]/10, park_coor[i][1]/10, park_coor[i][2]/10])
+    for i in ribo_free_idx:
+        hold_force.addParticle(i, [0, 0, 0, 0])
+    system.addForce(hold_force)
+    # END position restraints
+
+    # fix ribosome atoms not in the free part
+    is_free = np.zeros(len(segid), dtype=bool)
+    is_free[ribo_free_idx] = True
+    for i in np.nonzero((segid != 'A') & np.logical_not(is_free))[0]:
+        system.setParticleMass(int(i), 0*dalton)
+    rm_cons_0_mass(system)
+
+    # Remove ligand bond constraints
+    try:
+        rm_cons_LIG(system, rnc_psf_pmd, forcefield, top, template_map)
+    except Exception as e:
+        traceback.print_exc()
+        sys.exit()
+
+    rnc_sys = {}
+    rnc_sys['system'] = system
+    rnc_sys['terms'] = terms
+    rnc_sys['nc_constraints'] = nc_constraints
+    rnc_sys['n_constrained'] = 0
+    rnc_sys['nb_forces'] = nb_forces
+    rnc_sys['nb_param'] = [custom_nb_force.getParticleParameters(i) for i in range(nc_length)]
+    # per particle parameters set to 0 for ghost residues
+    rnc_sys['nb_ghost_param'] = [nb_param_name.index('ke'), nb_param_name.index('kv')]
+    rnc_sys['hold_force'] = hold_force
+    rnc_sys['park_coor'] = park_coor
+    rnc_sys['nc_length'] = nc_length
+    rnc_sys['AtR_id76_R_index'] = AtR_id76_R_index
+    rnc_sys['ribo_free_idx'] = ribo_free_idx
+    rnc_sys['grid_force'] = grid_force
+    rnc_sys['grid_param'] = grid_param
+    rnc_sys['current_length'] = nc_length
+    # all nascent chain residues start as ghosts
+    set_persistent_length(rnc_sys, 0, None)
+    return rnc_sys
+# END create persistent system of the full-length RNC
+
+# turn nascent chain residues >= nascent_chain_length into ghosts and the others into real residues
+def set_persistent_length(rnc_sys, nascent_chain_length, context):
+    k_park = 10*kilocalories/mole/angstroms**2
+    if nascent_chain_length == rnc_sys['current_length']:
+        return
+    i_start = min(nascent_chain_length, rnc_sys['current_length'])
+    i_end = max(nascent_chain_length, rnc_sys['current_length'])
+    for i in range(i_start, i_end):
+        param = list(rnc_sys['nb_param'][i])
+        if i < nascent_chain_length:
+            k = 0
+        else:
+            k = k_park
+            for j in rnc_sys['nb_ghost_param']:
+                param[j] = 0
+        for force in rnc_sys['nb_forces']:
+            force.setParticleParameters(i, param)
+        if rnc_sys['grid_force'] != None:
+            if i < nascent_chain_length:
+                rnc_sys['grid_force'].setBondParameters(i, [i], rnc_sys['grid_param'][i])
+            else:
+                rnc_sys['grid_force'].setBondParameters(i, [i], [0]*len(rnc_sys['grid_param'][i]))
+        park = rnc_sys['park_coor'][i]/10
+        rnc_sys['hold_force'].setParticleParameters(i, i, [k, park[0], park[1], park[2]])
+    if context != None:
+        for force in rnc_sys['nb_forces']:
+            force.updateParametersInContext(context)
+        if rnc_sys['grid_force'] != None:
+            rnc_sys['grid_force'].updateParametersInContext(context)
+        rnc_sys['hold_force'].updateParametersInContext(context)
+    rnc_sys['current_length'] = nascent_chain_length
+
+# constrain the nascent chain bonds of the first n_residue residues of the persistent system
+# Constraints cannot be switched on a live context, so the context is reinitialized when they change, which happens 
+# once per codon (stage 3). Constraints of the nascent chain are always the last ones of the system.
+def set_persistent_constraints(rnc_sys, n_residue, context):
+    global constraint_tolerance
+    system = rnc_sys['system']
+    n_old = rnc_sys['n_constrained']
+    if n_residue == n_old:
+        return
+    for i in range(n_old, n_residue):
+        for (p1, p2, d) in rnc_sys['nc_constraints'][i]:
+            system.addConstraint(p1, p2, d)
+    for i in reversed(range(n_residue, n_old)):
+        for j in range(len(rnc_sys['nc_constraints'][i])):
+            system.removeConstraint(system.getNumConstraints()-1)
+    rnc_sys['n_constrained'] = n_residue
+    if context != None:
+        context.reinitialize(preserveState=True)
+        context.applyConstraints(constraint_tolerance)
+        context.applyVelocityConstraints(constraint_tolerance)
+
+# switch bonded terms and non-bonded exclusions of the persistent system to the given stage
+def set_persistent_stage(rnc_sys, stage, nascent_chain_length, context):
+    global spherical_restraint_center
+    N = nascent_chain_length
+    set_persistent_length(rnc_sys, N, context)
+    # the bond between the new AA and the previous AA is only constrained after peptide bond formation
+    if stage == 1 or stage == 2:
+        set_persistent_constraints(rnc_sys, N-1, context)
+    else:
+        set_persistent_constraints(rnc_sys, N, context)
+
+    on_set = set()
+    for i in range(N):
+        on_set.add(('nc_angle', i))
+        on_set.add(('nc_torsion', i))
+    AtR_exclude = []
+    PtR_exclude = []
+    if stage == 1:
+        # no bond, angle, dihedral energy term involving new AA within nascent chain
+        on_set.discard(('nc_angle', N-1))
+        on_set.discard(('nc_torsion', N-1))
+        # NB interactions between new AA and adjacent AA
+        on_set.add(('nc_pair_12', N-1))
+        on_set.add(('nc_pair_13', N-1))
+        on_set.add(('AtR_bond', N-1))
+        on_set.add(('AtR_angle', N-1))
+        on_set.add(('AtR_torsion', N-1))
+        if N > 1:
+            on_set.add(('PtR_bond', N-2))
+            on_set.add(('PtR_angle', N-2))
+            on_set.add(('PtR_torsion', N-2))
+            on_set.add(('PtR_caf', N-2))
+        AtR_exclude = [N-1]
+        PtR_exclude = [N-2, N-3]
+    elif stage == 2:
+        on_set.add(('pep_bond', N-1))
+        on_set.add(('AtR_bond', N-1))
+        on_set.add(('AtR_angle', N-1))
+        on_set.add(('AtR_torsion', N-1))
+        on_set.add(('AtR_caf', N-1))
+        AtR_exclude = [N-1, N-2]
+    elif stage == 3:
+        on_set.add(('PtR_bond', N-1))
+        on_set.add(('PtR_angle', N-1))
+        on_set.add(('PtR_torsion', N-1))
+        on_set.add(('PtR_caf', N-1))
+        PtR_exclude = [N-1, N-2]
+    for i in range(N):
+        if (stage == 1 or stage == 2) and not i in AtR_exclude:
+            on_set.add(('AtR_pair', i))
+        if not i in PtR_exclude:
+            on_set.add(('PtR_pair', i))
+
+    changed_force = []
+    for fm, term_list in rnc_sys['terms'].items():
+        for i, terms in enumerate(term_list):
+            state = int((fm, i) in on_set)
+            for term in terms:
+                if term[4] != state:
+                    getattr(term[0], term[1])(*term[3-state])
+                    term[4] = state
+                    if not term[0] in changed_force:
+                        changed_force.append(term[0])
+    for force in changed_force:
+        force.updateParametersInContext(context)
+
+    if stage == 1 or stage == 2:
+        context.setParameter('lambda_AtR', 1)
+    else:
+        context.setParameter('lambda_AtR', 0)
+    if stage == 5:
+        context.setParameter('k_push', 20*kilocalories/mole/angstroms**2)
+    else:
+        context.setParameter('k_push', 0)
+        # move the spherical restraint back from the nascent chain of the last dissociation
+        center_xyz = spherical_restraint_center * angstrom
+        context.setParameter('x0', center_xyz[0])
+        context.setParameter('y0', center_xyz[1])
+        context.setParameter('z0', center_xyz[2])
+
+# hold atoms at the given positions (used to fix atoms during minimization)
+def hold_persistent_atoms(rnc_sys, hold_idx, positions, context):
+    k_hold = 1e4*kilocalories/mole/angstroms**2
+    hold_force = rnc_sys['hold_force']
+    for i in range(hold_force.getNumParticles()):
+        (atom_idx, param) = hold_force.getParticleParameters(i)
+        if atom_idx < rnc_sys['nc_length'] and atom_idx >= rnc_sys['current_length']:
+            # ghost residue
+            continue
+        if atom_idx in hold_idx:
+            coor = positions[atom_idx].value_in_unit(nanometer)
+            hold_force.setParticleParameters(i, atom_idx, [k_hold, coor[0], coor[1], coor[2]])
+        else:
+            hold_force.setParticleParameters(i, atom_idx, [0, 0, 0, 0])
+    hold_force.updateParametersInContext(context)
+
+# build the persistent RNC system and simulation object for one trajectory
+def create_persistent_rnc(prot_psf, ribo_psf, total_nascent_chain_length, out_file, platform, properties, rand):
+    global temp_prod, fbsolu, timestep, constraint_tolerance, forcefield, rnc_index
+
+    rnc_psf_pmd = slice_rnc_psf(rnc_index, total_nascent_chain_length)
+    top = rnc_psf_pmd.topology
+
+    ribo_free_idx = rnc_mask_index(rnc_index, 'ribo_free_idx', total_nascent_chain_length)
+    sp_rst_idx = rnc_mask_index(rnc_index, 'sp_rst_idx', total_nascent_chain_length)
+
+    # build residue template map
+    template_map = {}
+    for chain in top.chains():
+        for res in chain.residues():
+            template_map[res] = res.name
+
+    fo = open(out_file, 'a')
+    fo.write('--> Create persistent system for nascent chain length up to %d\n'%total_nascent_chain_length)
+    fo.close()
+    rnc_sys = create_persistent_system(forcefield, rnc_psf_pmd, top, template_map, ribo_free_idx, sp_rst_idx)
+    if rnc_sys == False:
+        return False
+    system = rnc_sys['system']
+    forcegroups = forcegroupify(system)
+    (integrator, forcegroups) = create_md_integrator(system, forcegroups, rand)
+    # Attempt of creating the simulation object (sometimes fail due to CUDA environment)
+    i_attempt = 0
+    while True:
+        try:
+            simulation = Simulation(top, system, integrator, platform, properties)
+        except Exception as e:
+            print('Error occurred at attempt %d...'%(i_attempt+1))
+            traceback.print_exc()
+            i_attempt += 1
+            continue
+        else:
+            break
+    fo = open(out_file, 'a')
+    fo.write('    Done\n')
+    fo.close()
+
+    rnc_sys['simulation'] = simulation
+    rnc_sys['forcegroups'] = forcegroups
+    rnc_sys['top'] = top
+    rnc_sys['seed'] = rand
+    # the context holds no structure of the trajectory yet
+    rnc_sys['new_context'] = True
+    return rnc_sys
+# END build the persistent RNC system
+
+# elongation of one codon on the persistent RNC system
+# resume: stage checkpoint of this codon to continue from (run all stages if None)
+def elongation_persistent(rnc_sys, nascent_chain_length, prot_psf, ribo_psf, previous_rnc_cor, simulation_steps, 
+    out_file, properties, resume=None):
+    global rnc_index, spherical_restraint_mask, spherical_restraint_center, spherical_restraint_radius
+
+    nc_length = rnc_sys['nc_length']
+    simulation = rnc_sys['simulation']
+    n_atom = rnc_sys['system'].getNumParticles()
+
+    rnc_psf_pmd = slice_rnc_psf(rnc_index, nascent_chain_length)
+    rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'.psf', overwrite=True)
+    formate_psf_vmd('rnc_l'+str(nascent_chain_length)+'.psf')
+    # atoms of the persistent system that exist in the RNC of current length
+    save_idx = list(range(nascent_chain_length)) + list(range(nc_length, n_atom))
+
+    ribo_free_idx = [i-nc_length+nascent_chain_length for i in rnc_sys['ribo_free_idx']]
+    fo = open(out_file, 'a')
+    if ribo_free_idx == []:
+        fo.write('    Free atom index: None\n')
+    else:
+        n_col = 10
+        n_row = math.ceil(len(ribo_free_idx) / n_col)
+        fo.write('    Free atom index:\n')
+        for i in range(n_row):
+            fo.write(' '*20)
+            for j in range(i*n_col, min((i+1)*n_col, len(ribo_free_idx))):
+                fo.write('%5d '%ribo_free_idx[j])
+            fo.write('\n')
+    if spherical_restraint_mask == '':
+        fo.write('    Spherical restraint: None\n')
+    else:
+        fo.write('    Spherical restraint: Center %s; Radius %.4f\n'%(str(spherical_restraint_center), spherical_restraint_radius))
+    fo.close()
+
+    # positions of a resumed stage are restored from the stage checkpoint
+    if resume == None:
+        if type(previous_rnc_cor) != str and not rnc_sys['new_context']:
+            # continue from the state of the previous codon in the context
+            current_rnc_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True).value_in_unit(nanometer)
+        else:
+            # a new context (e.g. the trajectory moved to another worker) starts from the structure of the previous 
+            # codon, either in memory or in a file
+            if type(previous_rnc_cor) == str:
+                previous_rnc_cor = load_rnc_cor(previous_rnc_cor)
+            previous_rnc_cor = np.array(previous_rnc_cor.value_in_unit(nanometer))
+            current_rnc_cor = np.zeros((n_atom, 3))
+            current_rnc_cor[:nc_length] = rnc_sys['park_coor']/10
+            current_rnc_cor[:nascent_chain_length-1] = previous_rnc_cor[:nascent_chain_length-1]
+            current_rnc_cor[nc_length:] = previous_rnc_cor[nascent_chain_length-1:]
+            set_persistent_length(rnc_sys, nascent_chain_length-1, simulation.context)
+
+        # add new amino acid bead to RNC next to A-site resid 76 ribose R 
+        alpha = 10*degree
+        current_rnc_cor[nascent_chain_length-1] = current_rnc_cor[rnc_sys['AtR_id76_R_index']] + np.array([
+            math.cos(alpha.value_in_unit(radian)), math.sin(alpha.value_in_unit(radian)), 0], dtype=np.float64) * 0.427
+        simulation.context.setPositions(current_rnc_cor*nanometer)
+    rnc_sys['new_context'] = False
+
+    for stage in [1, 2, 3]:
+        if resume != None and stage < resume['stage']:
+            continue
+        if resume != None and stage == resume['stage']:
+            stage_resume = resume
+        else:
+            stage_resume = None
+        if not run_persistent_stage(rnc_sys, rnc_psf_pmd, stage, nascent_chain_length, simulation_steps[stage-1], 
+            save_idx, out_file, properties, stage_resume):
+            return False
+
+    if nascent_chain_length == len(prot_psf.residues):
+        if resume == None or resume['stage'] <= 3:
+            fo = open(out_file, 'a')
+            fo.write('--> Elongation finished at length %d\n'%nascent_chain_length)
+            fo.write('#'*92 + '\n')
+            fo.write('--> Elongation termination at length %d\n'%nascent_chain_length)
+            fo.write('--> Nascent chain ejection with random seed %d\n'%(rnc_sys['seed']))
+            fo.close()
+        if resume == None or resume['stage'] <= 4:
+            if resume != None and resume['stage'] == 4:
+                stage_resume = resume
+            else:
+                stage_resume = None
+            if not run_persistent_stage(rnc_sys, rnc_psf_pmd, 4, nascent_chain_length, simulation_steps[2], save_idx, 
+                out_file, properties, stage_resume):
+                return False
+            fo = open(out_file, 'a')
+            fo.write('--> Nascent chain dissociation with random seed %d\n'%(rnc_sys['seed']))
+            fo.close()
+        if resume != None and resume['stage'] == 5:
+            stage_resume = resume
+        else:
+            stage_resume = None
+        if not run_persistent_stage(rnc_sys, rnc_psf_pmd, 5, nascent_chain_length, simulation_steps[2], save_idx, 
+            out_file, properties, stage_resume):
+            return False
+
+    return simulation.context.getState(getPositions=True).getPositions(asNumpy=True)[save_idx]
+
+# run one stage on the persistent RNC system
+# resume: stage checkpoint of this stage to continue from (minimize and start from step 0 if None)
+def run_persistent_stage(rnc_sys, rnc_psf_pmd, stage, nascent_chain_length, simulation_steps, save_idx, out_file, properties, 
+    resume=None):
+    global temp_prod, use_gpu, save_stage_structures
+    stage_name = {1: 'A-site tRNA binding', 2: 'peptide bond formation', 3: 'A-site tRNA translocation'}
+
+    simulation = rnc_sys['simulation']
+    system = rnc_sys['system']
+    forcegroups = rnc_sys['forcegroups']
+
+    if resume != None:
+        # continue the MD of the checkpointed stage without minimization
+        set_persistent_stage(rnc_sys, stage, nascent_chain_length, simulation.context)
+        hold_persistent_atoms(rnc_sys, set(), None, simulation.context)
+    elif stage <= 3:
+        fo = open(out_file, 'a')
+        fo.write('--> Update system for %s\n'%stage_name[stage])
+        set_persistent_stage(rnc_sys, stage, nascent_chain_length, simulation.context)
+        fo.write('    Done\n')
+        fo.close()
+
+        # fix everything other than the C-terminal 15 residues of the nascent chain
+        current_rnc_cor = simulation.context.getState(getPositions=True).getPositions()
+        hold_idx = set(list(range(nascent_chain_length-15)) + rnc_sys['ribo_free_idx'])
+        hold_persistent_atoms(rnc_sys, hold_idx, current_rnc_cor, simulation.context)
+
+        energy = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilocalorie/mole)
+        fo = open(out_file, 'a')
+        fo.write('    Potential energy before minimization: %.4f kcal/mol\n'%(energy))
+        fo.close()
+        try:
+            simulation.minimizeEnergy(tolerance=1*kilojoule/mole)
+        except Exception as e:
+            fo = open(out_file, 'a')
+            fo.write("Error: crashed at min%d\n"%stage)
+            fo.write(str(e)+'\n')
+            getEnergyDecomposition(fo, simulation.context, forcegroups)
+            current_rnc_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+            rnc_psf_pmd.positions = current_rnc_cor[save_idx]
+            rnc_psf_pmd.save('rnc_l'+str(nascent_chain_length)+'_crashed_min%d.cor'%stage, format='charmmcrd', overwrite=True)
+            fo.close()
+            return False
+        # release the atoms held for minimization
+        hold_persistent_atoms(rnc_sys, set(), current_rnc_cor, simulation.context)
+        energy = simulation.context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilocalorie/mole)
+        fo = open(out_file, 'a')
+        fo.write('    Potential energy after minimization: %.4f kcal/mol\n'%(energy))
+        getEnergyDecomposition(fo, simulation.context, forcegroups)
+        fo.close()
+        if save_stage_structures == 1:
+            current_rnc_cor = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+            rnc_psf_pmd.positions = current_rnc_cor[save_idx]
+            rnc_psf_pmd.write_pdb('rnc_l'+str(nascent_chain_length)+'_min_%d.pdb'%stage, charmm=True)
+        simulation.context.setVelocitiesToTemperature(temp_prod)
+    else:
+        set_persistent_stage(rnc_sys, stage, nascent_chain_length, simulation.context)
+
+    fo = open(out_file, 'a')
+    if use_gpu == 0:
+        fo.write('    Running MD on %d CPUs with random seed %d\n'%(int(properties['Threads']), rnc_sys['seed']))
+    else:
+        fo.write('    Running MD on GPUs with random seed %d\n'%(rnc_sys['seed']))
+    fo.close()
+
+    simulation.currentStep = 0
+    mobile_idx = list(range(nascent_chain_length)) + rnc_sys['ribo_free_idx']
+    dof = 3*len(mobile_idx) - system.getNumConstraints()
+    (current_rnc_cor, current_rnc_velocities) = run_stage_md(simulation, system, rnc_sys['top'], nascent_chain_length, 
+        rnc_psf_pmd, out_file, stage, simulation_steps, forcegroups, dof, save_idx, mobile_idx, resume)
+    if current_rnc_cor == False:
+        return False
+    return True
+# END elongation on the persistent RNC system
+
+# DCD reporter that only writes a subset of atoms
+class SubsetDCDReporter(object):
+    def __init__(self, file, reportInterval, atom_index, topology, append=False):
+        self._reportInterval = reportInterval
+        self._atom_index = atom_index
+        self._topology = topology
+        self._append = append
+        if append:
+            self._out = open(file, 'r+b')
+        else:
+            self._out = open(file, 'wb')
+        self._dcd = None
 
-        # add improper dihedral potential for new AA -- PtR:76@R -- PtR:76@P -- PtR:76@PU2
-        ctf.addTorsion(nascent_chain_length-1, PtR_id76_R_index, PtR_id76_R_index-1, PtR_id76_R_index+2, 
-            [improper_dihedral_force, di_N_R_P_PU2_P])
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep%self._reportInterval
+        return (steps, True, False, False, False, False)
 
-        # add Ep angle for previous AA -- new AA -- PtR:76@R
-        if nascent_chain_length > 1:
-            caf.addAngle(nascent_chain_length-2, nascent_chain_length-1, PtR_id76_R_index, 
-                [106.4*kilocalories/mole/radian**2, 91.7*degree, 26.3*kilocalories/mole/radian**2, 
-                130*degree, 0.1*mole/kilocalories, 4.3*kilocalories/mole])
-        # add exclusion for NB between new AA and P-site resid 76 ribose R
-        custom_nb_force.addExclusion(nascent_chain_length-1, PtR_id76_R_index)
-        # add exclusion for NB between previous AA and P-site resid 76 ribose R
-        if nascent_chain_length > 1:
-            custom_nb_force.addExclusion(nascent_chain_length-2, PtR_id76_R_index)
-    elif stage == 5:
-        xref = (x_eject-2)*angstrom
-        k = 20*kilocalories/mole/angstroms**2
-        force_2 = CustomExternalForce("k*r^2; r=min(x-x0, 0)")
-        force_2.addPerParticleParameter("k")
-        force_2.addPerParticleParameter("x0")
-        for atom in top.atoms():
-            if atom.residue.chain.id == 'A':
-                force_2.addParticle(atom.index, [k, xref])
-        system.addForce(force_2)
-    
-    # add spherical restraint
-    k = 0.1*kilocalories/mole/angstroms**2
-    R0 = spherical_restraint_radius * angstrom
-    center_xyz = spherical_restraint_center * angstrom
-    force = CustomExternalForce("k*dR^2; dR=max(R-R0, 0); R=sqrt((x-x0)^2+(y-y0)^2+(z-z0)^2);")
-    force.addGlobalParameter('k', k)
-    force.addGlobalParameter('R0', R0)
-    force.addGlobalParameter('x0', center_xyz[0])
-    force.addGlobalParameter('y0', center_xyz[1])
-    force.addGlobalParameter('z0', center_xyz[2])
-    for atom in top.atoms():
-        if atom.index in sp_rst_idx:
-            force.addParticle(atom.index, [])
-    system.addForce(force)
-    
-    # add position restraints
-    force_7 = CustomExternalForce("k*((x-x0)^2+(y-y0)^2+(z-z0)^2)")
-    force_7.addPerParticleParameter("k")
-    force_7.addPerParticleParameter("x0")
-    force_7.addPerParticleParameter("y0")
-    force_7.addPerParticleParameter("z0")
-    system.addForce(force_7)
-    # END add position restraints
-    
-    # Remove ligand bond constraints
-    try:
-        rm_cons_LIG(system, rnc_psf_pmd, forcefield, top, template_map)
-    except Exception as e:
-        traceback.print_exc()
-        sys.exit()
+    def report(self, simulation, state):
+        if self._dcd is None:
+            first_step = simulation.currentStep
+            if self._append:
+                # keep the first step of the existing file
+                self._out.seek(12)
+                first_step = struct.unpack('<i', self._out.read(4))[0]
+            self._dcd = DCDFile(self._out, self._topology, simulation.integrator.getStepSize(), 
+                first_step, self._reportInterval, self._append)
+        positions = state.getPositions(asNumpy=True)[self._atom_index]
+        self._dcd.writeModel(positions)
 
-    return system
-# END create system for elongation
+    def __del__(self):
+        self._out.close()
+# END DCD reporter that only writes a subset of atoms
+
+# Save the coordinates (A) of the ribosome once per trajectory
+# Frozen ribosome atoms never move, so frames of the whole RNC can be rebuilt from frames of the mobile atoms and
+# this snapshot. nc_natom[L] is the number of nascent chain atoms at length L, which precede the ribosome atoms in 
+# the RNC; ribo_free_idx is counted from the first ribosome atom.
+def save_static_snapshot(static_file, rnc_coor, nascent_chain_length):
+    global rnc_index
+    nc_natom = rnc_index['nc_natom'][nascent_chain_length]
+    full_nc_natom = rnc_index['nc_natom'][-1]
+    ribo_free_idx = rnc_index['ribo_free_idx']
+    tmp_file = static_file.split('.npz')[0]+'.tmp.npz'
+    np.savez(tmp_file, ribo_coor=rnc_coor[nc_natom:], nc_natom=np.array(rnc_index['nc_natom']), 
+        ribo_free_idx=ribo_free_idx[ribo_free_idx >= full_nc_natom] - full_nc_natom)
+    os.replace(tmp_file, static_file)
+# END Save the coordinates of the ribosome
+
+# Trajectory container of one trajectory
+# The record format is described in rnc_traj_container.py, whose scan_traj_container() is shared by this writer and 
+# the readers.
+
+# Truncate the trajectory container to file_size bytes
+def truncate_traj_container(container_file, file_size):
+    f = open(container_file, 'r+b')
+    f.truncate(file_size)
+    f.close()
+# END Truncate the trajectory container
+
+# Drop the records of nascent chain length >= nascent_chain_length and any torn record before elongation restarts 
+# at nascent_chain_length
+def trim_traj_container(container_file, nascent_chain_length):
+    (record_list, end) = scan_traj_container(container_file)
+    for (offset, header) in record_list:
+        if header['length'] >= nascent_chain_length:
+            end = offset
+            break
+    if os.path.exists(container_file) and os.path.getsize(container_file) != end:
+        truncate_traj_container(container_file, end)
+# END Drop records of the codons to be simulated again
+
+# Reporter that appends frames of one stage to the trajectory container
+class TrajContainerReporter(object):
+    def __init__(self, file, reportInterval, atom_index, nascent_chain_length, stage, selection, chunk_size):
+        self._reportInterval = reportInterval
+        self._atom_index = atom_index
+        self._header = {'length': nascent_chain_length, 'stage': stage, 'natom': len(atom_index), 
+            'atoms': selection, 'final': 0}
+        self._chunk_size = chunk_size
+        (record_list, end) = scan_traj_container(file)
+        # a resumed stage continues its own frame numbers and clock; a new stage starts at the time of the last 
+        # final structure
+        self._first_frame = 0
+        self._start_time = 0
+        if len(record_list) > 0:
+            last = record_list[-1][1]
+            if last['length'] == nascent_chain_length and last['stage'] == stage and last['final'] == 0:
+                self._first_frame = last['first_frame'] + len(last['step'])
+                self._start_time = last['start_time']
+            else:
+                self._start_time = last['time'][-1]
+        if os.path.exists(file):
+            self._out = open(file, 'r+b')
+            self._out.truncate(end)
+            self._out.seek(end)
+        else:
+            self._out = open(file, 'wb')
+        self._frames = []
+        self._steps = []
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep%self._reportInterval
+        return (steps, True, False, False, False, False)
+
+    def report(self, simulation, state):
+        self._frames.append(state.getPositions(asNumpy=True).value_in_unit(angstroms)[self._atom_index])
+        self._steps.append(simulation.currentStep)
+        if len(self._frames) >= self._chunk_size:
+            self.flush()
+
+    # write buffered frames as one record
+    def flush(self, final=0):
+        if len(self._frames) == 0:
+            return
+        dt = timestep.value_in_unit(nanoseconds)
+        header = dict(self._header)
+        header['first_frame'] = self._first_frame
+        header['step'] = self._steps
+        header['time'] = [self._start_time + n*dt for n in self._steps]
+        header['start_time'] = self._start_time
+        header['final'] = final
+        header = json.dumps(header).encode()
+        data = zlib.compress(np.array(self._frames, dtype=np.float32).tobytes())
+        self._out.write(b'RTC1' + struct.pack('<I', len(header)) + header + struct.pack('<Q', len(data)) + data)
+        self._out.flush()
+        self._first_frame += len(self._frames)
+        self._frames = []
+        self._steps = []
+
+    # write buffered frames and the final structure of the stage
+    def write_final(self, state, step):
+        self.flush()
+        self._frames.append(state.getPositions(asNumpy=True).value_in_unit(angstroms)[self._atom_index])
+        self._steps.append(step)
+        self.flush(final=1)
+
+    def __del__(self):
+        self._out.close()
+# END Reporter that appends frames to the trajectory container
 
 # calculate minimum distance between nascent chain and ribosome 
-def calc_min_distance(top, current_rnc_cor):
-    dis_1 = 999999999999
-    dis_2 = 999999999999
-    ribo_atom_index = []
-    nc_atom_index = []
-    for atom in top.atoms():
-        if atom.residue.chain.id == 'A':
-            nc_atom_index.append(atom.index)
-        elif atom.residue.chain.id != 'LIG':
-            # not nascent chain and not ligands
-            ribo_atom_index.append(atom.index)
-    for i in nc_atom_index:
-        coor_1 = current_rnc_cor[i].value_in_unit(angstroms)
-        d = coor_1[0]
-        if d < dis_2:
-            dis_2 = d
-        for j in ribo_atom_index:
-            coor_2 = current_rnc_cor[j].value_in_unit(angstroms)
-            d = ((coor_1[0]-coor_2[0])**2 + (coor_1[1]-coor_2[1])**2 + (coor_1[2]-coor_2[2])**2)**0.5
-            if d < dis_1:
-                dis_1 = d
-    return (dis_1, dis_2)
-    
-def calc_NC_COM(top, current_rnc_cor, system):
-    nc_atom_index = []
-    for atom in top.atoms():
-        if atom.residue.chain.id == 'A':
-            nc_atom_index.append(atom.index)
-    com = np.zeros(3)
-    total_mass = 0
-    for i in nc_atom_index:
-        coor = current_rnc_cor[i].value_in_unit(angstroms)
-        mass = system.getParticleMass(i).value_in_unit(dalton)
-        com += coor * mass
-        total_mass += mass
-    com = com / total_mass
-    return com
+# Cell list of static ribosome atoms for the nascent chain-ribosome distance monitor
+# static_coor: coordinates of the frozen ribosome atoms in angstrom
+def build_ribo_cell_list(static_coor, cell_size=10.0):
+    cell_list = {'cell_size': cell_size, 'coor': static_coor}
+    if len(static_coor) == 0:
+        return cell_list
+    origin = static_coor.min(axis=0)
+    cell = np.floor((static_coor - origin) / cell_size).astype(int)
+    # occupied cells and the cell of each atom
+    (occupied_cell, atom_cell) = np.unique(cell, axis=0, return_inverse=True)
+    cell_list['origin'] = origin
+    cell_list['occupied_cell'] = occupied_cell
+    cell_list['atom_cell'] = atom_cell.ravel()
+    return cell_list
+# END Cell list of static ribosome atoms
+
+# minimum distance between two sets of coordinates
+def min_pair_distance(coor_1, coor_2):
+    if len(coor_1) == 0 or len(coor_2) == 0:
+        return np.inf
+    d2 = np.sum(coor_1**2, axis=1)[:, None] + np.sum(coor_2**2, axis=1)[None, :] - 2 * np.dot(coor_1, coor_2.T)
+    return np.sqrt(max(np.min(d2), 0))
+
+# Minimum distance between nascent chain and ribosome (dis_1) and minimum x of nascent chain (dis_2)
+# nc_coor, free_coor: coordinates of nascent chain atoms and free ribosome atoms in angstrom
+def calc_min_distance(ribo_cell_list, nc_coor, free_coor):
+    dis_2 = np.min(nc_coor[:, 0])
+    dis_1 = min_pair_distance(nc_coor, free_coor)
+    static_coor = ribo_cell_list['coor']
+    if len(static_coor) == 0:
+        return (dis_1, dis_2)
+    cell_size = ribo_cell_list['cell_size']
+    nc_cell = np.unique(np.floor((nc_coor - ribo_cell_list['origin']) / cell_size).astype(int), axis=0)
+    # number of cells between each occupied ribosome cell and its closest nascent chain cell;
+    # atoms in cells more than n_shell away are farther than n_shell*cell_size from the nascent chain
+    n_shell_cell = np.abs(ribo_cell_list['occupied_cell'][:, None, :] - nc_cell[None, :, :]).max(axis=2).min(axis=1)
+    n_shell_atom = n_shell_cell[ribo_cell_list['atom_cell']]
+    n_shell = max(np.min(n_shell_cell), 1)
+    while True:
+        d = min_pair_distance(nc_coor, static_coor[n_shell_atom <= n_shell])
+        if d <= n_shell*cell_size or n_shell >= np.max(n_shell_cell):
+            return (min(dis_1, d), dis_2)
+        n_shell = int(np.ceil(d / cell_size))
+# END Minimum distance between nascent chain and ribosome
 
 # remove bond constraints of 0 mass atoms
 def rm_cons_0_mass(system):
@@ -969,30 +2825,33 @@ def rm_cons_0_mass(system):
             hbf = force
             break
     
-    tag = 0
-    while tag == 0 and system.getNumConstraints() != 0:
-        for i in range(system.getNumConstraints()):
-            con_i = system.getConstraintParameters(i)[0]
-            con_j = system.getConstraintParameters(i)[1]
-            mass_i = system.getParticleMass(con_i).value_in_unit(dalton)
-            mass_j = system.getParticleMass(con_j).value_in_unit(dalton)
-            if mass_i == 0 and mass_j == 0:
-                system.removeConstraint(i)
-                #print('Constraint %d is removed, range is %d'%(i, system.getNumConstraints()))
-                tag = 0
-                break
-            elif mass_i == 0 or mass_j == 0:
-                system.removeConstraint(i)
-                #print('Constraint %d is removed, range is %d'%(i, system.getNumConstraints()))
-                hbf.addBond(con_i, con_j, 3.81*angstroms, 50*kilocalories/mole/angstroms**2)
-                tag = 0
-                break
-            else:
-                tag = 1
+    # all constraints are checked in one pass and removed from the end so that the index of the remaining ones 
+    # does not change
+    mass = np.array([system.getParticleMass(i).value_in_unit(dalton) for i in range(system.getNumParticles())])
+    rm_list = []
+    for i in range(system.getNumConstraints()):
+        (con_i, con_j, length) = system.getConstraintParameters(i)
+        if mass[con_i] == 0 and mass[con_j] == 0:
+            rm_list.append(i)
+        elif mass[con_i] == 0 or mass[con_j] == 0:
+            rm_list.append(i)
+            hbf.addBond(con_i, con_j, 3.81*angstroms, 50*kilocalories/mole/angstroms**2)
+    for i in reversed(rm_list):
+        system.removeConstraint(i)
 # END remove bond constraints of 0 mass atoms
 
 # remove bond constraints of LIG atoms
 def rm_cons_LIG(system, psf_pmd, forcefield, top, templete_map):
+    segid = np.array([atm.residue.segid for atm in psf_pmd.atoms])
+    rm_list = []
+    for i in range(system.getNumConstraints()):
+        (con_i, con_j, length) = system.getConstraintParameters(i)
+        if segid[con_i] == 'LIG' and segid[con_j] == 'LIG':
+            rm_list.append(i)
+    if len(rm_list) == 0:
+        # no ligand constraint; skip building the unconstrained system
+        return
+
     system_new = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
                  nonbondedCutoff=2.0*nanometer,
                  constraints=None, removeCMMotion=False, ignoreExternalBonds=True, 
@@ -1001,29 +2860,24 @@ def rm_cons_LIG(system, psf_pmd, forcefield, top, templete_map):
         if force.getName() == 'HarmonicBondForce':
             bond_force = force
             break
-    bond_parameter_list = [bond_force.getBondParameters(i) for i in range(bond_force.getNumBonds())]
+    # first bond parameters of each atom pair
+    bond_parameter_dict = {}
+    for i in range(bond_force.getNumBonds()):
+        bp = bond_force.getBondParameters(i)
+        pair = (min(bp[0], bp[1]), max(bp[0], bp[1]))
+        if not pair in bond_parameter_dict:
+            bond_parameter_dict[pair] = bp
     for force in system.getForces():
         if force.getName() == 'HarmonicBondForce':
             hbf = force
             break
-    tag = 0
-    while tag == 0 and system.getNumConstraints() != 0:
-        for i in range(system.getNumConstraints()):
-            con_i = system.getConstraintParameters(i)[0]
-            con_j = system.getConstraintParameters(i)[1]
-            segid_i = psf_pmd.atoms[con_i].residue.segid
-            segid_j = psf_pmd.atoms[con_j].residue.segid
-            if segid_i == 'LIG' and segid_j == 'LIG':
-                system.removeConstraint(i)
-                # print('Constraint %d is removed, range is %d'%(i, system.getNumConstraints()))
-                for bp in bond_parameter_list:
-                    if (con_i == bp[0] and con_j == bp[1]) or (con_i == bp[1] and con_j == bp[0]):
-                        hbf.addBond(*bp)
-                        break
-                tag = 0
-                break
-            else:
-                tag = 1
+    for i in rm_list:
+        (con_i, con_j, length) = system.getConstraintParameters(i)
+        pair = (min(con_i, con_j), max(con_i, con_j))
+        if pair in bond_parameter_dict:
+            hbf.addBond(*bond_parameter_dict[pair])
+    for i in reversed(rm_list):
+        system.removeConstraint(i)
 # END remove bond constraints of LIG atoms
 
 # energy decomposition 
@@ -1056,8 +2910,7 @@ def getEnergyDecomposition(handle, context, forcegroups):
         handle.write('      %s: %.4f kcal/mol\n'%(forcegroups[idd], energies[idd].value_in_unit(kilocalories/mole))) 
     return results
 
-def getMaxForce(handle, context, system):
-    forcegroups = forcegroupify(system)
+def getMaxForce(handle, context, forcegroups):
     forces = {}
     for i, f in forcegroups.items():
         states = context.getState(getForces=True, groups={i})
@@ -1072,6 +2925,63 @@ def getMaxForce(handle, context, system):
     return results
 # END energy decomposition 
 
+# raise an exception if the potential or kinetic energy is not finite
+def check_finite_energy(context):
+    state = context.getState(getEnergy=True)
+    Ep = state.getPotentialEnergy().value_in_unit(kilocalorie/mole)
+    Ek = state.getKineticEnergy().value_in_unit(kilocalorie/mole)
+    if not (np.isfinite(Ep) and np.isfinite(Ek)):
+        raise ValueError('Energy is NaN or infinite (Ep = %s, Ek = %s)'%(str(Ep), str(Ek)))
+
+# Multiple time step Langevin integrator (BAOAB splitting with RESPA)
+# Forces in group 1 are applied as half-step impulses at the start and end of each step of size dt; forces in 
+# group 0 are integrated with nsub inner BAOAB steps of size dt/nsub. Particles with zero mass are not moved.
+def MTSLangevinIntegrator(temperature, friction, dt, nsub):
+    gamma_dt = friction.value_in_unit(picosecond**-1) * dt.value_in_unit(picosecond) / nsub
+    integrator = CustomIntegrator(dt)
+    integrator.addGlobalVariable('a', math.exp(-gamma_dt))
+    integrator.addGlobalVariable('b', math.sqrt(1 - math.exp(-2*gamma_dt)))
+    integrator.addGlobalVariable('kT', MOLAR_GAS_CONSTANT_R*temperature)
+    integrator.addPerDofVariable('x1', 0)
+    integrator.addUpdateContextState()
+    integrator.addComputePerDof('v', 'v+0.5*dt*f1/m')
+    for i in range(nsub):
+        integrator.addComputePerDof('v', 'v+0.5*(dt/%d)*f0/m'%nsub)
+        integrator.addComputePerDof('x', 'x+0.5*(dt/%d)*v'%nsub)
+        integrator.addComputePerDof('v', 'a*v+b*sqrt(kT/m)*gaussian')
+        integrator.addComputePerDof('x', 'x+0.5*(dt/%d)*v'%nsub)
+        integrator.addComputePerDof('x1', 'x')
+        integrator.addConstrainPositions()
+        integrator.addComputePerDof('v', 'v+(x-x1)/(dt/%d)'%nsub)
+        integrator.addComputePerDof('v', 'v+0.5*(dt/%d)*f0/m'%nsub)
+        integrator.addConstrainVelocities()
+    integrator.addComputePerDof('v', 'v+0.5*dt*f1/m')
+    integrator.addConstrainVelocities()
+    return integrator
+# END Multiple time step Langevin integrator
+
+# Integrator for MD of elongation stages
+# mts_steps > 1: forces between nascent chain and ribosome (named 'NCRiboForce') are moved to force group 1 and 
+# evaluated once per step of size timestep; all the other forces are moved to group 0 and evaluated every 
+# timestep/mts_steps. The energy decomposition then reports the two groups.
+# return (integrator, forcegroups)
+def create_md_integrator(system, forcegroups, rand):
+    global temp_prod, fbsolu, timestep, constraint_tolerance, mts_steps
+    if mts_steps == 1:
+        integrator = LangevinIntegrator(temp_prod, fbsolu, timestep)
+    else:
+        for force in system.getForces():
+            if force.getName() == 'NCRiboForce':
+                force.setForceGroup(1)
+            else:
+                force.setForceGroup(0)
+        forcegroups = {0: 'FastForces', 1: 'NCRiboForce'}
+        integrator = MTSLangevinIntegrator(temp_prod, fbsolu, timestep, mts_steps)
+    integrator.setConstraintTolerance(constraint_tolerance)
+    integrator.setRandomNumberSeed(rand)
+    return (integrator, forcegroups)
+# END Integrator for MD of elongation stages
+
 # format psf generated from parmed so that it can be read by vmd
 def formate_psf_vmd(psf_file):
     f = open(psf_file, 'r')
@@ -1115,10 +3025,91 @@ def formate_psf_vmd(psf_file):
             f_o.write(line)
     f.close()
     f_o.close()
-    os.system('rm -f '+psf_file)
-    os.system('mv '+'new_'+psf_file+' '+psf_file)
+    os.replace('new_'+psf_file, psf_file)
 # END format psf for vmd
 
+# Load RNC coordinates from charmm cor file or checkpoint file
+def load_rnc_cor(cor_file):
+    if cor_file.endswith('.npz'):
+        (nascent_chain_length, positions) = load_rnc_checkpoint(cor_file)
+        return Quantity([Vec3(*p) for p in positions.tolist()], nanometer)
+    else:
+        return CharmmCrdFile(cor_file).positions
+# END Load RNC coordinates from charmm cor file or checkpoint file
+
+# Save RNC coordinates to checkpoint file
+def save_rnc_checkpoint(checkpoint_file, nascent_chain_length, positions):
+    positions = np.array(positions.value_in_unit(nanometer), dtype=np.float64)
+    # write to a temporary file first so that a crash never leaves a broken checkpoint
+    tmp_file = checkpoint_file.split('.npz')[0]+'.tmp.npz'
+    np.savez(tmp_file, nascent_chain_length=nascent_chain_length, positions=positions)
+    os.replace(tmp_file, checkpoint_file)
+# END Save RNC coordinates to checkpoint file
+
+# Load RNC coordinates from checkpoint file
+def load_rnc_checkpoint(checkpoint_file):
+    data = np.load(checkpoint_file)
+    return (int(data['nascent_chain_length']), data['positions'])
+# END Load RNC coordinates from checkpoint file
+
+# Save the state of the running stage to the stage checkpoint file
+# The context checkpoint holds positions, velocities, parameters and the integrator random number state. 
+# out_size and dcd_size are the sizes of the output files at this step, which are used to truncate them on restart.
+def save_stage_checkpoint(checkpoint_file, simulation, nascent_chain_length, stage, step, tag_seperate, 
+    out_file, dcd_file):
+    global stage_checkpoint_info
+    state = simulation.context.getState(getPositions=True, getVelocities=True)
+    positions = state.getPositions(asNumpy=True).value_in_unit(nanometer)
+    velocities = state.getVelocities(asNumpy=True).value_in_unit(nanometer/picosecond)
+    context_checkpoint = np.frombuffer(simulation.context.createCheckpoint(), dtype=np.uint8)
+    tmp_file = checkpoint_file.split('.npz')[0]+'.tmp.npz'
+    np.savez(tmp_file, nascent_chain_length=nascent_chain_length, stage=stage, step=step, 
+        simulation_steps=np.array(stage_checkpoint_info['simulation_steps']), rand=stage_checkpoint_info['rand'], 
+        tag_seperate=tag_seperate, positions=positions, velocities=velocities, context_checkpoint=context_checkpoint, 
+        out_size=os.path.getsize(out_file), dcd_size=os.path.getsize(dcd_file))
+    os.replace(tmp_file, checkpoint_file)
+# END Save the state of the running stage
+
+# Load the stage checkpoint file
+def load_stage_checkpoint(checkpoint_file):
+    data = np.load(checkpoint_file)
+    resume = {}
+    for key in ['nascent_chain_length', 'stage', 'step', 'rand', 'tag_seperate', 'out_size', 'dcd_size']:
+        resume[key] = int(data[key])
+    resume['simulation_steps'] = [int(n) for n in data['simulation_steps']]
+    resume['positions'] = data['positions']
+    resume['velocities'] = data['velocities']
+    resume['context_checkpoint'] = data['context_checkpoint'].tobytes()
+    return resume
+# END Load the stage checkpoint file
+
+# Restore the simulation of the running stage from the stage checkpoint
+def restore_stage_checkpoint(simulation, resume, out_file):
+    try:
+        simulation.context.loadCheckpoint(resume['context_checkpoint'])
+    except Exception as e:
+        # context checkpoints cannot be moved across platforms or OpenMM versions
+        fo = open(out_file, 'a')
+        fo.write('Warning: cannot load the context checkpoint (%s). Random number state will not be restored.\n'%str(e))
+        fo.close()
+        simulation.context.setPositions(resume['positions']*nanometer)
+        simulation.context.setVelocities(resume['velocities']*nanometer/picosecond)
+    simulation.currentStep = resume['step']
+# END Restore the simulation of the running stage
+
+# Truncate a DCD file to file_size bytes holding nframe frames and update the header
+def truncate_dcd(dcd_file, file_size, nframe):
+    f = open(dcd_file, 'r+b')
+    f.truncate(file_size)
+    f.seek(12)
+    (first_step, interval) = struct.unpack('<2i', f.read(8))
+    f.seek(8)
+    f.write(struct.pack('<i', nframe))
+    f.seek(20)
+    f.write(struct.pack('<i', first_step+(nframe-1)*interval))
+    f.close()
+# END Truncate a DCD file
+
 ###### convert time seconds to hours ######
 def convert_time(seconds):
     m, s = divmod(seconds, 60)
@@ -1134,6 +3125,68 @@ def sample_fpt_dist(mfptaa):
     #return (r1, -np.log(r1)*np.float64(mfptaa))
     return random.expovariate(1/mfptaa)
 # END #
+
+# simulate_ribosome_traffic() (TASEP model of ribosome traffic) is in ribosome_traffic_tasep.py, which is shared with
+# validate_ribosome_traffic.py
+
+# Traffic-adjusted mean codon dwell times for every (mRNA, initiation rate) pair; results are cached in cache_dir
+# keyed on the mRNA sequence, the codon translation times, the initiation rate and the TASEP settings, and only the
+# missing pairs are simulated, all in one batch
+# return (mean_fpt_array[mRNA, initiation rate, codon], number of pairs loaded from cache)
+def ribosome_traffic_mfpt(mrna_seq_list, map_codon_to_mfpt, initiation_rate_list, cache_dir):
+    global traffic_footprint, traffic_termination_rate, traffic_num_ribosomes, traffic_num_replicas, traffic_seed
+    codon_mfpt_list_list = []
+    for mrna in mrna_seq_list:
+        codon_mfpt_list_list.append([map_codon_to_mfpt[mrna[3*i:3*i+3]] for i in range(len(mrna)//3)])
+    max_codon = max([len(c) for c in codon_mfpt_list_list])
+    mean_fpt = np.zeros((len(mrna_seq_list), len(initiation_rate_list), max_codon))
+
+    cache_file_map = {}
+    missing_list = []
+    for i, mrna in enumerate(mrna_seq_list):
+        for j, rate in enumerate(initiation_rate_list):
+            cache_file = ''
+            if cache_dir != '':
+                h = hashlib.sha1()
+                h.update(mrna.encode())
+                h.update(repr(codon_mfpt_list_list[i]).encode())
+                h.update(repr((float(rate), traffic_footprint, float(traffic_termination_rate),
+                    traffic_num_ribosomes, traffic_num_replicas, traffic_seed)).encode())
+                cache_file = cache_dir+'/traffic_'+h.hexdigest()+'.npz'
+                cache_file_map[(i, j)] = cache_file
+            if cache_file != '' and os.path.exists(cache_file):
+                try:
+                    data = np.load(cache_file)
+                    mean_fpt[i, j, :len(codon_mfpt_list_list[i])] = data['mean_fpt']
+                    continue
+                except Exception as e:
+                    print('Warning: cannot load cached ribosome traffic result %s (%s). Simulate it again.'%(
+                        cache_file, str(e)))
+            missing_list.append((i, j))
+    n_cached = len(mrna_seq_list) * len(initiation_rate_list) - len(missing_list)
+    if len(missing_list) == 0:
+        return (mean_fpt, n_cached)
+
+    mrna_idx = sorted(set([i for (i, j) in missing_list]))
+    rate_idx = sorted(set([j for (i, j) in missing_list]))
+    sim_fpt = simulate_ribosome_traffic([codon_mfpt_list_list[i] for i in mrna_idx],
+        [initiation_rate_list[j] for j in rate_idx], traffic_footprint, traffic_termination_rate,
+        traffic_num_ribosomes, traffic_num_replicas, traffic_seed)
+    for (i, j) in missing_list:
+        n_codon = len(codon_mfpt_list_list[i])
+        mean_fpt[i, j, :n_codon] = sim_fpt[mrna_idx.index(i), rate_idx.index(j), :n_codon]
+        if cache_dir != '':
+            cache_file = cache_file_map[(i, j)]
+            try:
+                if not os.path.exists(cache_dir):
+                    os.makedirs(cache_dir, exist_ok=True)
+                tmp_file = cache_file+'.%d.tmp.npz'%os.getpid()
+                np.savez(tmp_file, mean_fpt=mean_fpt[i, j, :n_codon])
+                os.replace(tmp_file, cache_file)
+            except Exception as e:
+                print('Warning: cannot save ribosome traffic result to %s (%s).'%(cache_file, str(e)))
+    return (mean_fpt, n_cached)
+# END Traffic-adjusted mean codon dwell times
 # Auto-combine ribosome and protein parameter files
 def combine_ribo_prot_param(ribo_param_file, prot_param_file):
     param_str_list = []
@@ -1251,6 +3304,10 @@ def combine_ribo_prot_param(ribo_param_file, prot_param_file):
     prefix = '/'.join(ribo_param_file.strip().split('/')[:-1])
     # rnc_prm_file = prefix+'/rnc_%s.prm'%(time.time())
     rnc_prm_file = prefix+'/rnc_%d-%d.prm'%(start_traj_id, start_traj_id+num_traj-1)
+    if work_queue != '':
+        # instances sharing the work queue compile the force field in the same directory
+        rnc_prm_file = prefix+'/rnc_%d-%d_%s_%d.prm'%(start_traj_id, start_traj_id+num_traj-1, socket.gethostname(), 
+            os.getpid())
     f = open(rnc_prm_file, 'w')
     f.write('* This CHARMM .prm file describes a Go model of nascent chain and ribosome structure\n*\n\n')
     for i in range(len(param_str_list)):
@@ -1261,48 +3318,227 @@ def combine_ribo_prot_param(ribo_param_file, prot_param_file):
     return rnc_prm_file
 # END Auto-combine ribosome and protein parameter files
 
-# parse mask
-def parse_mask(struct, mask):
-    mask_idx = []
+# Hash key of the compiled force field built from the input top/prm files
+# The parser script and OpenMM version are included since the cached ForceField object depends on both
+def forcefield_cache_key(input_file_list):
+    h = hashlib.sha1()
+    parser = shutil.which('parse_cg_prm.py')
+    if parser != None:
+        input_file_list = input_file_list + [parser]
+    for fn in input_file_list:
+        f = open(fn, 'rb')
+        h.update(f.read())
+        f.close()
+    h.update(Platform.getOpenMMVersion().encode())
+    return h.hexdigest()
+# END Hash key of the compiled force field
+
+# Load the compiled RNC force field from cache_dir; compile it from the top/prm files and store it on a cache miss
+# The generated rnc.xml, which gen_ribosome_grid.py and validate_ribosome_grid.py read, is cached next to the pickle 
+# and written next to the ribosome prm file in both cases.
+# return (forcefield, cache_file); cache_file is '' if the force field was compiled in this run
+def load_rnc_forcefield(cache_dir):
+    global ribo_top, prot_top, ribo_param, prot_param
+    ribo_xml_file = ('/'.join(ribo_param.strip().split('/')[:-1]))+'/rnc.xml'
+    cache_file = ''
+    if cache_dir != '':
+        key = forcefield_cache_key([ribo_top, prot_top, ribo_param, prot_param])
+        cache_file = cache_dir+'/rnc_'+key+'.pkl'
+        cache_xml_file = cache_dir+'/rnc_'+key+'.xml'
+        if os.path.exists(cache_file) and os.path.exists(cache_xml_file):
+            try:
+                f = open(cache_file, 'rb')
+                forcefield = pickle.load(f)
+                f.close()
+                shutil.copy(cache_xml_file, ribo_xml_file)
+                return (forcefield, cache_file)
+            except Exception as e:
+                print('Warning: cannot load cached force field %s (%s). Compile it again.'%(cache_file, str(e)))
+
+    # combine ribosome forcefield with protein forcefield
+    rnc_prm_file = combine_ribo_prot_param(ribo_param, prot_param)
+    rnc_xml_file = rnc_prm_file.split('.prm')[0]+'.xml'
+    os.system('parse_cg_prm.py -t "'+ribo_top+' '+prot_top+'" -p '+rnc_prm_file)
+    forcefield = ForceField(rnc_xml_file)
+    os.system('rm -f '+rnc_prm_file)
+    os.system('mv '+rnc_xml_file+' '+ribo_xml_file)
+
+    if cache_file != '':
+        # several batches may compile the same force field at the same time; the last one wins
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, exist_ok=True)
+            tmp_file = cache_xml_file+'.%d.tmp'%os.getpid()
+            shutil.copy(ribo_xml_file, tmp_file)
+            os.replace(tmp_file, cache_xml_file)
+            tmp_file = cache_file+'.%d.tmp'%os.getpid()
+            f = open(tmp_file, 'wb')
+            pickle.dump(forcefield, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.close()
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print('Warning: cannot save compiled force field to %s (%s).'%(cache_file, str(e)))
+    return (forcefield, '')
+# END Load the compiled RNC force field
+
+# Precomputed index of the full-length RNC, built once per run
+# The RNC of any nascent chain length and its atom selections are sliced from it instead of combining and renumbering 
+# the protein and ribosome psf and parsing the masks at every codon
+def build_rnc_index(prot_psf, ribo_psf, total_nascent_chain_length):
+    global ribo_resid_list, ribo_free_mask, spherical_restraint_mask
+    rnc_psf_pmd = prot_psf[':1-'+str(total_nascent_chain_length)] + ribo_psf # combine ribosome psf with nascent chain psf
+    # renumber ribosome resid
+    idx = 0
+    for res in rnc_psf_pmd.residues:
+        if res.segid != 'A':
+            res.number = ribo_resid_list[idx]
+            idx += 1
+    # number of nascent chain atoms at each nascent chain length
+    nc_natom = [0]
+    for res in rnc_psf_pmd.residues[:total_nascent_chain_length]:
+        nc_natom.append(nc_natom[-1] + len(res.atoms))
+    rnc_index = {'psf': rnc_psf_pmd, 'nc_natom': nc_natom, 'n_atom': len(rnc_psf_pmd.atoms)}
+    rnc_index['columns'] = mask_columns(rnc_psf_pmd)
+    for (key, mask) in [('ribo_free_idx', ribo_free_mask), ('sp_rst_idx', spherical_restraint_mask)]:
+        if mask == '':
+            rnc_index[key] = np.array([], dtype=int)
+        else:
+            rnc_index[key] = np.nonzero(select_mask(rnc_index['columns'], mask))[0]
+    return rnc_index
+# END Precomputed index of the full-length RNC
+
+# Boolean selection of the atoms of the RNC with nascent_chain_length in the full-length RNC
+def rnc_atom_selection(rnc_index, nascent_chain_length):
+    sel = np.ones(rnc_index['n_atom'], dtype=bool)
+    sel[rnc_index['nc_natom'][nascent_chain_length]:rnc_index['nc_natom'][-1]] = False
+    return sel
+# END Boolean selection of the atoms of the RNC
+
+# parmed structure of the RNC with nascent_chain_length
+def slice_rnc_psf(rnc_index, nascent_chain_length):
+    return rnc_index['psf'][rnc_atom_selection(rnc_index, nascent_chain_length)]
+# END parmed structure of the RNC
+
+# Map a precomputed mask selection (key in rnc_index) to atom index of the RNC with nascent_chain_length
+def rnc_mask_index(rnc_index, key, nascent_chain_length):
+    mask_idx = rnc_index[key]
+    nc_natom = rnc_index['nc_natom'][nascent_chain_length]
+    full_nc_natom = rnc_index['nc_natom'][-1]
+    nc_part = mask_idx[mask_idx < nc_natom]
+    ribo_part = mask_idx[mask_idx >= full_nc_natom] - full_nc_natom + nc_natom
+    return nc_part.tolist() + ribo_part.tolist()
+# END Map a precomputed mask selection
+
+# Per-atom columns of a parmed structure used by the atom selection (segid, resid, atom name)
+def mask_columns(struct):
+    columns = {}
+    columns['segid'] = np.array([atm.residue.segid for atm in struct.atoms])
+    columns['resid'] = np.array([atm.residue.number for atm in struct.atoms], dtype=int)
+    columns['name'] = np.array([atm.name for atm in struct.atoms])
+    return columns
+# END Per-atom columns of a parmed structure
+
+# Columns of the RNC with nascent_chain_length sliced from the precomputed full-length RNC
+def rnc_columns(rnc_index, nascent_chain_length):
+    sel = rnc_atom_selection(rnc_index, nascent_chain_length)
+    columns = {}
+    for key in rnc_index['columns'].keys():
+        columns[key] = rnc_index['columns'][key][sel]
+    return columns
+# END Columns of the RNC
+
+# Compile a mask string into a boolean selection over the atom columns
+def select_mask(columns, mask):
+    sel = np.zeros(len(columns['name']), dtype=bool)
     mask_list = mask.strip().split('|')
     for m in mask_list:
         sub_list = m.strip().split(':')
         seg_mask = sub_list[0]
         segid_list = seg_mask.strip().split(',')
         segid_list = [s.strip() for s in segid_list]
+        resid_list = []
+        atmnm_list = []
         if len(sub_list) == 2:
             sub_mask = sub_list[1]
             sub_list = sub_mask.strip().split('@')
             res_mask = sub_list[0]
-            resid_list =res_mask.strip().split(',')
-            resid_list = [s.strip().split(' - ') for s in resid_list]
+            resid_list = res_mask.strip().split(',')
+            resid_list = [[int(r) for r in s.strip().split(' - ')] for s in resid_list]
             if len(sub_list) == 2:
                 atm_mask = sub_list[1]
-                atmnm_list =atm_mask.strip().split(',')
+                atmnm_list = atm_mask.strip().split(',')
                 atmnm_list = [s.strip() for s in atmnm_list]
-            else:
-                atmnm_list = []
-        else:
-            resid_list = []
-            atmnm_list = []
-
-        for atm in struct.atoms:
-            if (atm.residue.segid in segid_list and atm.name in atmnm_list) or (segid_list == [] and atmnm_list == []) or (
-                segid_list == [] and atm.name in atmnm_list) or (atm.residue.segid in segid_list and atmnm_list == []):
-                resid = atm.residue.number
-                if resid_list == []:
-                    mask_idx.append(atm.idx)
-                    continue
-                for r in resid_list:
-                    if len(r) == 1 and resid == int(r[0]):
-                        mask_idx.append(atm.idx)
-                        break
-                    elif len(r) == 2 and resid >= int(r[0]) and resid <= int(r[1]):
-                        mask_idx.append(atm.idx)
-                        break                
-    return mask_idx
+
+        sub_sel = np.ones(len(sel), dtype=bool)
+        if segid_list != []:
+            sub_sel &= np.isin(columns['segid'], segid_list)
+        if atmnm_list != []:
+            sub_sel &= np.isin(columns['name'], atmnm_list)
+        if resid_list != []:
+            res_sel = np.zeros(len(sel), dtype=bool)
+            for r in resid_list:
+                if len(r) == 1:
+                    res_sel |= columns['resid'] == r[0]
+                elif len(r) == 2:
+                    res_sel |= (columns['resid'] >= r[0]) & (columns['resid'] <= r[1])
+            sub_sel &= res_sel
+        sel |= sub_sel
+    return sel
+# END Compile a mask string
+
+# parse mask; return sorted atom index list
+def parse_mask(struct, mask):
+    return np.nonzero(select_mask(mask_columns(struct), mask))[0].tolist()
 # END parse mask
 
+# Distance (A) of every ribosome atom to the nearest 3' end ribose (R) of the A- and P-site tRNAs in the starting 
+# structure, in ribosome atom numbering. The tRNAs are frozen, so the distance holds for the whole simulation.
+# return None if the tRNA atoms are not found or not fixed
+def calc_tether_dist(rnc_index, starting_strucs):
+    full_nc_natom = rnc_index['nc_natom'][-1]
+    n_ribo = rnc_index['n_atom'] - full_nc_natom
+    coor = np.array(load_rnc_cor(starting_strucs).value_in_unit(angstroms))[-n_ribo:]
+    segid = rnc_index['columns']['segid'][full_nc_natom:]
+    name = rnc_index['columns']['name'][full_nc_natom:]
+    ribo_free_set = set((rnc_index['ribo_free_idx'] - full_nc_natom).tolist())
+    tether_dist = None
+    for tRNA in ['AtR', 'PtR']:
+        idx = np.nonzero((segid == tRNA) & (name == 'R'))[0]
+        # last residue of the tRNA
+        if len(idx) == 0 or idx[-1] in ribo_free_set:
+            return None
+        d = np.linalg.norm(coor - coor[idx[-1]], axis=1)
+        if tether_dist is None:
+            tether_dist = d
+        else:
+            tether_dist = np.minimum(tether_dist, d)
+    return tether_dist
+# END Distance of ribosome atoms to the tRNA 3' ends
+
+# Fixed ribosome atoms that can interact with the nascent chain with nascent_chain_length
+# The nascent chain is bonded to the 3' end of a tRNA, so none of its atoms gets further than the tRNA bond 
+# (4.76 A) plus nascent_chain_length-1 virtual bonds (3.81 A) and active_shell_margin from the tRNA 3' ends. 
+# Fixed atoms further than this reach plus the nonbonded cutoff have no interactions with the nascent chain.
+# return (atom index in the RNC with nascent_chain_length, radius of the shell in A)
+def calc_active_shell(ribo_fix_atom_index, nascent_chain_length):
+    global rnc_index, nonbond_cutoff, active_shell_margin
+    radius = (4.76 + 3.81*(nascent_chain_length-1) + active_shell_margin + 
+        nonbond_cutoff.value_in_unit(angstroms))
+    ribo_fix_atom_index = np.array(ribo_fix_atom_index, dtype=int)
+    dist = rnc_index['tether_dist'][ribo_fix_atom_index - rnc_index['nc_natom'][nascent_chain_length]]
+    return (ribo_fix_atom_index[dist <= radius].tolist(), radius)
+# END Fixed ribosome atoms that can interact with the nascent chain
+
+# Atom index of fixed ribosome atoms, nascent chain and A-site tRNA from the segid column
+def rnc_atom_groups(segid, ribo_free_idx):
+    is_free = np.zeros(len(segid), dtype=bool)
+    is_free[ribo_free_idx] = True
+    ribo_fix_atom_index = np.nonzero(np.logical_not(is_free) & (segid != 'A') & (segid != 'AtR'))[0].tolist()
+    nc_atom_index = np.nonzero(segid == 'A')[0].tolist()
+    AtR_atom_index = np.nonzero(segid == 'AtR')[0].tolist()
+    return (ribo_fix_atom_index, nc_atom_index, AtR_atom_index)
+# END Atom index of fixed ribosome atoms
+
 ##################################### MAIN #######################################
 ctrlfile = ''
 
@@ -1352,6 +3588,12 @@ time_stage_1 = 0.68/1000 # experimental mean dwell time (s) before peptide bond
 time_stage_2 = 8.38/1000 # experimental mean dwell time (s) before tRNA translocation
 ribosome_traffic = 0 # flag for considering ribosome traffic effect on translation time. 0: turn off; 1: turn on
 initiation_rate = 0 # translation initiation rate for ribosome traffic calculation
+traffic_num_ribosomes = 4000 # number of ribosomes translating each mRNA replica in ribosome traffic calculation; the first
+                             # 10% are discarded as warm-up
+traffic_num_replicas = 16 # number of independent mRNA replicas averaged in ribosome traffic calculation
+traffic_footprint = 10 # number of codons covered by a ribosome in ribosome traffic calculation
+traffic_termination_rate = 35.0 # termination rate (s-1) at the stop codon in ribosome traffic calculation
+traffic_seed = 100 # random seed of ribosome traffic calculation
 x_eject = 60 # x-axis threshold to determine whether nascant chain has ejected from ribosome in angstrom
 scale_factor = 4375901 # scale factor used to scale experimental translation time (s) to in silico translation time (ns) 
                        # by experimental_translation_time (ns) / scale_factor
@@ -1365,6 +3607,51 @@ nonbond_cutoff = 2.0*nanometer
 switch_cutoff = 1.8*nanometer
 constraint_tolerance = 1e-10
 sleep_time = 5 # how often (seconds) the main process check and write the log file
+persistent_context = 0 # 1: create one system and context per trajectory and switch elongation stages by parameter 
+                       # updates; 0: create a new system and context for every stage
+save_stage_structures = 1 # 1: save final cor and minimized pdb of every elongation stage; 0: only keep them in memory
+checkpoint_codons = 0 # save RNC checkpoint every checkpoint_codons codons; 0: off
+checkpoint_minutes = 0 # save RNC checkpoint every checkpoint_minutes minutes; 0: off
+stage_checkpoint_minutes = 0 # save the state of the running stage every stage_checkpoint_minutes minutes for exact 
+                             # restart within the stage; 0: off
+ribosome_grid = '' # precomputed grid potential of frozen ribosome atoms created by gen_ribosome_grid.py; 
+                   # '': use explicit ribosome beads
+progress_queue = None # queue of progress events sent from workers to the main process
+progress_traj_index = 0 # index of the trajectory running in the current worker
+rnc_index = None # precomputed index of the full-length RNC
+stage_checkpoint_info = {} # sampled steps of all stages and random seed of the codon running in the current worker
+queue_lease_deadline = None # time until which the codons of this instance are safely assigned to it in the work 
+                            # queue, shared by the main process with the workers; None: not in distributed mode
+queue_lease_lost = False # True if the codon running in the current worker was stopped since its lease could expire
+codon_scheduler = 0 # 1: schedule one codon of one trajectory at a time on idle workers; 0: one worker per trajectory
+max_live_traj = 0 # maximum number of started but unfinished trajectories in codon scheduler; 0: twice the number 
+                  # of workers
+ff_cache_dir = '~/.cache/cg_simtk_ff' # directory of compiled force fields keyed by the hash of top/prm files and of 
+                                      # ribosome traffic results; '': always compile the force field and simulate the 
+                                      # ribosome traffic
+traj_container = 0 # 1: append frames and final structures of all stages to one chunked, compressed container 
+                   # traj/<id>/rnc_traj.rtc instead of writing DCD files of every stage; 0: write DCD files
+traj_container_atoms = 'nc' # atoms saved in the trajectory container. nc: nascent chain only; mobile: nascent chain 
+                            # and free ribosome atoms; all: the whole RNC
+fork_length = 0 # > 0: only fork_seeds seed trajectories elongate codons up to fork_length; the other trajectories 
+                # are branched from them at the end of codon fork_length and continue with their own random seeds 
+                # and dwell times; 0: all trajectories start from starting_strucs
+fork_seeds = 1 # number of seed trajectories in fork mode; they are the first fork_seeds trajectories
+traj_atoms = 'all' # atoms saved in DCD files. all: the whole RNC; mobile: nascent chain and free ribosome atoms, with 
+                   # topology rnc_l<N>_mobile.psf; the frozen ribosome is saved once per trajectory in rnc_static.npz
+traj_container_chunk = 100 # number of frames compressed together in one container record
+mts_steps = 1 # > 1: multiple time step integrator. Nascent chain - ribosome nonbonded and grid forces are evaluated 
+              # once per time step of mts_steps*timestep; all the other forces are evaluated every timestep. Steps 
+              # in outputs (including nsteps_save) count the outer time steps. 1: single time step integrator
+active_shell = 0 # 1: at each nascent chain length, only fixed ribosome atoms that the tethered nascent chain can reach 
+                 # interact with it in elongation stages; 0: all fixed ribosome atoms. Only used when 
+                 # persistent_context = 0
+active_shell_margin = 10 # margin (A) added to the maximum reach of the nascent chain in the active shell, which 
+                         # covers side chain beads and stretching of bonds
+work_queue = '' # SQLite file on a shared filesystem. Any number of instances of this script, on one or many nodes, 
+                # pull codons of the trajectories from it; '': run the trajectories on this node only
+work_queue_lease = 10 # minutes a codon stays assigned to an instance without renewal. Codons of crashed or 
+                      # preempted instances are run again by other instances after the lease expires
 
 if not os.path.exists(ctrlfile):
     print('Error: cannot find control file ' + ctrlfile + '.')
@@ -1487,6 +3774,25 @@ try:
         if line.startswith('initiation_rate'):
             words = line.split('=')
             initiation_rate = float(words[1].strip())
+        if line.startswith('traffic_num_ribosomes'):
+            words = line.split('=')
+            traffic_num_ribosomes = int(words[1].strip())
+            continue
+        if line.startswith('traffic_num_replicas'):
+            words = line.split('=')
+            traffic_num_replicas = int(words[1].strip())
+            continue
+        if line.startswith('traffic_footprint'):
+            words = line.split('=')
+            traffic_footprint = int(words[1].strip())
+            continue
+        if line.startswith('traffic_termination_rate'):
+            words = line.split('=')
+            traffic_termination_rate = float(words[1].strip())
+            continue
+        if line.startswith('traffic_seed'):
+            words = line.split('=')
+            traffic_seed = int(words[1].strip())
             continue
         if line.startswith('scale_factor'):
             words = line.split('=')
@@ -1504,6 +3810,86 @@ try:
             words = line.split('=')
             spherical_restraint_radius = float(words[1].strip())
             continue
+        if line.startswith('persistent_context'):
+            words = line.split('=')
+            persistent_context = int(words[1].strip())
+            continue
+        if line.startswith('save_stage_structures'):
+            words = line.split('=')
+            save_stage_structures = int(words[1].strip())
+            continue
+        if line.startswith('checkpoint_codons'):
+            words = line.split('=')
+            checkpoint_codons = int(words[1].strip())
+            continue
+        if line.startswith('checkpoint_minutes'):
+            words = line.split('=')
+            checkpoint_minutes = float(words[1].strip())
+            continue
+        if line.startswith('stage_checkpoint_minutes'):
+            words = line.split('=')
+            stage_checkpoint_minutes = float(words[1].strip())
+            continue
+        if line.startswith('ribosome_grid'):
+            words = line.split('=')
+            ribosome_grid = words[1].strip()
+            continue
+        if line.startswith('codon_scheduler'):
+            words = line.split('=')
+            codon_scheduler = int(words[1].strip())
+            continue
+        if line.startswith('max_live_traj'):
+            words = line.split('=')
+            max_live_traj = int(words[1].strip())
+            continue
+        if line.startswith('ff_cache_dir'):
+            words = line.split('=')
+            ff_cache_dir = words[1].strip()
+            continue
+        if line.startswith('fork_length'):
+            words = line.split('=')
+            fork_length = int(words[1].strip())
+            continue
+        if line.startswith('fork_seeds'):
+            words = line.split('=')
+            fork_seeds = int(words[1].strip())
+            continue
+        if line.startswith('traj_atoms'):
+            words = line.split('=')
+            traj_atoms = words[1].strip()
+            continue
+        if line.startswith('traj_container_atoms'):
+            words = line.split('=')
+            traj_container_atoms = words[1].strip()
+            continue
+        if line.startswith('traj_container_chunk'):
+            words = line.split('=')
+            traj_container_chunk = int(words[1].strip())
+            continue
+        if line.startswith('traj_container'):
+            words = line.split('=')
+            traj_container = int(words[1].strip())
+            continue
+        if line.startswith('mts_steps'):
+            words = line.split('=')
+            mts_steps = int(words[1].strip())
+            continue
+        if line.startswith('work_queue_lease'):
+            words = line.split('=')
+            work_queue_lease = float(words[1].strip())
+            continue
+        if line.startswith('work_queue'):
+            words = line.split('=')
+            work_queue = words[1].strip()
+            continue
+        if line.startswith('active_shell_margin'):
+            words = line.split('=')
+            active_shell_margin = float(words[1].strip())
+            continue
+        if line.startswith('active_shell'):
+            words = line.split('=')
+            active_shell = int(words[1].strip())
+            continue
 finally:
      file_object.close()
 
@@ -1574,25 +3960,115 @@ if ribosome_traffic == 1:
     if initiation_rate <= 0:
         print('Error: wrong initiation_rate value '+str(initiation_rate))
         sys.exit()
+    if traffic_num_ribosomes < 10:
+        print('Error: traffic_num_ribosomes must be at least 10.')
+        sys.exit()
+    if traffic_num_replicas < 1:
+        print('Error: traffic_num_replicas must be at least 1.')
+        sys.exit()
+    if traffic_footprint < 1:
+        print('Error: traffic_footprint must be at least 1.')
+        sys.exit()
+    if traffic_termination_rate <= 0:
+        print('Error: wrong traffic_termination_rate value '+str(traffic_termination_rate))
+        sys.exit()
 elif not ribosome_traffic == 0:
     print('Error: ribosome_traffic can only be set to 0 or 1.')
     sys.exit()
+if persistent_context != 0 and persistent_context != 1:
+    print('Error: persistent_context can only be set to 0 or 1.')
+    sys.exit()
+if save_stage_structures != 0 and save_stage_structures != 1:
+    print('Error: save_stage_structures can only be set to 0 or 1.')
+    sys.exit()
+if checkpoint_codons < 0 or checkpoint_minutes < 0:
+    print('Error: checkpoint_codons and checkpoint_minutes cannot be negative.')
+    sys.exit()
+if stage_checkpoint_minutes < 0:
+    print('Error: stage_checkpoint_minutes cannot be negative.')
+    sys.exit()
+if codon_scheduler != 0 and codon_scheduler != 1:
+    print('Error: codon_scheduler can only be set to 0 or 1.')
+    sys.exit()
+if max_live_traj < 0:
+    print('Error: max_live_traj cannot be negative.')
+    sys.exit()
+if fork_length < 0:
+    print('Error: fork_length cannot be negative.')
+    sys.exit()
+if fork_length > 0:
+    if fork_seeds < 1 or fork_seeds > num_traj:
+        print('Error: fork_seeds must be between 1 and num_traj.')
+        sys.exit()
+    if fork_length < start_nascent_chain_length or fork_length >= total_nascent_chain_length:
+        print('Error: fork_length must be between start_nascent_chain_length and total_nascent_chain_length-1.')
+        sys.exit()
+if traj_container != 0 and traj_container != 1:
+    print('Error: traj_container can only be set to 0 or 1.')
+    sys.exit()
+if traj_container_atoms != 'nc' and traj_container_atoms != 'mobile' and traj_container_atoms != 'all':
+    print('Error: traj_container_atoms can only be set to nc, mobile or all.')
+    sys.exit()
+if traj_atoms != 'all' and traj_atoms != 'mobile':
+    print('Error: traj_atoms can only be set to all or mobile.')
+    sys.exit()
+if traj_container_chunk <= 0:
+    print('Error: traj_container_chunk must be positive.')
+    sys.exit()
+if mts_steps < 1:
+    print('Error: mts_steps must be at least 1.')
+    sys.exit()
+if active_shell != 0 and active_shell != 1:
+    print('Error: active_shell can only be set to 0 or 1.')
+    sys.exit()
+if active_shell_margin < 0:
+    print('Error: active_shell_margin cannot be negative.')
+    sys.exit()
+if active_shell == 1 and persistent_context == 1:
+    print('Warning: active_shell is not used when persistent_context = 1.')
+    active_shell = 0
+if work_queue_lease <= 0:
+    print('Error: work_queue_lease must be positive.')
+    sys.exit()
+if ribosome_grid != '' and not os.path.exists(ribosome_grid):
+    print('Error: cannot find ribosome grid file '+ribosome_grid+'. Please create it using gen_ribosome_grid.py.')
+    sys.exit()
+if save_stage_structures == 0 and checkpoint_codons == 0 and checkpoint_minutes == 0 and stage_checkpoint_minutes == 0:
+    print('Warning: no stage structures or checkpoints will be saved. Restart will begin from the first codon.')
+
+# distributed mode: only the instance creating the work queue sets up the output and restart state of the trajectories
+queue_role = ''
+if work_queue != '':
+    queue_role = open_work_queue(work_queue)
+    if queue_role == 'join':
+        conn = connect_work_queue(work_queue)
+        row = conn.execute('SELECT COUNT(*) AS n, MIN(id) AS id FROM traj').fetchone()
+        conn.close()
+        if row['n'] != num_traj or row['id'] != start_traj_id:
+            print('Error: trajectories %d - %d in work queue %s are different from the control file.'%(row['id'], 
+                row['id']+row['n']-1, work_queue))
+            sys.exit()
 
 start_res = [start_nascent_chain_length for i in range(num_traj)]
+resume_stage = [0 for i in range(num_traj)] # 1: resume the unfinished codon from the stage checkpoint
 
 ribo_psf_pmd = pmd.charmm.psf.CharmmPsfFile(ribo_psf)
 prot_psf_pmd = pmd.charmm.psf.CharmmPsfFile(prot_psf)
-if restart == 1:
+if restart == 1 and queue_role != 'join':
     for i in range(1, num_traj + 1):
         traj_id = start_traj_id + i -1
         if os.path.exists('output/'+str(traj_id)+'.out'):
             last_nc = 0
             tag_done = 0
+            out_size = 0
+            finished_size = 0 # size of the output up to the last finished codon
             f = open('output/'+str(traj_id)+'.out', 'r')
             for line in f:
+                out_size += len(line)
                 if line.startswith('--> Elongation finished at length '):
                     words = line.strip().split()
                     last_nc = int(words[5])
+                    finished_size = out_size
                 elif line.startswith('--> All Done'):
                     tag_done = 1
             f.close()
@@ -1603,10 +4079,35 @@ if restart == 1:
                     start_res[i-1] = last_nc + 1
             else:
                 start_res[i-1] = len(prot_psf_pmd.residues) + 1
+
+            # restart from the latest saved structure
+            if (tag_done == 0 and start_res[i-1] > 1 and not 
+                os.path.exists('traj/%d/rnc_l%d_stage_3_final.cor'%(traj_id, start_res[i-1]-1))):
+                checkpoint_nc = 0
+                if os.path.exists('traj/%d/rnc_checkpoint.npz'%traj_id):
+                    (checkpoint_nc, positions) = load_rnc_checkpoint('traj/%d/rnc_checkpoint.npz'%traj_id)
+                    if checkpoint_nc > start_res[i-1]-1:
+                        checkpoint_nc = 0
+                if (fork_length > checkpoint_nc and fork_length <= start_res[i-1]-1 and 
+                    os.path.exists('traj/%d/rnc_fork.npz'%traj_id)):
+                    checkpoint_nc = fork_length
+                start_res[i-1] = checkpoint_nc + 1
+
+            # resume from the stage checkpoint if it was saved after the last finished codon
+            stage_checkpoint_file = 'traj/%d/rnc_stage_checkpoint.npz'%traj_id
+            if tag_done == 0 and os.path.exists(stage_checkpoint_file):
+                stage_checkpoint = load_stage_checkpoint(stage_checkpoint_file)
+                if stage_checkpoint['out_size'] > finished_size and stage_checkpoint['out_size'] <= out_size:
+                    start_res[i-1] = stage_checkpoint['nascent_chain_length']
+                    resume_stage[i-1] = 1
+                    # drop the output written after the checkpoint
+                    os.truncate('output/'+str(traj_id)+'.out', stage_checkpoint['out_size'])
+                else:
+                    os.remove(stage_checkpoint_file)
             
-            if last_nc == 0:
+            if resume_stage[i-1] == 0 and start_res[i-1] == 1:
                 os.system('rm -f output/'+str(traj_id)+'.out')
-            elif tag_done == 0:
+            elif resume_stage[i-1] == 0 and tag_done == 0:
                 f = open('output/'+str(traj_id)+'.out', 'r')
                 fo = open('output/new_'+str(traj_id)+'.out', 'w')
                 for line in f:
@@ -1659,27 +4160,67 @@ else:
 if ribosome_traffic == 1:
     log_head += 'Ribosome traffic effect will be considered\n'
     log_head += 'Translation-initiation rate: '+str(initiation_rate)+' s-1\n'
+    log_head += 'Number of ribosomes per mRNA in traffic calculation: '+str(traffic_num_ribosomes)+' x '+str(
+        traffic_num_replicas)+'\n'
+    log_head += 'Ribosome footprint in traffic calculation: '+str(traffic_footprint)+' codons\n'
+    log_head += 'Termination rate in traffic calculation: '+str(traffic_termination_rate)+' s-1\n'
+    log_head += 'Random seed of traffic calculation: '+str(traffic_seed)+'\n'
 else:
     log_head += 'Ribosome traffic effect will not be considered\n'
 
+if persistent_context == 1:
+    log_head += 'One persistent context will be used for each trajectory\n'
+else:
+    log_head += 'System will be re-created for each elongation stage\n'
+
+if save_stage_structures == 1:
+    log_head += 'Final structure of each elongation stage will be saved\n'
+else:
+    log_head += 'Final structure of each elongation stage will not be saved\n'
+if fork_length > 0:
+    log_head += 'Trajectories will be branched from '+str(fork_seeds)+' seed trajectories at length '+str(
+        fork_length)+'\n'
+if traj_container == 0 and traj_atoms == 'mobile':
+    log_head += 'Only mobile atoms will be saved in DCD files; frozen ribosome is saved in rnc_static.npz\n'
+if traj_container == 1:
+    log_head += 'Trajectories will be saved in container rnc_traj.rtc (atoms: '+traj_container_atoms+'; '+str(
+        traj_container_chunk)+' frames per record)\n'
+if checkpoint_codons > 0:
+    log_head += 'RNC checkpoint will be saved every '+str(checkpoint_codons)+' codons\n'
+if checkpoint_minutes > 0:
+    log_head += 'RNC checkpoint will be saved every '+str(checkpoint_minutes)+' minutes\n'
+if stage_checkpoint_minutes > 0:
+    log_head += 'State of the running stage will be saved every '+str(stage_checkpoint_minutes)+' minutes\n'
+
 if restart == 0:
     log_head += 'No restart requested\n'
 else:
     log_head += 'Restart requested\n'
+if queue_role == 'init':
+    log_head += 'Trajectories are set up in work queue '+work_queue+' (lease: '+str(work_queue_lease)+' minutes)\n'
+elif queue_role == 'join':
+    log_head += 'Join work queue '+work_queue+' (lease: '+str(work_queue_lease)+' minutes)\n'
 
 log_head += 'Starting structure: '+starting_strucs+'\n'
+if mts_steps > 1:
+    # steps in all outputs count the outer time steps
+    inner_timestep = timestep
+    timestep = round(timestep.value_in_unit(picoseconds)*mts_steps, 10)*picoseconds
+    log_head += 'Multiple time step integrator: nascent chain - ribosome forces every '+str(
+        timestep)+', other forces every '+str(inner_timestep)+'\n'
 log_head += 'File save steps: '+str(nsteps_save)+'\n'
 log_head += 'Time step: '+str(timestep)+'\n'
 log_head += 'Scaling factor: '+str(scale_factor)+'\n'
 
 if not os.path.exists('output'):
     os.mkdir('output')
-elif restart == 0:
+elif restart == 0 and queue_role != 'join':
     for i in range(num_traj):
         os.system('rm -f output/%d.out'%(i+start_traj_id))
+    os.system('rm -f output/fork_points.dat')
 if not os.path.exists('traj'):
     os.mkdir('traj')
-elif restart == 0:
+elif restart == 0 and queue_role != 'join':
     for i in range(num_traj):
         os.system('rm -rf traj/%d/'%(i+start_traj_id))
 ###### END Setup writing log files ######
@@ -1691,11 +4232,54 @@ if len(prot_psf_pmd.residues) < total_nascent_chain_length:
     print('Adjust total_nascent_chain_length to be '+str(total_nascent_chain_length))
 log_head += 'Total nascent chain length: '+str(total_nascent_chain_length)+'\n'
 
+# replace frozen ribosome atoms by precomputed grid potential
+if ribosome_grid != '':
+    ribo_grid = load_ribosome_grid(ribosome_grid)
+    if int(ribo_grid['n_ribo_atom']) != len(ribo_psf_pmd.atoms):
+        print('Error: ribosome grid %s was not generated for %s.'%(ribosome_grid, ribo_psf))
+        sys.exit()
+    if str(ribo_grid['free_mask']) != ribo_free_mask:
+        print('Error: ribo_free_mask used in ribosome grid (%s) is different from %s.'%(str(ribo_grid['free_mask']), 
+            ribo_free_mask))
+        sys.exit()
+    if (abs(float(ribo_grid['cutoff']) - nonbond_cutoff.value_in_unit(nanometer)) > 1e-8 or 
+        abs(float(ribo_grid['switch_cutoff']) - switch_cutoff.value_in_unit(nanometer)) > 1e-8):
+        print('Error: nonbonded cutoff used in ribosome grid is different from the current setting.')
+        sys.exit()
+    explicit_idx = set(ribo_grid['explicit_idx'].tolist())
+    ribo_sel = [atm.idx in explicit_idx for atm in ribo_psf_pmd.atoms]
+    ribo_psf_pmd = ribo_psf_pmd[ribo_sel]
+    # starting structure with explicit ribosome atoms only
+    ribo_coor = np.array(pmd.load_file(starting_strucs).positions.value_in_unit(angstroms))
+    ribo_psf_pmd.coordinates = ribo_coor[ribo_sel]
+    # frozen atoms represented by grid are still used to monitor the nascent chain-ribosome distance
+    ribo_grid['grid_coor'] = ribo_coor[np.logical_not(ribo_sel)]
+    grid_starting_strucs = starting_strucs.split('.cor')[0]+'_grid.cor'
+    # other instances sharing the work queue may be reading it
+    tmp_file = grid_starting_strucs.split('.cor')[0]+'.%d.tmp.cor'%os.getpid()
+    ribo_psf_pmd.save(tmp_file, format='charmmcrd', overwrite=True)
+    os.replace(tmp_file, grid_starting_strucs)
+    log_head += 'Frozen ribosome atoms are represented by grid potential: '+ribosome_grid+'\n'
+    log_head += 'Number of explicit ribosome atoms: '+str(len(ribo_psf_pmd.atoms))+'\n'
+else:
+    log_head += 'Frozen ribosome atoms are represented by explicit beads\n'
+if active_shell == 1:
+    log_head += 'Only fixed ribosome atoms within reach of the nascent chain + '+str(active_shell_margin)+' A + '+str(
+        nonbond_cutoff)+' interact with it in elongation stages\n'
+
 # ribosome resid list
 ribo_resid_list = []
 for res in ribo_psf_pmd.residues:
     ribo_resid_list.append(res.number)
 
+# full-length RNC topology and atom selections shared by all trajectories
+try:
+    rnc_index = build_rnc_index(prot_psf_pmd, ribo_psf_pmd, total_nascent_chain_length)
+except Exception as e:
+    traceback.print_exc()
+    print('Error: cannot parse ribo_free_mask or spherical_restraint_mask.')
+    sys.exit()
+
 ribo_coor = pmd.load_file(starting_strucs)
 restraint_coor = []
 for idx, coor in enumerate(ribo_coor.positions):
@@ -1705,25 +4289,40 @@ for idx, coor in enumerate(ribo_coor.positions):
         # select interaction sites around the peptidyl transferase center
         restraint_coor.append(coor)
 
+if ribosome_grid != '':
+    starting_strucs = grid_starting_strucs
+
+# distance of ribosome atoms to the tRNA 3' ends holding the nascent chain
+if active_shell == 1:
+    rnc_index['tether_dist'] = calc_tether_dist(rnc_index, starting_strucs)
+    if rnc_index['tether_dist'] is None:
+        print('Error: active_shell needs fixed 3\' end ribose (R) atoms of A- and P-site tRNAs (segid AtR and PtR).')
+        sys.exit()
+
 previous_rnc_cor_list = []
 for i in range(num_traj):
-    if start_res[i] == 1 or restart == 0:
+    if resume_stage[i] == 1:
+        previous_rnc_cor_list.append('rnc_stage_checkpoint.npz')
+    elif start_res[i] == 1 or restart == 0:
         previous_rnc_cor_list.append('../../'+starting_strucs)
-    else:
+    elif os.path.exists('traj/%d/rnc_l%d_stage_3_final.cor'%(start_traj_id+i, start_res[i]-1)):
         previous_rnc_cor_list.append('rnc_l'+str(start_res[i]-1)+'_stage_3_final.cor')
+    elif start_res[i]-1 == fork_length and os.path.exists('traj/%d/rnc_fork.npz'%(start_traj_id+i)):
+        previous_rnc_cor_list.append('rnc_fork.npz')
+    else:
+        previous_rnc_cor_list.append('rnc_checkpoint.npz')
 
-# combine ribosome forcefield with protein forcefield
-rnc_prm_file = combine_ribo_prot_param(ribo_param, prot_param)
-os.system('parse_cg_prm.py -t "'+ribo_top+' '+prot_top+'" -p '+rnc_prm_file)
-forcefield = ForceField(rnc_prm_file.split('.prm')[0]+'.xml')
-os.system('rm -f '+rnc_prm_file)
-os.system('mv '+rnc_prm_file.split('.prm')[0]+'.xml '+('/'.join(ribo_param.strip().split('/')[:-1]))+'/rnc.xml')
+# load compiled force field of the RNC
+if ff_cache_dir != '':
+    ff_cache_dir = os.path.expanduser(ff_cache_dir)
+(forcefield, ff_cache_file) = load_rnc_forcefield(ff_cache_dir)
+if ff_cache_file != '':
+    log_head += 'Compiled force field loaded from cache: '+ff_cache_file+'\n'
 
 # Build mean translation time list
 real_mean_fpt_list = []
 intrinsic_mean_fpt_list = []
 if not mrna_seq == '':
-    mrna_seq_file = mrna_seq
     f = open(mrna_seq)
     mrna_seq = f.read().strip().split('\n')
     mrna_seq = ''.join(mrna_seq)
@@ -1759,20 +4358,15 @@ if uniform_ta == 0:
         codon_list.append(codon)
 
     if ribosome_traffic == 1:
-        mrna_seq_prefix = '/'.join(mrna_seq_file.strip().split('/')[:-1])
-        mrna_data_file = mrna_seq_prefix+'/mrna_%d-%d.dat'%(start_traj_id, start_traj_id+num_traj-1)
-        fo = open(mrna_data_file, 'w')
-        fo.write(mrna_seq+'\n')
-        fo.close()
-        shell_out = os.popen('ribosome_traffic '+mrna_data_file+' '+trans_times+' '+str(initiation_rate)).readlines()
-        # populate map_resid_to_codon with codon positon : codon type pairs
+        (traffic_mfpt, n_cached) = ribosome_traffic_mfpt([mrna_seq], map_codon_to_mfpt, [initiation_rate], ff_cache_dir)
+        if n_cached > 0:
+            log_head += 'Ribosome traffic result loaded from cache\n'
         print('AA insertion time (s) considering ribosome traffic:')
         for i in range(int(len(mrna_seq)/3)):
             codon = mrna_seq[3*i]+mrna_seq[3*i+1]+mrna_seq[3*i+2]
-            real_mean_fpt_list.append(float(shell_out[i].strip()))
+            real_mean_fpt_list.append(float(traffic_mfpt[0, 0, i]))
             intrinsic_mean_fpt_list.append(map_codon_to_mfpt[codon])
-            print('%12.6f'%float(shell_out[i].strip()))
-        os.system('rm -f '+mrna_data_file)
+            print('%12.6f'%traffic_mfpt[0, 0, i])
     else:
         for i in range(int(len(mrna_seq)/3)):
             codon = mrna_seq[3*i]+mrna_seq[3*i+1]+mrna_seq[3*i+2]
@@ -1783,6 +4377,16 @@ else:
         intrinsic_mean_fpt_list.append(uniform_mfpt)
         real_mean_fpt_list.append(uniform_mfpt)
 # END Build mean translation time list
+
+# predicted remaining simulation steps from each nascent chain length, used to prioritize trajectories
+remaining_steps_list = [0 for i in range(total_nascent_chain_length+2)]
+for i in range(total_nascent_chain_length, 0, -1):
+    if real_mean_fpt_list[i-1]-intrinsic_mean_fpt_list[i-1] > 0:
+        mean_time_stage_2 = time_stage_2+real_mean_fpt_list[i-1]-intrinsic_mean_fpt_list[i-1]
+    else:
+        mean_time_stage_2 = time_stage_2
+    mean_time = time_stage_1 + mean_time_stage_2 + intrinsic_mean_fpt_list[i]-time_stage_1-time_stage_2
+    remaining_steps_list[i] = remaining_steps_list[i+1] + mean_time*1e9/scale_factor/timestep.value_in_unit(nanoseconds)
 # assign GPU device index
 dev_index_list = []
 if use_gpu != 0:
@@ -1803,70 +4407,60 @@ if use_gpu != 0:
 
 ###### Continuous Synthesis ######
 nprocess = int(tpn/ppn)
-log_file_object = open(log_file, 'w')
+if work_queue != '':
+    log_head += 'Codons will be pulled from the work queue by '+str(nprocess)+' workers\n'
+elif codon_scheduler == 1:
+    if max_live_traj == 0:
+        max_live_traj = 2*nprocess
+    log_head += 'Codons will be scheduled on '+str(nprocess)+' workers with up to '+str(max_live_traj)+' live trajectories\n'
 
 log_head += '\n%10s %10s %20s %15s %10s %15s\n'%('SIM_ID', 'START_LEN', 'SIM_STATUS', 'CURRENT_LEN', 'TIME_USED', 'SPEED (ns/d)')
-log_output = log_head
 start_str = []
+progress_list = []
 for i in range(1, num_traj + 1):
     start_str.append(str(start_res[i-1]))
-    log_output += '%10s %10s %20s %15s %10s %15s\n'%(str(start_traj_id+i-1), start_str[i-1], 'wait', '--', '--', '--')
-log_file_object.write(log_output)
-log_file_object.close()
+    if start_res[i-1] > total_nascent_chain_length:
+        progress_list.append({'length': str(total_nascent_chain_length), 'status': 'Done', 'speed': '--', 
+            'start_time': None, 'end_time': None})
+    else:
+        progress_list.append({'length': '--', 'status': 'wait', 'speed': '--', 'start_time': None, 'end_time': None})
+# workers publish their progress events to the main process through this queue
+progress_queue = multiprocessing.Queue()
+write_progress_log(progress_list)
 
-print('Setup process pool containing %d processors'%nprocess)
-pool = multiprocessing.Pool(nprocess)
-for i in range(1, num_traj + 1):
-    pool.apply_async(run_elongation, (start_traj_id+i-1, start_res[i-1], total_nascent_chain_length, previous_rnc_cor_list[i-1], ))
+if work_queue != '':
+    if queue_role == 'init':
+        init_work_queue(work_queue, start_res, previous_rnc_cor_list, progress_list)
+    print('Pull codons from work queue %s with %d workers'%(work_queue, nprocess))
+    run_queue_scheduler(nprocess, work_queue, progress_list)
+    print('All Done.')
+    sys.exit()
 
-start_time = [time.time() for i in range(num_traj)]
-end_time = [time.time() for i in range(num_traj)]
-while True:
-    time.sleep(sleep_time)
-    log_file_object = open(log_file,'w')
-    log_output = log_head
-    for i in range(1, num_traj + 1):
-        if os.path.exists('output/'+str(start_traj_id+i-1)+'.out'):
-            last_line = os.popen('grep "\\-\\-> Elongation at length" output/'+str(start_traj_id+i-1)+'.out | tail -n 1').read().strip()
-            if not last_line:
-                log_output += '%10s %10s %20s %15s %10s %15s\n'%(str(start_traj_id+i-1), start_str[i-1], 'wait', '--', '--', '--')
+if fork_length > 0:
+    # seed trajectories elongate the shared codons
+    seed_start_res = [start_res[i] if i < fork_seeds else fork_length+1 for i in range(num_traj)]
+    print('Elongate %d seed trajectories up to length %d'%(fork_seeds, fork_length))
+    run_synthesis(nprocess, seed_start_res, previous_rnc_cor_list, progress_list, fork_length)
+    for i in range(fork_seeds):
+        if start_res[i] <= fork_length:
+            if os.path.exists('traj/%d/rnc_fork.npz'%(start_traj_id+i)):
+                start_res[i] = fork_length+1
+                previous_rnc_cor_list[i] = 'rnc_fork.npz'
             else:
-                words = last_line.split()
-                current_length = int(words[4])
-                last_line = os.popen('tail -n 1 output/'+str(start_traj_id+i-1)+'.out').read().strip()
-                words = last_line.split()
-                if last_line.startswith('--> All Done'):
-                    status = 'Done'
-                    speed = '--'
-                    time_used = convert_time(end_time[i-1] - start_time[i-1])
-                elif last_line.endswith('--> Elongation finished at length %d'%(start_res[i-1]-1)):
-                    status = 'wait'
-                    current_length = min([current_length+1, total_nascent_chain_length])
-                    start_time[i-1] = time.time()
-                    time_used = '--'
-                    speed = '--'
-                elif words[0].endswith('%'):
-                    status = words[1]+'('+words[0]+')'
-                    speed = str(float(words[5]))
-                    end_time[i-1] = time.time()
-                    time_used = convert_time(end_time[i-1] - start_time[i-1])
-                else:
-                    status = 'minimizing'
-                    speed = '--'
-                    end_time[i-1] = time.time()
-                    time_used = convert_time(end_time[i-1] - start_time[i-1])
-                log_output += '%10s %10s %20s %15s %10s %15s\n'%(str(start_traj_id+i-1), start_str[i-1], status, str(current_length),
-                                                                 time_used, speed)
-        else:
-            start_time[i-1] = time.time()
-            log_output += '%10s %10s %20s %15s %10s %15s\n'%(str(start_traj_id+i-1), start_str[i-1], 'wait', '--', '--', '--')
-    log_file_object.write(log_output)
-    log_file_object.close()
-
-    if len(pool._cache) == 0:
-        print('All Done.')
-        break
-
-pool.close()
-pool.join()
+                # failed seed
+                start_res[i] = total_nascent_chain_length+1
+    # branch the other trajectories
+    for i in range(fork_seeds, num_traj):
+        if start_res[i] <= fork_length and resume_stage[i] == 0:
+            seed_id = start_traj_id + (i-fork_seeds)%fork_seeds
+            if fork_trajectory(start_traj_id+i, seed_id, fork_length):
+                start_res[i] = fork_length+1
+                previous_rnc_cor_list[i] = 'rnc_fork.npz'
+                start_str[i] = '%d@%d'%(fork_length+1, seed_id)
+            else:
+                print('Warning: seed trajectory %d did not reach length %d. Trajectory %d starts from %s.'%(seed_id, 
+                    fork_length, start_traj_id+i, starting_strucs))
+    write_progress_log(progress_list)
+run_synthesis(nprocess, start_res, previous_rnc_cor_list, progress_list, total_nascent_chain_length)
+print('All Done.')
 
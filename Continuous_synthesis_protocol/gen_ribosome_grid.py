@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+try:
+    from openmm.app import *
+    from openmm import *
+    from openmm.unit import *
+except:
+    from simtk.openmm.app import *
+    from simtk.openmm import *
+    from simtk.unit import *
+
+import getopt, os, sys, time, math
+import parmed as pmd
+import numpy as np
+
+usage = '\nUsage: python gen_ribosome_grid.py\n' \
+        '       --psf | -p <ribosome.psf> psf file of the truncated CG ribosome\n'\
+        '       --cor | -c <ribosome.cor> cor file of the truncated CG ribosome\n'\
+        '       --xml | -x <rnc.xml> OpenMM force field of the ribosome-nascent-chain complex created by\n'\
+        '                            continuous_synthesis_v7.py (in the same directory as ribosome prm file)\n'\
+        '       [--free | -f] <"L24 : 42 - 59"> ribo_free_mask used in continuous synthesis. Default is "".\n'\
+        '       [--spacing | -s] <0.05> grid spacing in nm. Default is 0.05.\n'\
+        '       [--box | -b] <"xmin xmax ymin ymax zmin zmax"> grid box in nm. Default is the bounding box\n'\
+        '                    of the frozen ribosome atoms extended by the nonbonded cutoff.\n'\
+        '       [--explicit_radius | -e] <1.0> frozen atoms within this distance in nm of a free atom keep\n'\
+        '                                explicit. Default is 1.0.\n'\
+        '       [--rclip | -r] <0.3> distance in nm below which pair potentials are capped. Default is 0.3.\n'\
+        '       [--tol | -t] <1e-6> relative singular value threshold for the LJ basis grids. Default is 1e-6.\n'\
+        '       [--outname | -o] <ribo_grid.npz> output file name. Default is ribo_grid.npz.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Precompute the potential of the frozen ribosome atoms on a 3D grid for the "grid ribosome" mode of\n'\
+        ' continuous_synthesis_v7.py (control option ribosome_grid). The Debye-Huckel term is stored as one grid\n'\
+        ' per unit charge; the 12-10-6 term of every bead type is expanded in a small set of basis grids\n'\
+        ' obtained from the singular value decomposition of the acoef/bcoef/ccoef tables. A-site and P-site\n'\
+        ' tRNA, free ribosome atoms and residues with frozen atoms within 3 bonds or explicit_radius of a free\n'\
+        ' atom stay explicit. The tricubic interpolation error decreases quickly with the grid spacing, but the\n'\
+        ' memory grows with its inverse cube; restrict the grid box to the region reachable by the nascent chain\n'\
+        ' and check the accuracy with validate_ribosome_grid.py.\n'
+
+nonbond_cutoff = 2.0 # nm, same as continuous_synthesis_v7.py
+switch_cutoff = 1.8 # nm, same as continuous_synthesis_v7.py
+r_scale = 0.4 # nm, typical contact distance used to weight r^-12, r^-10 and r^-6 terms in SVD
+
+# parse ribo_free_mask, same as continuous_synthesis_v7.py
+def parse_mask(struct, mask):
+    mask_idx = []
+    mask_list = mask.strip().split('|')
+    for m in mask_list:
+        sub_list = m.strip().split(':')
+        seg_mask = sub_list[0]
+        segid_list = seg_mask.strip().split(',')
+        segid_list = [s.strip() for s in segid_list]
+        if len(sub_list) == 2:
+            sub_mask = sub_list[1]
+            sub_list = sub_mask.strip().split('@')
+            res_mask = sub_list[0]
+            resid_list =res_mask.strip().split(',')
+            resid_list = [s.strip().split(' - ') for s in resid_list]
+            if len(sub_list) == 2:
+                atm_mask = sub_list[1]
+                atmnm_list =atm_mask.strip().split(',')
+                atmnm_list = [s.strip() for s in atmnm_list]
+            else:
+                atmnm_list = []
+        else:
+            resid_list = []
+            atmnm_list = []
+
+        for atm in struct.atoms:
+            if (atm.residue.segid in segid_list and atm.name in atmnm_list) or (segid_list == [] and atmnm_list == []) or (
+                segid_list == [] and atm.name in atmnm_list) or (atm.residue.segid in segid_list and atmnm_list == []):
+                resid = atm.residue.number
+                if resid_list == []:
+                    mask_idx.append(atm.idx)
+                    continue
+                for r in resid_list:
+                    if len(r) == 1 and resid == int(r[0]):
+                        mask_idx.append(atm.idx)
+                        break
+                    elif len(r) == 2 and resid >= int(r[0]) and resid <= int(r[1]):
+                        mask_idx.append(atm.idx)
+                        break
+    return mask_idx
+# END parse mask
+
+# switching function used by OpenMM CustomNonbondedForce
+def switch_function(r):
+    x = (r - switch_cutoff) / (nonbond_cutoff - switch_cutoff)
+    S = 1 - 10*x**3 + 15*x**4 - 6*x**5
+    S[r < switch_cutoff] = 1
+    S[r >= nonbond_cutoff] = 0
+    return S
+
+#################################### MAIN ####################################
+psf_file = ''
+cor_file = ''
+xml_file = ''
+ribo_free_mask = ''
+spacing = 0.05
+box = []
+explicit_radius = 1.0
+r_clip = 0.3
+tol = 1e-6
+outname = 'ribo_grid.npz'
+
+if len(sys.argv) == 1:
+    print(usage)
+    sys.exit()
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:],"hp:c:x:f:s:b:e:r:t:o:", ["psf=", "cor=", "xml=", "free=", "spacing=",
+        "box=", "explicit_radius=", "rclip=", "tol=", "outname="])
+except getopt.GetoptError:
+    print(usage)
+    sys.exit()
+for opt, arg in opts:
+    if opt == '-h':
+        print(usage)
+        sys.exit()
+    elif opt in ("-p", "--psf"):
+        psf_file = arg
+    elif opt in ("-c", "--cor"):
+        cor_file = arg
+    elif opt in ("-x", "--xml"):
+        xml_file = arg
+    elif opt in ("-f", "--free"):
+        ribo_free_mask = arg.strip()
+    elif opt in ("-s", "--spacing"):
+        spacing = float(arg)
+    elif opt in ("-b", "--box"):
+        box = [float(b) for b in arg.strip().split()]
+    elif opt in ("-e", "--explicit_radius"):
+        explicit_radius = float(arg)
+    elif opt in ("-r", "--rclip"):
+        r_clip = float(arg)
+    elif opt in ("-t", "--tol"):
+        tol = float(arg)
+    elif opt in ("-o", "--outname"):
+        outname = arg
+
+if psf_file == '' or cor_file == '' or xml_file == '':
+    print(usage)
+    sys.exit()
+if box != [] and len(box) != 6:
+    print('Error: grid box must be given as "xmin xmax ymin ymax zmin zmax".')
+    sys.exit()
+
+print('--> Reading ribosome structure')
+struct = pmd.charmm.psf.CharmmPsfFile(psf_file)
+cor = pmd.load_file(cor_file)
+coor = np.array(cor.positions.value_in_unit(nanometer))
+if len(coor) != len(struct.atoms):
+    print('Error: number of atoms in %s (%d) does not match %s (%d).'%(cor_file, len(coor), psf_file, len(struct.atoms)))
+    sys.exit()
+print('    Done.')
+
+## Select frozen atoms represented by grid ##
+if ribo_free_mask == '':
+    ribo_free_idx = []
+else:
+    ribo_free_idx = parse_mask(struct, ribo_free_mask)
+# frozen atoms within 3 bonds of a free atom keep explicit for bonded terms and exclusions
+bond_list = [[] for i in range(len(struct.atoms))]
+for bond in struct.bonds:
+    bond_list[bond.atom1.idx].append(bond.atom2.idx)
+    bond_list[bond.atom2.idx].append(bond.atom1.idx)
+anchor_idx = set(ribo_free_idx)
+shell = set(ribo_free_idx)
+for i in range(3):
+    shell = set([j for k in shell for j in bond_list[k]]) - anchor_idx
+    anchor_idx = anchor_idx | shell
+# frozen atoms close to free atoms keep explicit since the steep short-range repulsion is poorly interpolated
+for i in range(len(struct.atoms)):
+    if len(ribo_free_idx) > 0 and np.min(np.linalg.norm(coor[ribo_free_idx] - coor[i], axis=1)) <= explicit_radius:
+        anchor_idx.add(i)
+# whole residues keep explicit to match residue templates in the force field
+explicit_res = set([struct.atoms[i].residue.idx for i in anchor_idx])
+explicit_idx = []
+grid_idx = []
+for atm in struct.atoms:
+    if atm.residue.segid in ['A', 'AtR', 'PtR'] or atm.residue.idx in explicit_res:
+        explicit_idx.append(atm.idx)
+    else:
+        grid_idx.append(atm.idx)
+print('--> %d ribosome atoms will be represented by grid, %d atoms keep explicit'%(len(grid_idx), len(explicit_idx)))
+## END Select frozen atoms represented by grid ##
+
+## Read nonbonded parameters ##
+print('--> Reading force field parameters')
+forcefield = ForceField(xml_file)
+top = struct.topology
+template_map = {}
+for res in top.residues():
+    template_map[res] = res.name
+system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic,
+    nonbondedCutoff=nonbond_cutoff*nanometer, constraints=None, removeCMMotion=False,
+    ignoreExternalBonds=True, residueTemplates=template_map)
+for force in system.getForces():
+    if force.getName() == 'CustomNonbondedForce':
+        custom_nb_force = force
+        break
+param_name = [custom_nb_force.getPerParticleParameterName(i) for i in range(custom_nb_force.getNumPerParticleParameters())]
+nb_param = np.array([custom_nb_force.getParticleParameters(i) for i in grid_idx])
+ke = nb_param[:, param_name.index('ke')]
+kv = nb_param[:, param_name.index('kv')]
+ep = nb_param[:, param_name.index('ep')]
+ld = nb_param[:, param_name.index('ld')]
+charge = nb_param[:, param_name.index('charge')]
+type_index = nb_param[:, param_name.index('index')].astype(int)
+if np.ptp(ld) > 1e-8:
+    print('Error: Debye length ld must be the same for all frozen ribosome atoms.')
+    sys.exit()
+tables = {}
+for i in range(custom_nb_force.getNumTabulatedFunctions()):
+    (xsize, ysize, values) = custom_nb_force.getTabulatedFunction(i).getFunctionParameters()
+    tables[custom_nb_force.getTabulatedFunctionName(i)] = np.array(values).reshape(ysize, xsize)
+for name in ['acoef', 'bcoef', 'ccoef']:
+    if not name in tables:
+        print('Error: cannot find tabulated function %s in %s.'%(name, xml_file))
+        sys.exit()
+n_type = tables['acoef'].shape[0]
+print('    Done.')
+## END Read nonbonded parameters ##
+
+## Decompose 12-10-6 coefficients into basis ##
+# E_t(r) = kv_t * sum_(T,p) X_p[t,T] * G_(T,p)(r); G_(T,p) = sum_(j in type T) kv_j * r_j^-p
+print('--> Building basis of 12-10-6 terms')
+power_list = [12, 10, 6]
+grid_type = sorted(set(type_index))
+# bead types that can be mobile: types of free ribosome atoms and types not used by the ribosome (nascent chain, ligand)
+ribo_type = set([int(custom_nb_force.getParticleParameters(i)[param_name.index('index')]) for i in range(len(struct.atoms))])
+free_type = set([int(custom_nb_force.getParticleParameters(i)[param_name.index('index')]) for i in ribo_free_idx])
+mobile_type = sorted(free_type | (set(range(n_type)) - ribo_type))
+n_T = np.array([np.sum(type_index == T) for T in grid_type])
+M = np.hstack([tables[name][mobile_type][:, grid_type] for name in ['acoef', 'bcoef', 'ccoef']])
+D = np.hstack([n_T * r_scale**(-p) for p in power_list])
+(U, sv, Vt) = np.linalg.svd(M * D, full_matrices=False)
+n_basis = int(np.sum(sv > tol * sv[0]))
+weights = np.zeros((n_type, n_basis))
+weights[mobile_type] = U[:, :n_basis] * sv[:n_basis]
+weight_mask = np.zeros(n_type, dtype=bool)
+weight_mask[mobile_type] = True
+basis = (Vt[:n_basis].T / D[:, None]).reshape(len(power_list), len(grid_type), n_basis)
+print('    %d basis grids kept for %d mobile bead types (largest dropped singular value: %.3e)'%(n_basis, 
+    len(mobile_type), sv[n_basis]/sv[0] if n_basis < len(sv) else 0))
+## END Decompose 12-10-6 coefficients into basis ##
+
+## Setup grid ##
+if box == []:
+    box_min = coor[grid_idx].min(axis=0) - nonbond_cutoff
+    box_max = coor[grid_idx].max(axis=0) + nonbond_cutoff
+else:
+    box_min = np.array(box[0::2])
+    box_max = np.array(box[1::2])
+    print('Warning: interactions with frozen ribosome atoms are set to 0 outside of the grid box.')
+shape = np.ceil((box_max - box_min) / spacing).astype(int) + 1
+box_max = box_min + (shape - 1) * spacing
+mem = 64 * 4 * np.prod(shape - 1) * (n_basis + 1) / 1024**3
+print('--> Grid: %d x %d x %d points, spacing %.3f nm'%(shape[0], shape[1], shape[2], spacing))
+print('    Estimated memory of tricubic spline coefficients in OpenMM: %.2f GB'%mem)
+## END Setup grid ##
+
+## Calculate grid potential ##
+print('--> Calculating grid potential')
+start_time = time.time()
+phi = np.zeros((shape[2], shape[1], shape[0]))
+g = np.zeros((n_basis, shape[2], shape[1], shape[0]))
+type_map = {T: i for i, T in enumerate(grid_type)}
+for j in range(len(grid_idx)):
+    xyz = coor[grid_idx[j]]
+    i0 = np.maximum(np.ceil((xyz - nonbond_cutoff - box_min) / spacing).astype(int), 0)
+    i1 = np.minimum(np.floor((xyz + nonbond_cutoff - box_min) / spacing).astype(int), shape - 1)
+    if np.any(i1 < i0):
+        continue
+    gx = box_min[0] + spacing * np.arange(i0[0], i1[0]+1) - xyz[0]
+    gy = box_min[1] + spacing * np.arange(i0[1], i1[1]+1) - xyz[1]
+    gz = box_min[2] + spacing * np.arange(i0[2], i1[2]+1) - xyz[2]
+    r = np.sqrt(gz[:, None, None]**2 + gy[None, :, None]**2 + gx[None, None, :]**2)
+    r = np.maximum(r, r_clip)
+    S = switch_function(r)
+    sub = (slice(i0[2], i1[2]+1), slice(i0[1], i1[1]+1), slice(i0[0], i1[0]+1))
+    phi[sub] += ke[j] * charge[j] / ep[j] * np.exp(-r / ld[j]**2) / r * S
+    coef = kv[j] * basis[:, type_map[type_index[j]], :] # (power, basis)
+    F = np.array([r**(-p) * S for p in power_list]) # (power, z, y, x)
+    g[(slice(None),)+sub] += np.tensordot(coef, F, axes=([0], [0]))
+    if (j+1) % 500 == 0:
+        print('    %d / %d atoms done, %.1f s'%(j+1, len(grid_idx), time.time()-start_time))
+print('    Done in %.1f s'%(time.time()-start_time))
+## END Calculate grid potential ##
+
+np.savez_compressed(outname, origin=box_min, spacing=spacing, shape=shape, phi=phi, basis=g, weights=weights,
+    weight_mask=weight_mask, ld=ld[0], cutoff=nonbond_cutoff, switch_cutoff=switch_cutoff, r_clip=r_clip, free_mask=ribo_free_mask,
+    explicit_idx=np.array(explicit_idx, dtype=int), n_ribo_atom=len(struct.atoms))
+print('--> Grid saved to %s'%outname)
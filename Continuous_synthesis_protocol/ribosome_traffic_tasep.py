@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+# In-process TASEP model of ribosome traffic used by continuous_synthesis_v7.py in place of the ribosome_traffic
+# binary. Also imported by validate_ribosome_traffic.py, so that the comparison with the binary runs the same code.
+
+# Mean codon dwell times (s) under ribosome traffic from a TASEP model of translation
+# Ribosomes cover footprint codons, initiate at rate initiation_rate when the first footprint codons are free, hop
+# from codon i to i+1 at rate 1/codon_mfpt_list[i] when codon i+footprint is free and terminate from the stop codon
+# at rate termination_rate. Because every waiting time is exponential, the arrival time of ribosome k at codon i+1
+# is exactly
+#     A_k(i+1) = max(A_k(i), A_k-1(i+footprint+1)) + tau_k(i),
+# which is a running maximum along the mRNA. Each ribosome is thus one vectorized step for all mRNAs, initiation
+# rates and replicas in the batch instead of hundreds of Gillespie events.
+# codon_mfpt_list_list: list of intrinsic mean dwell time lists, one per mRNA (stop codon included)
+# initiation_rate_list: list of initiation rates (s-1)
+# num_ribosomes: number of ribosomes translating each mRNA replica; the first 10% are discarded as warm-up
+# num_replicas: number of independent mRNA replicas averaged
+# return mean_fpt_array[mRNA, initiation rate, codon]; entries beyond the length of a mRNA are 0
+def simulate_ribosome_traffic(codon_mfpt_list_list, initiation_rate_list, footprint=10, termination_rate=35.0,
+                              num_ribosomes=4000, num_replicas=16, seed=100):
+    L = footprint
+    n_mrna = len(codon_mfpt_list_list)
+    n_rate = len(initiation_rate_list)
+    n_codon = np.array([len(c) for c in codon_mfpt_list_list])
+    max_codon = n_codon.max()
+    # rows are (mRNA, initiation rate, replica); columns are codons padded with zero dwell times
+    mean_tau = np.zeros((n_mrna, max_codon))
+    for i, codon_mfpt_list in enumerate(codon_mfpt_list_list):
+        mean_tau[i, :n_codon[i]] = codon_mfpt_list
+        mean_tau[i, n_codon[i]-1] = 1/termination_rate
+    nrow = n_mrna * n_rate * num_replicas
+    mean_tau = np.repeat(mean_tau, n_rate * num_replicas, axis=0)
+    mean_init = np.tile(np.repeat(1/np.array(initiation_rate_list, dtype=float), num_replicas), n_mrna)
+    row_codon = np.repeat(n_codon, n_rate * num_replicas)
+    # the ribosome at codon i waits for the leading ribosome to leave codon i+L, which exists only if i+L <= N
+    codon_id = np.arange(1, max_codon+1)
+    blockable = codon_id[np.newaxis, :] + L <= row_codon[:, np.newaxis]
+    block_idx = np.minimum(codon_id + L, max_codon)
+    # initiation needs the leading ribosome beyond codon L (or terminated on mRNAs shorter than L)
+    init_idx = np.minimum(L, row_codon)
+
+    rng = np.random.RandomState(seed)
+    n_warmup = num_ribosomes // 10
+    # arrival[:, i] is the time the current ribosome arrives at codon i+1; arrival[:, N] is its termination time
+    arrival = np.full((nrow, max_codon+1), -np.inf)
+    arrival[:, 0] = 0
+    dwell_sum = np.zeros((nrow, max_codon))
+    for k in range(num_ribosomes):
+        tau = rng.standard_exponential((nrow, max_codon)) * mean_tau
+        cum_tau = np.cumsum(tau, axis=1)
+        if k == 0:
+            start = np.zeros(nrow)
+            barrier = np.full((nrow, max_codon), -np.inf)
+        else:
+            start = arrival[np.arange(nrow), init_idx] + rng.standard_exponential(nrow) * mean_init
+            barrier = np.where(blockable, arrival[:, block_idx], -np.inf)
+        # A(i+1) - S(i) = max(A(i) - S(i-1), B(i) - S(i-1)), S(i) = tau(1) + ... + tau(i)
+        shifted = np.empty((nrow, max_codon+1))
+        shifted[:, 0] = start
+        shifted[:, 1:] = barrier - (cum_tau - tau)
+        np.maximum.accumulate(shifted, axis=1, out=shifted)
+        arrival[:, 0] = start
+        arrival[:, 1:] = shifted[:, 1:] + cum_tau
+        if k >= n_warmup:
+            dwell_sum += np.diff(arrival, axis=1)
+    mean_fpt = dwell_sum / (num_ribosomes - n_warmup)
+    mean_fpt = mean_fpt.reshape((n_mrna, n_rate, num_replicas, max_codon)).mean(axis=2)
+    for i in range(n_mrna):
+        mean_fpt[i, :, n_codon[i]:] = 0
+    return mean_fpt
+# END Mean codon dwell times under ribosome traffic
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+import getopt, os, sys, struct, json, zlib
+import numpy as np
+
+usage = '\nUsage: python rnc_traj_container.py\n' \
+        '       --input | -i <rnc_traj.rtc> trajectory container written by continuous_synthesis_v7.py\n'\
+        '                                  (control option traj_container = 1), or a DCD file of mobile\n'\
+        '                                  atoms (control option traj_atoms = mobile) together with -l and -r\n'\
+        '       [--length | -l] <"10 - 20"> nascent chain lengths to select. Use " - " to select a range\n'\
+        '                       (space required) and "," to select multiple lengths. Default is all.\n'\
+        '       [--stage | -s] <"1,2,3"> stages to select (4: ejection; 5: dissociation). Default is all.\n'\
+        '       [--time | -t] <"tmin tmax"> in silico time range (ns) to select. Default is all.\n'\
+        '       [--final | -f] <0> 1: only select final structures of stages; 0: only select MD frames;\n'\
+        '                      2: select both. Default is 0.\n'\
+        '       [--outname | -o] <traj.dcd> write the selected frames to a DCD file. All selected frames\n'\
+        '                        must have the same number of atoms. Default is to print the index only.\n'\
+        '       [--static | -r] <rnc_static.npz> ribosome snapshot of the trajectory. If given, frames of the\n'\
+        '                       whole RNC are rebuilt from the saved nascent chain or mobile atoms. Free\n'\
+        '                       ribosome atoms are taken from the snapshot if only the nascent chain is saved.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Print the index (nascent chain length, stage, number of frames, steps and in silico time) of a\n'\
+        ' trajectory container or extract frames from it. The functions load_index(), iter_frames() and\n'\
+        ' read_frames() can be imported by analysis scripts to stream frames by length, stage or time.\n'
+
+# Trajectory container written by continuous_synthesis_v7.py
+# The container is a sequence of records appended to one file. A record is
+#     'RTC1', header length (uint32), JSON header, data length (uint64), zlib-compressed float32 coordinates (A)
+# and holds a chunk of frames of one stage. The header gives the nascent chain length, stage (4: ejection; 5: 
+# dissociation), index of the first frame in the stage, MD step and in silico time (ns, accumulated over the whole 
+# trajectory) of every frame, number and selection of atoms and whether the record is the final structure of the 
+# stage. A record torn by a crash is dropped when the container is opened again.
+# Scan the container; return (list of (offset, header) of complete records, end offset of the last complete record)
+# Also imported by continuous_synthesis_v7.py, so the writer and the readers share one parser of the format.
+def scan_traj_container(container_file):
+    record_list = []
+    end = 0
+    if not os.path.exists(container_file):
+        return (record_list, end)
+    file_size = os.path.getsize(container_file)
+    f = open(container_file, 'rb')
+    while True:
+        head = f.read(8)
+        if len(head) < 8 or head[:4] != b'RTC1':
+            break
+        header_size = struct.unpack('<I', head[4:])[0]
+        header = f.read(header_size)
+        data_size = f.read(8)
+        if len(header) < header_size or len(data_size) < 8:
+            break
+        data_size = struct.unpack('<Q', data_size)[0]
+        if end + 16 + header_size + data_size > file_size:
+            break
+        record_list.append((end, json.loads(header.decode())))
+        end += 16 + header_size + data_size
+        f.seek(end)
+    f.close()
+    return (record_list, end)
+# END Scan the trajectory container
+
+# Per-frame index of the container
+# return dict of arrays: length, stage, frame (index in the stage), step, time (ns), final, natom, record (index of
+# the record holding the frame)
+def load_index(container_file):
+    (record_list, end) = scan_traj_container(container_file)
+    index = {'length': [], 'stage': [], 'frame': [], 'step': [], 'time': [], 'final': [], 'natom': [], 'record': []}
+    for (i, (offset, header)) in enumerate(record_list):
+        nframe = len(header['step'])
+        index['length'] += [header['length']]*nframe
+        index['stage'] += [header['stage']]*nframe
+        index['frame'] += list(range(header['first_frame'], header['first_frame']+nframe))
+        index['step'] += header['step']
+        index['time'] += header['time']
+        index['final'] += [header['final']]*nframe
+        index['natom'] += [header['natom']]*nframe
+        index['record'] += [i]*nframe
+    for key in index.keys():
+        if key == 'time':
+            index[key] = np.array(index[key], dtype=float)
+        else:
+            index[key] = np.array(index[key], dtype=int)
+    return index
+# END Per-frame index of the container
+
+# Read the coordinates (nframe, natom, 3) in angstrom of one record
+def read_record(f, offset, header):
+    f.seek(offset+4)
+    header_size = struct.unpack('<I', f.read(4))[0]
+    f.seek(offset+8+header_size)
+    data_size = struct.unpack('<Q', f.read(8))[0]
+    coor = np.frombuffer(zlib.decompress(f.read(data_size)), dtype=np.float32)
+    return coor.reshape((len(header['step']), header['natom'], 3))
+# END Read one record
+
+# Stream frames of the container
+# length, stage: None or list of nascent chain lengths and stages to select
+# time_range: None or [tmin, tmax] in silico time (ns)
+# final: 0 only MD frames; 1 only final structures of stages; 2 both
+# yield (info, coor); info is a dict of length, stage, frame, step, time and final; coor (natom, 3) in angstrom
+# Only records holding selected frames are decompressed
+def iter_frames(container_file, length=None, stage=None, time_range=None, final=0):
+    (record_list, end) = scan_traj_container(container_file)
+    f = open(container_file, 'rb')
+    try:
+        for (offset, header) in record_list:
+            if length is not None and header['length'] not in length:
+                continue
+            if stage is not None and header['stage'] not in stage:
+                continue
+            if final != 2 and header['final'] != final:
+                continue
+            time_list = header['time']
+            if time_range is not None and (time_list[-1] < time_range[0] or time_list[0] > time_range[1]):
+                continue
+            coor = None
+            for i in range(len(time_list)):
+                if time_range is not None and (time_list[i] < time_range[0] or time_list[i] > time_range[1]):
+                    continue
+                if coor is None:
+                    coor = read_record(f, offset, header)
+                info = {'length': header['length'], 'stage': header['stage'], 'frame': header['first_frame']+i,
+                    'step': header['step'][i], 'time': time_list[i], 'final': header['final']}
+                yield (info, coor[i])
+    finally:
+        f.close()
+# END Stream frames of the container
+
+# Read the selected frames into memory; return (list of info, list of coor). See iter_frames().
+def read_frames(container_file, length=None, stage=None, time_range=None, final=0):
+    info_list = []
+    coor_list = []
+    for (info, coor) in iter_frames(container_file, length, stage, time_range, final):
+        info_list.append(info)
+        coor_list.append(coor)
+    return (info_list, coor_list)
+# END Read the selected frames
+
+# Load the ribosome snapshot rnc_static.npz saved by continuous_synthesis_v7.py
+def load_static_snapshot(static_file):
+    data = np.load(static_file)
+    static = {}
+    for key in ['ribo_coor', 'nc_natom', 'ribo_free_idx']:
+        static[key] = data[key]
+    return static
+# END Load the ribosome snapshot
+
+# Rebuild frames of the whole RNC with nascent_chain_length from frames of the saved atoms
+# coor: (natom, 3) or (nframe, natom, 3) in angstrom holding the nascent chain atoms, optionally followed by the free 
+# ribosome atoms (control option traj_atoms or traj_container_atoms = mobile)
+def expand_frames(static, nascent_chain_length, coor):
+    nc_natom = static['nc_natom'][nascent_chain_length]
+    ribo_free_idx = static['ribo_free_idx']
+    coor = np.asarray(coor)
+    shape = coor.shape[:-2]
+    full = np.empty(shape + (nc_natom+len(static['ribo_coor']), 3), dtype=coor.dtype)
+    full[..., nc_natom:, :] = static['ribo_coor']
+    full[..., :nc_natom, :] = coor[..., :nc_natom, :]
+    if coor.shape[-2] == nc_natom + len(ribo_free_idx):
+        full[..., nc_natom+ribo_free_idx, :] = coor[..., nc_natom:, :]
+    elif coor.shape[-2] != nc_natom:
+        raise ValueError('%d atoms in frame do not match %d nascent chain atoms and %d free ribosome atoms at length %d'
+            %(coor.shape[-2], nc_natom, len(ribo_free_idx), nascent_chain_length))
+    return full
+# END Rebuild frames of the whole RNC
+
+# parse selection string like "10 - 20, 25"
+def parse_int_list(sel):
+    int_list = []
+    for s in sel.strip().split(','):
+        s = s.strip().split(' - ')
+        if len(s) == 1:
+            int_list.append(int(s[0]))
+        else:
+            int_list += list(range(int(s[0]), int(s[1])+1))
+    return int_list
+# END parse selection string
+
+#################################### MAIN ####################################
+if __name__ == '__main__':
+    container_file = ''
+    length = None
+    stage = None
+    time_range = None
+    final = 0
+    outname = ''
+    static_file = ''
+
+    if len(sys.argv) == 1:
+        print(usage)
+        sys.exit()
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hi:l:s:t:f:o:r:", ["input=", "length=", "stage=", "time=", 
+            "final=", "outname=", "static="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit()
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ("-i", "--input"):
+            container_file = arg
+        elif opt in ("-l", "--length"):
+            length = parse_int_list(arg)
+        elif opt in ("-s", "--stage"):
+            stage = parse_int_list(arg)
+        elif opt in ("-t", "--time"):
+            time_range = [float(t) for t in arg.strip().split()]
+        elif opt in ("-f", "--final"):
+            final = int(arg)
+        elif opt in ("-o", "--outname"):
+            outname = arg
+        elif opt in ("-r", "--static"):
+            static_file = arg
+
+    if not os.path.exists(container_file):
+        print('Error: cannot find trajectory container '+container_file+'.')
+        sys.exit()
+    if time_range is not None and len(time_range) != 2:
+        print('Error: wrong time range specified.')
+        sys.exit()
+    if final not in [0, 1, 2]:
+        print('Error: final can only be set to 0, 1 or 2.')
+        sys.exit()
+    if static_file != '' and not os.path.exists(static_file):
+        print('Error: cannot find ribosome snapshot '+static_file+'.')
+        sys.exit()
+    is_dcd = container_file.endswith('.dcd')
+    if is_dcd and (static_file == '' or outname == '' or length is None or len(length) != 1):
+        print('Error: DCD input needs the ribosome snapshot (-r), one nascent chain length (-l) and output (-o).')
+        sys.exit()
+    static = None
+    if static_file != '':
+        static = load_static_snapshot(static_file)
+
+    if is_dcd:
+        import mdtraj as md
+        dcd_in = md.formats.DCDTrajectoryFile(container_file, 'r')
+        dcd = md.formats.DCDTrajectoryFile(outname, 'w', force_overwrite=True)
+        nframe = 0
+        while True:
+            (xyz, cell_lengths, cell_angles) = dcd_in.read(100)
+            if len(xyz) == 0:
+                break
+            dcd.write(expand_frames(static, length[0], xyz))
+            nframe += len(xyz)
+        dcd_in.close()
+        dcd.close()
+        print('%d frames written to %s'%(nframe, outname))
+    elif outname == '':
+        print('%8s %6s %8s %8s %12s %14s %14s'%('Length', 'Stage', 'Final', 'Frames', 'Atoms', 'Time_start(ns)',
+            'Time_end(ns)'))
+        (record_list, end) = scan_traj_container(container_file)
+        # merge the records of one stage
+        summary = []
+        for (offset, header) in record_list:
+            key = (header['length'], header['stage'], header['final'])
+            if len(summary) > 0 and summary[-1][0] == key:
+                summary[-1][1] += len(header['step'])
+                summary[-1][4] = header['time'][-1]
+            else:
+                summary.append([key, len(header['step']), header['natom'], header['time'][0], header['time'][-1]])
+        for (key, nframe, natom, t0, t1) in summary:
+            if length is not None and key[0] not in length:
+                continue
+            if stage is not None and key[1] not in stage:
+                continue
+            print('%8d %6d %8d %8d %12d %14.4f %14.4f'%(key[0], key[1], key[2], nframe, natom, t0, t1))
+        if end != os.path.getsize(container_file):
+            print('Warning: %d bytes of incomplete record at the end of the container.'%(
+                os.path.getsize(container_file) - end))
+    else:
+        import mdtraj as md
+        nframe = 0
+        natom = None
+        dcd = None
+        for (info, coor) in iter_frames(container_file, length, stage, time_range, final):
+            if static is not None:
+                coor = expand_frames(static, info['length'], coor)
+            if natom is None:
+                natom = len(coor)
+                dcd = md.formats.DCDTrajectoryFile(outname, 'w', force_overwrite=True)
+            elif len(coor) != natom:
+                print('Error: number of atoms changes from %d to %d at length %d stage %d. Please select frames '
+                    'of one nascent chain length.'%(natom, len(coor), info['length'], info['stage']))
+                dcd.close()
+                sys.exit()
+            dcd.write(coor[np.newaxis, :, :])
+            nframe += 1
+        if dcd is not None:
+            dcd.close()
+        print('%d frames written to %s'%(nframe, outname))
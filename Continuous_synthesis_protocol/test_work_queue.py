@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import getopt, os, sys, time, signal, subprocess, sqlite3, shlex
+
+usage = '\nUsage: python test_work_queue.py\n' \
+        '       --ctrlfile | -f <cont_synth.cntrl> control file of a small continuous synthesis campaign. Paths\n'\
+        '                      in it are relative to the current directory, which must not contain output/ or\n'\
+        '                      traj/ of an earlier run.\n'\
+        '       [--instances | -n] <2> number of instances of continuous_synthesis_v7.py started on this node.\n'\
+        '                      Each instance runs tpn workers of the control file. Default is 2.\n'\
+        '       [--lease | -l] <1> work_queue_lease (minutes) of the test queue. Default is 1.\n'\
+        '       [--kill | -k] <0> kill the last instance and its workers after this many seconds, so that its\n'\
+        '                      codons are taken over by the other instances after the lease expires.\n'\
+        '                      0: no instance is killed. Default is 0.\n'\
+        '       [--python | -p] <"python"> command to run python. Default is the interpreter of this script.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Run several instances of continuous_synthesis_v7.py against one toy work queue in the current directory\n'\
+        ' and check the result. The control file is copied to <ctrlfile>.queue_test with the options work_queue =\n'\
+        ' work_queue_test.db and work_queue_lease appended; the output of instance k is written to\n'\
+        ' queue_test_<k>.log. After all instances exit, every trajectory must be done in the queue, and its\n'\
+        ' output/<id>.out must contain each codon exactly once and in order.\n'
+
+queue_file = 'work_queue_test.db'
+
+# read total_nascent_chain_length, start_nascent_chain_length and num_traj of the control file
+def parse_ctrl(ctrl_file):
+    info = {'total_nascent_chain_length': 0, 'start_nascent_chain_length': 1, 'num_traj': 1}
+    f = open(ctrl_file, 'r')
+    for line in f:
+        line = line.strip()
+        for key in info.keys():
+            if line.startswith(key):
+                words = line.split('=')
+                info[key] = int(words[1].strip())
+    f.close()
+    return info
+# END read the control file
+
+# check the codon sequence of one output file
+# return list of problems (empty if the output is complete)
+def check_output(out_file, info):
+    problem_list = []
+    if not os.path.exists(out_file):
+        return ['missing '+out_file]
+    start_list = []
+    finish_list = []
+    all_done = 0
+    f = open(out_file, 'r')
+    for line in f:
+        line = line.strip()
+        if line.startswith('--> Elongation at length '):
+            start_list.append(int(line.split()[4]))
+        elif line.startswith('--> Elongation finished at length '):
+            finish_list.append(int(line.split()[-1]))
+        elif line == '--> All Done':
+            all_done += 1
+    f.close()
+    for L in set(start_list):
+        if start_list.count(L) > 1:
+            problem_list.append('codon %d started %d times'%(L, start_list.count(L)))
+    for L in set(finish_list):
+        if finish_list.count(L) > 1:
+            problem_list.append('codon %d finished %d times'%(L, finish_list.count(L)))
+    if finish_list != sorted(finish_list):
+        problem_list.append('codons finished out of order')
+    if all_done > 1:
+        problem_list.append('"All Done" written %d times'%all_done)
+    if all_done == 0:
+        if len(finish_list) == 0 or finish_list[-1] != info['total_nascent_chain_length']:
+            problem_list.append('last codon %d not finished'%info['total_nascent_chain_length'])
+        elif finish_list != list(range(finish_list[0], finish_list[-1]+1)):
+            problem_list.append('missing codons')
+    return problem_list
+# END check the codon sequence
+
+if __name__ == '__main__':
+    ctrl_file = ''
+    ninstance = 2
+    lease = 1.0
+    kill_time = 0.0
+    python_cmd = [sys.executable]
+
+    if len(sys.argv) == 1:
+        print(usage)
+        sys.exit()
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hf:n:l:k:p:", ["ctrlfile=", "instances=", "lease=", "kill=",
+            "python="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit()
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ("-f", "--ctrlfile"):
+            ctrl_file = arg
+        elif opt in ("-n", "--instances"):
+            ninstance = int(arg)
+        elif opt in ("-l", "--lease"):
+            lease = float(arg)
+        elif opt in ("-k", "--kill"):
+            kill_time = float(arg)
+        elif opt in ("-p", "--python"):
+            python_cmd = shlex.split(arg)
+
+    if not os.path.exists(ctrl_file):
+        print('Error: cannot find control file '+ctrl_file+'.')
+        sys.exit()
+    for path in ['output', 'traj', queue_file]:
+        if os.path.exists(path):
+            print('Error: %s exists. Please run the test in a clean copy of the setup directory.'%path)
+            sys.exit()
+    if ninstance < 2:
+        print('Error: at least 2 instances are needed.')
+        sys.exit()
+    info = parse_ctrl(ctrl_file)
+
+    test_ctrl_file = ctrl_file+'.queue_test'
+    fo = open(test_ctrl_file, 'w')
+    fo.write(open(ctrl_file, 'r').read().rstrip('\n')+'\n')
+    # later lines of the control file take precedence
+    fo.write('work_queue_lease = %s\n'%str(lease))
+    fo.write('work_queue = %s\n'%queue_file)
+    fo.close()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'continuous_synthesis_v7.py')
+    proc_list = []
+    start_time = time.time()
+    for k in range(ninstance):
+        log = open('queue_test_%d.log'%(k+1), 'w')
+        # each instance in its own process group, so that it can be killed with its workers
+        proc_list.append(subprocess.Popen(python_cmd+[script, '-f', test_ctrl_file], stdout=log,
+            stderr=subprocess.STDOUT, start_new_session=True))
+        print('Instance %d started (pid %d)'%(k+1, proc_list[-1].pid))
+        # the first instance sets up the queue
+        time.sleep(1)
+    killed = False
+    while any([proc.poll() == None for proc in proc_list]):
+        if kill_time > 0 and not killed and time.time() - start_time >= kill_time:
+            os.killpg(proc_list[-1].pid, signal.SIGKILL)
+            killed = True
+            print('Instance %d killed after %.0f s'%(ninstance, time.time()-start_time))
+        time.sleep(1)
+    print('All instances exited after %.0f s'%(time.time()-start_time))
+
+    # check the queue and the output files
+    nfail = 0
+    conn = sqlite3.connect(queue_file)
+    conn.row_factory = sqlite3.Row
+    print('%10s %10s %10s %10s   %s'%('SIM_ID', 'STATE', 'LENGTH', 'ATTEMPTS', 'CHECK'))
+    for row in conn.execute('SELECT id, state, length, attempts FROM traj ORDER BY id').fetchall():
+        problem_list = check_output('output/%d.out'%row['id'], info)
+        if row['state'] != 'done':
+            problem_list.insert(0, 'state '+row['state'])
+        if len(problem_list) > 0:
+            nfail += 1
+            check = 'FAIL: '+'; '.join(problem_list)
+        else:
+            check = 'OK'
+        print('%10d %10s %10d %10d   %s'%(row['id'], row['state'], row['length'], row['attempts'], check))
+    conn.close()
+    if nfail == 0:
+        print('Work queue test passed')
+    else:
+        print('Work queue test failed: %d trajectories'%nfail)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+import getopt, os, sys, math
+import parmed as pmd
+import numpy as np
+from scipy.stats import ks_2samp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from rnc_traj_container import scan_traj_container, read_record
+
+usage = '\nUsage: python validate_mts.py\n' \
+        '       --ref | -r <dir> directory of continuous synthesis run with the single time step integrator\n'\
+        '                        (control option mts_steps = 1)\n'\
+        '       --test | -t <dir> directory of continuous synthesis run with the multiple time step integrator\n'\
+        '                         (control option mts_steps > 1). All the other control options should be the same.\n'\
+        '       [--log | -g] <info.log> log file name of continuous_synthesis_v7.py in both directories.\n'\
+        '                    Default is info.log.\n'\
+        '       [--native | -n] <protein.cor> native structure of the CG protein. Default is the cor file next\n'\
+        '                       to the protein psf file given in the log file of the reference run.\n'\
+        '       [--length | -l] <"10 - 20"> nascent chain lengths to compare Q. Use " - " to select a range\n'\
+        '                       (space required) and "," to select multiple lengths. Default is all.\n'\
+        '       [--outname | -o] <mts_validation.dat> output file. Default is mts_validation.dat.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Compare distributions of the fraction of native contacts (Q) of the nascent chain at the end of each\n'\
+        ' codon and after ejection, and of the ejection time, between the two runs. Q is computed with the\n'\
+        ' native contacts of CA atoms (|i-j| >= 4, d <= 8 A) formed within 1.2 times of their native distances.\n'\
+        ' Final structures are taken from rnc_l<N>_stage_3_final.cor and rnc_l<N>_ejection_final.cor, or from\n'\
+        ' the trajectory container rnc_traj.rtc (control option traj_container = 1).\n'\
+        ' For each observable the output lists the mean and standard error in both runs, the difference of\n'\
+        ' means in units of its standard error (z), and the two-sample Kolmogorov-Smirnov statistic and p value.\n'
+
+# parse selection string like "10 - 20, 25"
+def parse_int_list(sel):
+    int_list = []
+    for s in sel.strip().split(','):
+        s = s.strip().split(' - ')
+        if len(s) == 1:
+            int_list.append(int(s[0]))
+        else:
+            int_list += list(range(int(s[0]), int(s[1])+1))
+    return int_list
+# END parse selection string
+
+# parse the log file of continuous_synthesis_v7.py
+def parse_log(log_file):
+    info = {'start_traj_id': 1, 'mts': 'no'}
+    f = open(log_file, 'r')
+    for line in f:
+        if line.startswith('Trajectories start at: '):
+            info['start_traj_id'] = int(line.split()[-1])
+        elif line.startswith('Number of trajectories: '):
+            info['num_traj'] = int(line.split()[-1])
+        elif line.startswith('Protein psf file: '):
+            info['prot_prefix'] = line.split()[-1].split('.psf')[0]
+        elif line.startswith('File save steps: '):
+            info['nsave'] = int(line.split()[-1])
+        elif line.startswith('Time step: '):
+            info['dt'] = float(line.split()[-2]) # ps
+        elif line.startswith('Multiple time step integrator: '):
+            info['mts'] = 'yes'
+    f.close()
+    for key in ['num_traj', 'prot_prefix', 'nsave', 'dt']:
+        if not key in info.keys():
+            print('Error: cannot find "%s" in %s.'%(key, log_file))
+            sys.exit()
+    return info
+# END parse the log file
+
+# native contacts of CA atoms
+# return (list of atom index of CA atoms, pairs (i, j) of residue index, native distances)
+def native_contacts(native_cor, cutoff=8.0):
+    crd = pmd.charmm.CharmmCrdFile(native_cor)
+    coor = np.array(crd.coordinates).reshape((-1, 3))
+    ca_idx = np.array([i for i in range(len(coor)) if crd.atname[i].strip() == 'A'])
+    d = np.linalg.norm(coor[ca_idx][:, np.newaxis, :] - coor[ca_idx][np.newaxis, :, :], axis=2)
+    (i_list, j_list) = np.nonzero(np.triu(d <= cutoff, k=4))
+    return (ca_idx, np.array([i_list, j_list]).T, d[i_list, j_list])
+# END native contacts
+
+# fraction of native contacts among the first nascent_chain_length residues
+# coor: (natom, 3) in angstrom, nascent chain atoms come first
+def calc_Q(coor, contacts, nascent_chain_length, sdist=1.2):
+    (ca_idx, pairs, d_native) = contacts
+    sel = pairs[:, 1] < nascent_chain_length
+    if np.sum(sel) == 0:
+        return np.nan
+    pairs = pairs[sel]
+    d = np.linalg.norm(coor[ca_idx[pairs[:, 0]]] - coor[ca_idx[pairs[:, 1]]], axis=1)
+    return np.mean(d <= sdist*d_native[sel])
+# END fraction of native contacts
+
+# Q at the end of each codon and after ejection, and ejection time (ns) of one trajectory
+def analyze_traj(run_dir, traj_id, info, contacts):
+    Q_codon = {}
+    Q_eject = None
+    t_eject = None
+    traj_dir = os.path.join(run_dir, 'traj', str(traj_id))
+    out_file = os.path.join(run_dir, 'output', str(traj_id)+'.out')
+    if not os.path.exists(out_file):
+        return (Q_codon, Q_eject, t_eject)
+
+    # ejection time from the number of steps in the ejection stage
+    tag_eject = 0
+    eject_length = None
+    f = open(out_file, 'r')
+    for line in f:
+        if line.startswith('--> Elongation termination at length '):
+            eject_length = int(line.split()[-1])
+        elif line.startswith('--> Nascent chain ejection'):
+            tag_eject = 1
+        elif line.strip().startswith('Done at step ') and tag_eject == 1:
+            t_eject = int(line.split()[-1]) * info['dt'] / 1000
+            tag_eject = 0
+    f.close()
+
+    # final structures of stage 3 and ejection
+    container_file = os.path.join(traj_dir, 'rnc_traj.rtc')
+    if os.path.exists(container_file):
+        (record_list, end) = scan_traj_container(container_file)
+        fc = open(container_file, 'rb')
+        for (offset, header) in record_list:
+            if header['final'] == 1 and header['stage'] in [3, 4]:
+                coor = read_record(fc, offset, header)[-1]
+                Q = calc_Q(coor, contacts, header['length'])
+                if header['stage'] == 3:
+                    Q_codon[header['length']] = Q
+                else:
+                    Q_eject = Q
+        fc.close()
+    elif os.path.exists(traj_dir):
+        for file in os.listdir(traj_dir):
+            if file.startswith('rnc_l') and file.endswith('_stage_3_final.cor'):
+                L = int(file[5:].split('_')[0])
+                coor = np.array(pmd.charmm.CharmmCrdFile(os.path.join(traj_dir, file)).coordinates).reshape((-1, 3))
+                Q_codon[L] = calc_Q(coor, contacts, L)
+        if eject_length is not None:
+            cor_file = os.path.join(traj_dir, 'rnc_l%d_ejection_final.cor'%eject_length)
+            if os.path.exists(cor_file):
+                coor = np.array(pmd.charmm.CharmmCrdFile(cor_file).coordinates).reshape((-1, 3))
+                Q_eject = calc_Q(coor, contacts, eject_length)
+    return (Q_codon, Q_eject, t_eject)
+# END analyze one trajectory
+
+# collect observables of all trajectories in one run
+def analyze_run(run_dir, info, contacts):
+    data = {'Q_codon': {}, 'Q_eject': [], 't_eject': []}
+    for traj_id in range(info['start_traj_id'], info['start_traj_id']+info['num_traj']):
+        (Q_codon, Q_eject, t_eject) = analyze_traj(run_dir, traj_id, info, contacts)
+        for (L, Q) in Q_codon.items():
+            if not np.isnan(Q):
+                data['Q_codon'].setdefault(L, []).append(Q)
+        if Q_eject is not None and not np.isnan(Q_eject):
+            data['Q_eject'].append(Q_eject)
+        if t_eject is not None:
+            data['t_eject'].append(t_eject)
+    return data
+# END collect observables of one run
+
+# compare two samples
+# return (n1, mean1, se1, n2, mean2, se2, z, ks_D, ks_p)
+def compare_samples(x1, x2):
+    x1 = np.array(x1, dtype=float)
+    x2 = np.array(x2, dtype=float)
+    result = []
+    for x in [x1, x2]:
+        if len(x) > 1:
+            result += [len(x), np.mean(x), np.std(x, ddof=1)/len(x)**0.5]
+        elif len(x) == 1:
+            result += [1, x[0], np.nan]
+        else:
+            result += [0, np.nan, np.nan]
+    se = (result[2]**2 + result[5]**2)**0.5
+    if se > 0:
+        z = (result[4] - result[1]) / se
+    else:
+        z = np.nan
+    if len(x1) > 0 and len(x2) > 0:
+        ks = ks_2samp(x1, x2)
+        result += [z, ks[0], ks[1]]
+    else:
+        result += [z, np.nan, np.nan]
+    return result
+# END compare two samples
+
+#################################### MAIN ####################################
+if __name__ == '__main__':
+    ref_dir = ''
+    test_dir = ''
+    log_file = 'info.log'
+    native_cor = ''
+    length = None
+    outname = 'mts_validation.dat'
+
+    if len(sys.argv) == 1:
+        print(usage)
+        sys.exit()
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hr:t:g:n:l:o:", ["ref=", "test=", "log=", "native=", "length=",
+            "outname="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit()
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ("-r", "--ref"):
+            ref_dir = arg
+        elif opt in ("-t", "--test"):
+            test_dir = arg
+        elif opt in ("-g", "--log"):
+            log_file = arg
+        elif opt in ("-n", "--native"):
+            native_cor = arg
+        elif opt in ("-l", "--length"):
+            length = parse_int_list(arg)
+        elif opt in ("-o", "--outname"):
+            outname = arg
+
+    for run_dir in [ref_dir, test_dir]:
+        if not os.path.exists(os.path.join(run_dir, log_file)):
+            print('Error: cannot find log file '+os.path.join(run_dir, log_file)+'.')
+            sys.exit()
+    ref_info = parse_log(os.path.join(ref_dir, log_file))
+    test_info = parse_log(os.path.join(test_dir, log_file))
+    if native_cor == '':
+        native_cor = os.path.join(ref_dir, ref_info['prot_prefix']+'.cor')
+    if not os.path.exists(native_cor):
+        print('Error: cannot find native structure '+native_cor+'.')
+        sys.exit()
+    if ref_info['mts'] == 'yes':
+        print('Warning: reference run %s used the multiple time step integrator.'%ref_dir)
+    if test_info['mts'] == 'no':
+        print('Warning: test run %s used the single time step integrator.'%test_dir)
+
+    contacts = native_contacts(native_cor)
+    print('%d native contacts found in %s'%(len(contacts[1]), native_cor))
+    ref_data = analyze_run(ref_dir, ref_info, contacts)
+    test_data = analyze_run(test_dir, test_info, contacts)
+
+    row_list = []
+    L_list = sorted(set(ref_data['Q_codon'].keys()) | set(test_data['Q_codon'].keys()))
+    if length is not None:
+        L_list = [L for L in L_list if L in length]
+    for L in L_list:
+        row_list.append(['Q_l%d'%L] + compare_samples(ref_data['Q_codon'].get(L, []),
+            test_data['Q_codon'].get(L, [])))
+    row_list.append(['Q_ejection'] + compare_samples(ref_data['Q_eject'], test_data['Q_eject']))
+    row_list.append(['t_ejection(ns)'] + compare_samples(ref_data['t_eject'], test_data['t_eject']))
+
+    fo = open(outname, 'w')
+    fo.write('# Reference: %s (time step %.4f ps, ejection checked every %.4f ns)\n'%(ref_dir, ref_info['dt'],
+        ref_info['dt']*ref_info['nsave']/1000))
+    fo.write('# Test: %s (time step %.4f ps, ejection checked every %.4f ns)\n'%(test_dir, test_info['dt'],
+        test_info['dt']*test_info['nsave']/1000))
+    fo.write('%-16s %6s %12s %12s %6s %12s %12s %8s %8s %10s\n'%('Observable', 'N_ref', 'Mean_ref', 'SE_ref',
+        'N_test', 'Mean_test', 'SE_test', 'z', 'KS_D', 'KS_p'))
+    for row in row_list:
+        fo.write('%-16s %6d %12.4f %12.4f %6d %12.4f %12.4f %8.3f %8.4f %10.4g\n'%tuple(row))
+    fo.close()
+
+    # summary
+    z_list = np.array([row[7] for row in row_list if not np.isnan(row[7])])
+    p_list = np.array([row[9] for row in row_list if not np.isnan(row[9])])
+    print('%d observables compared'%len(row_list))
+    if len(z_list) > 0:
+        print('Maximum |z| of difference of means: %.3f'%np.max(np.abs(z_list)))
+    if len(p_list) > 0:
+        print('Minimum KS p value: %.4g (%d observables with p < 0.05)'%(np.min(p_list), np.sum(p_list < 0.05)))
+    print('Results written to %s'%outname)
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+try:
+    from openmm.app import *
+    from openmm import *
+    from openmm.unit import *
+except:
+    from simtk.openmm.app import *
+    from simtk.openmm import *
+    from simtk.unit import *
+
+import getopt, os, sys, time, math
+import parmed as pmd
+import numpy as np
+
+usage = '\nUsage: python validate_ribosome_grid.py\n' \
+        '       --grid | -g <ribo_grid.npz> ribosome grid created by gen_ribosome_grid.py\n'\
+        '       --ribo_psf | -p <ribosome.psf> psf file of the truncated CG ribosome used to create the grid\n'\
+        '       --prot_psf | -n <protein.psf> psf file of the CG nascent chain\n'\
+        '       --xml | -x <rnc.xml> OpenMM force field of the ribosome-nascent-chain complex\n'\
+        '       --cor | -c <rnc_lN.cor> cor file of an RNC with explicit ribosome beads, e.g.\n'\
+        '                               rnc_lN_stage_3_final.cor from continuous synthesis without grid\n'\
+        '       [--nsample | -m] <0> number of extra samples with randomly displaced mobile atoms. Default is 0.\n'\
+        '       [--displace | -d] <1.0> maximum random displacement in angstrom. Default is 1.0.\n'\
+        '       [--platform | -P] <Reference> OpenMM platform. Default is Reference.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Compare energies and forces on the mobile atoms (nascent chain and free ribosome atoms) from the\n'\
+        ' frozen ribosome represented by explicit beads and by the precomputed grid potential.\n'
+
+# parse ribo_free_mask, same as continuous_synthesis_v7.py
+def parse_mask(struct, mask):
+    mask_idx = []
+    mask_list = mask.strip().split('|')
+    for m in mask_list:
+        sub_list = m.strip().split(':')
+        seg_mask = sub_list[0]
+        segid_list = seg_mask.strip().split(',')
+        segid_list = [s.strip() for s in segid_list]
+        if len(sub_list) == 2:
+            sub_mask = sub_list[1]
+            sub_list = sub_mask.strip().split('@')
+            res_mask = sub_list[0]
+            resid_list =res_mask.strip().split(',')
+            resid_list = [s.strip().split(' - ') for s in resid_list]
+            if len(sub_list) == 2:
+                atm_mask = sub_list[1]
+                atmnm_list =atm_mask.strip().split(',')
+                atmnm_list = [s.strip() for s in atmnm_list]
+            else:
+                atmnm_list = []
+        else:
+            resid_list = []
+            atmnm_list = []
+
+        for atm in struct.atoms:
+            if (atm.residue.segid in segid_list and atm.name in atmnm_list) or (segid_list == [] and atmnm_list == []) or (
+                segid_list == [] and atm.name in atmnm_list) or (atm.residue.segid in segid_list and atmnm_list == []):
+                resid = atm.residue.number
+                if resid_list == []:
+                    mask_idx.append(atm.idx)
+                    continue
+                for r in resid_list:
+                    if len(r) == 1 and resid == int(r[0]):
+                        mask_idx.append(atm.idx)
+                        break
+                    elif len(r) == 2 and resid >= int(r[0]) and resid <= int(r[1]):
+                        mask_idx.append(atm.idx)
+                        break
+    return mask_idx
+# END parse mask
+
+# Add grid potential of the frozen ribosome acting on mobile atoms, same as continuous_synthesis_v7.py
+def add_ribosome_grid_force(system, custom_nb_force, mobile_idx, ribo_grid):
+    n_basis = ribo_grid['weights'].shape[1]
+    (nx, ny, nz) = [int(n) for n in ribo_grid['shape']]
+    grid_min = ribo_grid['origin']
+    grid_max = ribo_grid['origin'] + (ribo_grid['shape'] - 1) * ribo_grid['spacing']
+    energy = 'qg*phi(x1,y1,z1)'
+    for k in range(n_basis):
+        energy += '+w%d*g%d(x1,y1,z1)'%(k, k)
+    grid_force = CustomCompoundBondForce(1, energy)
+    grid_force.addPerBondParameter('qg')
+    for k in range(n_basis):
+        grid_force.addPerBondParameter('w%d'%k)
+    grid_force.addTabulatedFunction('phi', Continuous3DFunction(nx, ny, nz, ribo_grid['phi'].ravel().tolist(),
+        grid_min[0], grid_max[0], grid_min[1], grid_max[1], grid_min[2], grid_max[2]))
+    for k in range(n_basis):
+        grid_force.addTabulatedFunction('g%d'%k, Continuous3DFunction(nx, ny, nz, ribo_grid['basis'][k].ravel().tolist(),
+            grid_min[0], grid_max[0], grid_min[1], grid_max[1], grid_min[2], grid_max[2]))
+
+    param_name = [custom_nb_force.getPerParticleParameterName(i) for i in range(custom_nb_force.getNumPerParticleParameters())]
+    for i in mobile_idx:
+        param = custom_nb_force.getParticleParameters(i)
+        ke = param[param_name.index('ke')]
+        kv = param[param_name.index('kv')]
+        ep = param[param_name.index('ep')]
+        ld = param[param_name.index('ld')]
+        charge = param[param_name.index('charge')]
+        index = int(param[param_name.index('index')])
+        if abs(ld - ribo_grid['ld']) > 1e-8 or not ribo_grid['weight_mask'][index]:
+            print('Error: parameters of atom %d are not covered by the ribosome grid. Please re-generate the grid.'%i)
+            sys.exit()
+        grid_force.addBond([i], [ke*charge/ep] + list(kv*ribo_grid['weights'][index]))
+    system.addForce(grid_force)
+    return grid_force
+# END Add grid potential of the frozen ribosome acting on mobile atoms
+
+# Calculate energy and forces of a system
+def calc_energy_force(context, positions):
+    context.setPositions(positions)
+    state = context.getState(getEnergy=True, getForces=True)
+    energy = state.getPotentialEnergy().value_in_unit(kilocalories_per_mole)
+    forces = state.getForces(asNumpy=True).value_in_unit(kilocalories_per_mole/angstrom)
+    return (energy, forces)
+# END Calculate energy and forces of a system
+
+#################################### MAIN ####################################
+grid_file = ''
+ribo_psf = ''
+prot_psf = ''
+xml_file = ''
+cor_file = ''
+nsample = 0
+displace = 1.0
+platform_name = 'Reference'
+
+if len(sys.argv) == 1:
+    print(usage)
+    sys.exit()
+
+try:
+    opts, args = getopt.getopt(sys.argv[1:],"hg:p:n:x:c:m:d:P:", ["grid=", "ribo_psf=", "prot_psf=", "xml=", "cor=",
+        "nsample=", "displace=", "platform="])
+except getopt.GetoptError:
+    print(usage)
+    sys.exit()
+for opt, arg in opts:
+    if opt == '-h':
+        print(usage)
+        sys.exit()
+    elif opt in ("-g", "--grid"):
+        grid_file = arg
+    elif opt in ("-p", "--ribo_psf"):
+        ribo_psf = arg
+    elif opt in ("-n", "--prot_psf"):
+        prot_psf = arg
+    elif opt in ("-x", "--xml"):
+        xml_file = arg
+    elif opt in ("-c", "--cor"):
+        cor_file = arg
+    elif opt in ("-m", "--nsample"):
+        nsample = int(arg)
+    elif opt in ("-d", "--displace"):
+        displace = float(arg)
+    elif opt in ("-P", "--platform"):
+        platform_name = arg
+
+if grid_file == '' or ribo_psf == '' or prot_psf == '' or xml_file == '' or cor_file == '':
+    print(usage)
+    sys.exit()
+
+print('--> Reading ribosome grid and RNC structure')
+data = np.load(grid_file)
+ribo_grid = {}
+for key in data.files:
+    ribo_grid[key] = data[key]
+ribo_psf_pmd = pmd.charmm.psf.CharmmPsfFile(ribo_psf)
+prot_psf_pmd = pmd.charmm.psf.CharmmPsfFile(prot_psf)
+if int(ribo_grid['n_ribo_atom']) != len(ribo_psf_pmd.atoms):
+    print('Error: ribosome grid %s was not generated for %s.'%(grid_file, ribo_psf))
+    sys.exit()
+cor = pmd.load_file(cor_file)
+positions = np.array(cor.positions.value_in_unit(angstroms))
+nascent_chain_length = len(positions) - len(ribo_psf_pmd.atoms)
+if nascent_chain_length < 1 or nascent_chain_length > len(prot_psf_pmd.residues):
+    print('Error: %s is not a structure of the nascent chain with explicit ribosome beads.'%cor_file)
+    sys.exit()
+rnc_psf_pmd = prot_psf_pmd[':1-'+str(nascent_chain_length)] + ribo_psf_pmd
+# renumber ribosome resid
+idx = 0
+for res in rnc_psf_pmd.residues:
+    if res.segid != 'A':
+        res.number = ribo_psf_pmd.residues[idx].number
+        idx += 1
+print('    Nascent chain length: %d'%nascent_chain_length)
+
+nc_atom_index = [atm.idx for atm in rnc_psf_pmd.atoms if atm.residue.segid == 'A']
+if str(ribo_grid['free_mask']) == '':
+    ribo_free_idx = []
+else:
+    ribo_free_idx = parse_mask(rnc_psf_pmd, str(ribo_grid['free_mask']))
+mobile_idx = nc_atom_index + ribo_free_idx
+explicit_idx = set([i + nascent_chain_length for i in ribo_grid['explicit_idx']])
+grid_atom_index = [atm.idx for atm in rnc_psf_pmd.atoms if atm.residue.segid != 'A' and not atm.idx in explicit_idx]
+print('    %d mobile atoms, %d frozen ribosome atoms represented by grid'%(len(mobile_idx), len(grid_atom_index)))
+
+## Build explicit and grid systems ##
+print('--> Building systems')
+forcefield = ForceField(xml_file)
+top = rnc_psf_pmd.topology
+template_map = {}
+for res in top.residues():
+    template_map[res] = res.name
+cutoff = float(ribo_grid['cutoff'])*nanometer
+system = forcefield.createSystem(top, nonbondedMethod=CutoffNonPeriodic, nonbondedCutoff=cutoff,
+    constraints=None, removeCMMotion=False, ignoreExternalBonds=True, residueTemplates=template_map)
+for force in system.getForces():
+    if force.getName() == 'CustomNonbondedForce':
+        custom_nb_force = force
+        break
+custom_nb_force.setUseSwitchingFunction(True)
+custom_nb_force.setSwitchingDistance(float(ribo_grid['switch_cutoff'])*nanometer)
+
+# only interactions between mobile atoms and frozen ribosome atoms represented by grid
+explicit_system = System()
+grid_system = System()
+for i in range(system.getNumParticles()):
+    explicit_system.addParticle(system.getParticleMass(i))
+    grid_system.addParticle(system.getParticleMass(i))
+explicit_nb_force = custom_nb_force.__copy__()
+explicit_nb_force.addInteractionGroup(mobile_idx, grid_atom_index)
+explicit_system.addForce(explicit_nb_force)
+add_ribosome_grid_force(grid_system, custom_nb_force, mobile_idx, ribo_grid)
+
+platform = Platform.getPlatformByName(platform_name)
+explicit_context = Context(explicit_system, VerletIntegrator(0.001*picoseconds), platform)
+grid_context = Context(grid_system, VerletIntegrator(0.001*picoseconds), platform)
+print('    Done.')
+## END Build explicit and grid systems ##
+
+## Compare energies and forces ##
+print('\n%8s %16s %16s %12s %12s %12s %12s'%('Sample', 'E_explicit', 'E_grid', 'dE', 'RMS_F', 'RMS_dF', 'Max_dF'))
+print('%8s %16s %16s %12s %12s %12s %12s'%('', '(kcal/mol)', '(kcal/mol)', '(kcal/mol)', '(kcal/mol/A)',
+    '(kcal/mol/A)', '(kcal/mol/A)'))
+worst = []
+for i_sample in range(nsample+1):
+    sample_positions = np.copy(positions)
+    if i_sample > 0:
+        sample_positions[mobile_idx] += np.random.uniform(-displace, displace, (len(mobile_idx), 3))
+    (E_explicit, F_explicit) = calc_energy_force(explicit_context, sample_positions*angstrom)
+    (E_grid, F_grid) = calc_energy_force(grid_context, sample_positions*angstrom)
+    F_explicit = F_explicit[mobile_idx]
+    grid_min = 10*ribo_grid['origin']
+    grid_max = 10*(ribo_grid['origin'] + (ribo_grid['shape'] - 1) * ribo_grid['spacing'])
+    mobile_pos = sample_positions[mobile_idx]
+    n_out = np.sum(np.any((mobile_pos < grid_min) | (mobile_pos > grid_max), axis=1))
+    if n_out > 0:
+        print('Warning: %d mobile atoms are outside the grid box in sample %d.'%(n_out, i_sample))
+    dF = np.linalg.norm(F_grid[mobile_idx] - F_explicit, axis=1)
+    print('%8d %16.4f %16.4f %12.4f %12.4f %12.4f %12.4f'%(i_sample, E_explicit, E_grid, E_grid-E_explicit,
+        np.sqrt(np.mean(np.sum(F_explicit**2, axis=1))), np.sqrt(np.mean(dF**2)), np.max(dF)))
+    for j in range(len(mobile_idx)):
+        worst.append([dF[j], np.linalg.norm(F_explicit[j]), i_sample, mobile_idx[j]])
+
+worst.sort(reverse=True)
+print('\nAtoms with the largest force errors:')
+print('%8s %8s %6s %8s %6s %16s %16s'%('Sample', 'Index', 'Segid', 'Resid', 'Name', '|F_explicit|', '|dF|'))
+for (dF, F, i_sample, idx) in worst[:10]:
+    atm = rnc_psf_pmd.atoms[idx]
+    print('%8d %8d %6s %8d %6s %16.4f %16.4f'%(i_sample, idx+1, atm.residue.segid, atm.residue.number, atm.name, F, dF))
+## END Compare energies and forces ##
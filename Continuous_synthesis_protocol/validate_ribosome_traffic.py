@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import getopt, os, sys, time, subprocess, tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from ribosome_traffic_tasep import simulate_ribosome_traffic
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+example_dir = os.path.join(script_dir, '..', 'example', 'continuous_synthesis', 'input', 'setup')
+
+usage = '\nUsage: python validate_ribosome_traffic.py\n' \
+        '       [--mrna | -m] <mrna_sequence.txt> mRNA sequence file (control option mrna_seq). Default is\n'\
+        '                     4c5c_mrna_sequence_fast.txt of example/continuous_synthesis.\n'\
+        '       [--trans | -t] <trans_times.txt> codon translation times (control option trans_times). Default\n'\
+        '                      is Fluitt_ecoli_trans_time_310K_avg_16.5.txt of example/continuous_synthesis.\n'\
+        '       [--rate | -i] <"0.083333"> initiation rates (s-1) to compare. Use "," to select multiple\n'\
+        '                     rates. Default is 0.083333, the initiation_rate of example/continuous_synthesis.\n'\
+        '       [--binary | -b] <ribosome_traffic> the ribosome_traffic binary. Default is the one next to\n'\
+        '                       this script.\n'\
+        '       [--ribosomes | -n] <4000> traffic_num_ribosomes of the in-process simulator. Default is 4000.\n'\
+        '       [--replicas | -r] <16> traffic_num_replicas of the in-process simulator. Default is 16.\n'\
+        '       [--seed | -s] <100> traffic_seed of the in-process simulator. Default is 100.\n'\
+        '       [--outname | -o] <ribosome_traffic_validation.dat> output file. Default is\n'\
+        '                        ribosome_traffic_validation.dat.\n'\
+        '       [-h] Print this information\n\n'\
+        ' Compare the traffic-adjusted mean codon dwell times of the ribosome_traffic binary used by\n'\
+        ' continuous_synthesis_v6.py with those of the in-process TASEP simulator used by\n'\
+        ' continuous_synthesis_v7.py (ribosome_traffic_tasep.py, footprint 10 codons and termination rate\n'\
+        ' 35 s-1 as in the binary). For each initiation rate the output lists per codon the intrinsic dwell\n'\
+        ' time, the dwell times of both and their relative difference, followed by the total transit time,\n'\
+        ' the correlation and the mean and maximum relative difference over all codons.\n'
+
+# mRNA sequence as one string, read the same way as continuous_synthesis_v7.py
+def read_mrna(mrna_file):
+    f = open(mrna_file, 'r')
+    mrna_seq = ''.join(f.read().strip().split('\n'))
+    f.close()
+    if len(mrna_seq) % 3 != 0:
+        print('Error: Number of nucleotides in sequence, '+str(len(mrna_seq))+', is not evenly divisible by 3')
+        sys.exit()
+    return mrna_seq
+# END read mRNA sequence
+
+# codon : mean translation time map
+def read_trans_times(trans_file):
+    map_codon_to_mfpt = {}
+    f = open(trans_file, 'r')
+    for line in f:
+        temp = line.strip().split()
+        if len(temp) == 2:
+            map_codon_to_mfpt[temp[0]] = float(temp[1])
+    f.close()
+    return map_codon_to_mfpt
+# END codon : mean translation time map
+
+# run the ribosome_traffic binary as continuous_synthesis_v6.py does
+# return list of mean dwell times, one per codon
+def run_binary(binary, mrna_seq, trans_file, rate):
+    work_dir = tempfile.mkdtemp(prefix='ribosome_traffic_')
+    mrna_file = os.path.join(work_dir, 'mrna.dat')
+    fo = open(mrna_file, 'w')
+    fo.write(mrna_seq+'\n')
+    fo.close()
+    try:
+        shell_out = subprocess.run([binary, mrna_file, os.path.abspath(trans_file), str(rate)], cwd=work_dir,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    finally:
+        os.remove(mrna_file)
+        os.rmdir(work_dir)
+    shell_out = shell_out.stdout.strip().split('\n')
+    try:
+        mean_fpt_list = [float(line.strip()) for line in shell_out[:len(mrna_seq)//3]]
+    except ValueError:
+        print('Error: cannot read the output of %s:'%binary)
+        print('\n'.join(shell_out))
+        sys.exit()
+    if len(mean_fpt_list) != len(mrna_seq)//3:
+        print('Error: %s returned %d dwell times for %d codons.'%(binary, len(mean_fpt_list), len(mrna_seq)//3))
+        sys.exit()
+    return mean_fpt_list
+# END run the ribosome_traffic binary
+
+if __name__ == '__main__':
+    mrna_file = os.path.join(example_dir, '4c5c_mrna_sequence_fast.txt')
+    trans_file = os.path.join(example_dir, 'Fluitt_ecoli_trans_time_310K_avg_16.5.txt')
+    rate_list = [0.083333]
+    binary = os.path.join(script_dir, 'ribosome_traffic')
+    num_ribosomes = 4000
+    num_replicas = 16
+    seed = 100
+    outname = 'ribosome_traffic_validation.dat'
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],"hm:t:i:b:n:r:s:o:", ["mrna=", "trans=", "rate=", "binary=",
+            "ribosomes=", "replicas=", "seed=", "outname="])
+    except getopt.GetoptError:
+        print(usage)
+        sys.exit()
+    for opt, arg in opts:
+        if opt == '-h':
+            print(usage)
+            sys.exit()
+        elif opt in ("-m", "--mrna"):
+            mrna_file = arg
+        elif opt in ("-t", "--trans"):
+            trans_file = arg
+        elif opt in ("-i", "--rate"):
+            rate_list = [float(r) for r in arg.strip().split(',')]
+        elif opt in ("-b", "--binary"):
+            binary = os.path.abspath(arg)
+        elif opt in ("-n", "--ribosomes"):
+            num_ribosomes = int(arg)
+        elif opt in ("-r", "--replicas"):
+            num_replicas = int(arg)
+        elif opt in ("-s", "--seed"):
+            seed = int(arg)
+        elif opt in ("-o", "--outname"):
+            outname = arg
+
+    for f in [mrna_file, trans_file, binary]:
+        if not os.path.exists(f):
+            print('Error: cannot find '+f+'.')
+            sys.exit()
+    mrna_seq = read_mrna(mrna_file)
+    map_codon_to_mfpt = read_trans_times(trans_file)
+    codon_list = [mrna_seq[3*i:3*i+3] for i in range(len(mrna_seq)//3)]
+    for codon in codon_list:
+        if not codon in map_codon_to_mfpt.keys():
+            print('Error: cannot find the translation time of codon %s in %s.'%(codon, trans_file))
+            sys.exit()
+    intrinsic_list = [map_codon_to_mfpt[codon] for codon in codon_list]
+
+    t0 = time.time()
+    sim_fpt = simulate_ribosome_traffic([intrinsic_list], rate_list, num_ribosomes=num_ribosomes,
+        num_replicas=num_replicas, seed=seed)[0]
+    print('In-process simulator: %d initiation rates in %.1f s'%(len(rate_list), time.time()-t0))
+
+    fo = open(outname, 'w')
+    for j, rate in enumerate(rate_list):
+        t0 = time.time()
+        bin_fpt = np.array(run_binary(binary, mrna_seq, trans_file, rate))
+        print('ribosome_traffic binary: initiation rate %s in %.1f s'%(str(rate), time.time()-t0))
+        tasep_fpt = sim_fpt[j, :len(codon_list)]
+        rel_diff = (tasep_fpt - bin_fpt) / bin_fpt
+        fo.write('# Initiation rate: %s s-1\n'%str(rate))
+        fo.write('#%7s %6s %12s %12s %12s %10s\n'%('CODON', 'TYPE', 'INTRINSIC', 'BINARY', 'IN-PROCESS', 'REL_DIFF'))
+        for i in range(len(codon_list)):
+            fo.write('%8d %6s %12.6f %12.6f %12.6f %10.4f\n'%(i+1, codon_list[i], intrinsic_list[i], bin_fpt[i],
+                tasep_fpt[i], rel_diff[i]))
+        summary = ('# Total transit time (s): binary %.4f; in-process %.4f\n'%(bin_fpt.sum(), tasep_fpt.sum())+
+                   '# Correlation: %.5f\n'%np.corrcoef(bin_fpt, tasep_fpt)[0, 1]+
+                   '# Relative difference: mean %.4f; mean absolute %.4f; max absolute %.4f (codon %d)\n\n'%(
+                       rel_diff.mean(), np.abs(rel_diff).mean(), np.abs(rel_diff).max(), np.abs(rel_diff).argmax()+1))
+        fo.write(summary)
+        print('Initiation rate %s s-1\n'%str(rate)+summary.replace('# ', '  ').rstrip('\n'))
+    fo.close()
+    print('Results written to '+outname)